@@ -10,7 +10,7 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from _logger_lib.db import init_db, verify_db, _run_migrations
 from _logger_lib.viewer import (
-    view_sessions, show_info, clear_db, tidy_db, get_session_ids,
+    view_sessions, show_info, clear_db, tidy_db, prune_db, get_session_ids,
     list_sessions,
 )
 
@@ -40,6 +40,18 @@ def parse_datetime(s):
         sys.exit(1)
 
 
+def parse_size(s):
+    import re
+
+    # Sizes in bytes or with a binary suffix: 500M, 2G, 1.5T
+    m = re.match(r'^(\d+(?:\.\d+)?)([kmgt]?)i?b?$', s.strip().lower())
+    if not m:
+        print(f"ERROR: Cannot parse size: {s}", file=sys.stderr)
+        sys.exit(1)
+    multipliers = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+    return int(float(m.group(1)) * multipliers[m.group(2)])
+
+
 def main():
     if len(sys.argv) < 3:
         print("Usage: _log.py <mode> <log_db> [options]", file=sys.stderr)
@@ -68,6 +80,7 @@ def main():
         except RuntimeError as e:
             print(f"ERROR: {e}", file=sys.stderr)
             sys.exit(1)
+        _run_migrations(conn)
 
         parser = argparse.ArgumentParser(prog="_log.py sessions")
         parser.add_argument("--grep", default=None)
@@ -147,6 +160,7 @@ def main():
             head=args.head,
             follow=args.follow,
             raw=args.raw,
+            db_path=log_db,
         )
         conn.close()
         return
@@ -157,6 +171,7 @@ def main():
         except RuntimeError as e:
             print(f"ERROR: {e}", file=sys.stderr)
             sys.exit(1)
+        _run_migrations(conn)
 
         fmt = "plain"
         if len(sys.argv) > 3 and sys.argv[3] == "--json":
@@ -171,6 +186,7 @@ def main():
         except RuntimeError as e:
             print(f"ERROR: {e}", file=sys.stderr)
             sys.exit(1)
+        _run_migrations(conn)
         clear_db(conn)
         conn.close()
         return
@@ -181,10 +197,39 @@ def main():
         except RuntimeError as e:
             print(f"ERROR: {e}", file=sys.stderr)
             sys.exit(1)
+        _run_migrations(conn)
         tidy_db(conn)
         conn.close()
         return
 
+    if mode == "prune":
+        try:
+            conn = verify_db(log_db)
+        except RuntimeError as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            sys.exit(1)
+        _run_migrations(conn)
+
+        parser = argparse.ArgumentParser(prog="_log.py prune")
+        parser.add_argument("--older-than", default=None,
+                            help="Remove sessions started before this time (abs or relative: 30d)")
+        parser.add_argument("--max-size", default=None,
+                            help="Remove the oldest sessions until the log fits in this size (2G)")
+
+        args = parser.parse_args(sys.argv[3:])
+        if args.older_than is None and args.max_size is None:
+            print("ERROR: prune needs --older-than and/or --max-size", file=sys.stderr)
+            sys.exit(1)
+
+        prune_db(
+            conn,
+            db_path=log_db,
+            older_than=parse_datetime(args.older_than) if args.older_than else None,
+            max_size=parse_size(args.max_size) if args.max_size else None,
+        )
+        conn.close()
+        return
+
     if mode == "help":
         print("Usage: crucible log <command> [options]")
         print()
@@ -207,9 +252,12 @@ def main():
         print("    --order asc|desc                 Sort direction")
         print("    --format plain|json              Output format")
         print("    --color                          Colorize output")
-        print("  info [--json]                      Show log database summary")
+        print("  info [--json]                      Show log database summary (incl. dropped/spilled lines)")
         print("  clear                              Delete all log entries")
-        print("  tidy                               Reclaim disk space (VACUUM)")
+        print("  tidy                               Pack closed sessions and reclaim disk space (VACUUM)")
+        print("  prune                              Remove old closed sessions, oldest first")
+        print("    --older-than <time>              Sessions started before this time (abs or relative: 30d)")
+        print("    --max-size <size>                Until the log fits in this size (500M, 2G)")
         print("  init                               Initialize log database")
         return
 
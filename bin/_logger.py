@@ -2,6 +2,7 @@
 # -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
 # vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
 
+import functools
 import os
 import queue
 import signal
@@ -11,45 +12,72 @@ import time
 
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from _logger_lib.db import verify_db, setup_session, LogInserter, _run_migrations
-from _logger_lib.output_writer import write_line
-from _logger_lib.pipe_reader import pipe_reader, flusher
+from _logger_lib.batching import BatchPolicy
+from _logger_lib.buffers import LineBuffer
+from _logger_lib.coldstore import cold_storage_enabled, pack_session
+from _logger_lib.db import (
+    verify_db, setup_session, close_session, LogInserter, _run_migrations,
+)
+from _logger_lib.follow import FollowNotifier
+from _logger_lib.output_writer import ConsoleWriter
+from _logger_lib.pipe_reader import pipe_reader
 
 signal.signal(signal.SIGINT, lambda s, f: None)
 
-sys.stdout.reconfigure(line_buffering=False)
-sys.stderr.reconfigure(line_buffering=False)
 
+def handle_lines(console, db_queue, stream, stream_id, ts, lines):
+    # echo first, the console never waits on the database
+    console.write(stream_id, lines)
+    db_queue.put_many([(ts, stream, stream_id, line) for line in lines])
 
-def db_writer_and_output(msg_queue, inserter):
-    BATCH_WINDOW = 0.010
+
+def commit_rows(rows, inserter, on_commit=None):
+    if rows:
+        inserter.insert_many(rows)
+        inserter.commit()
+        if on_commit is not None:
+            on_commit()
+
+
+def db_writer(db_queue, inserter, policy=None, on_commit=None):
+    if policy is None:
+        policy = BatchPolicy.from_env()
+    stream_ids = inserter.stream_ids
+
+    # rows are held here until the batch policy says to commit them, so
+    # the write lock is only taken for the length of one insert_many();
+    # this runs in its own thread so the event loop echoing to the
+    # console never waits for it
+    pending = []
+    oldest = None
 
     while True:
-        batch = []
-        deadline = time.time() + BATCH_WINDOW
-
-        while time.time() < deadline:
-            try:
-                msg = msg_queue.get(timeout=0.005)
-                if msg is None:
-                    batch.sort(key=lambda m: m[0])
-                    for ts, stream, stream_id, line in batch:
-                        write_line(stream_id, line)
-                        inserter.insert(ts, stream, line)
-                    inserter.commit()
-                    return
-                batch.append(msg)
-            except queue.Empty:
-                break
-
-        if batch:
-            batch.sort(key=lambda m: m[0])
-            for ts, stream, stream_id, line in batch:
-                write_line(stream_id, line)
-                inserter.insert(ts, stream, line)
-            inserter.commit()
-        else:
-            time.sleep(0.05)
+        age = time.monotonic() - oldest if pending else 0.0
+        try:
+            msgs = db_queue.get_many(policy.max_rows - len(pending),
+                                     timeout=policy.wait_timeout(len(pending), age))
+        except queue.Empty:
+            commit_rows(pending, inserter, on_commit)
+            pending = []
+            continue
+
+        done = msgs[-1] is None
+        if done:
+            msgs.pop()
+        if msgs and not pending:
+            oldest = time.monotonic()
+        # lines travel as bytes from the pipes to the console; this is
+        # the one place they are decoded
+        pending.extend((ts, stream_ids[stream], line.decode(errors="replace"))
+                       for ts, stream, stream_id, line in msgs)
+
+        if done:
+            commit_rows(pending, inserter, on_commit)
+            return
+
+        if policy.should_flush(len(pending), time.monotonic() - oldest, db_queue.qsize()):
+            commit_rows(pending, inserter, on_commit)
+            pending = []
 
 
 def main():
@@ -75,35 +103,41 @@ def main():
     db_session_id = setup_session(conn, source, session_id, command)
     inserter = LogInserter(conn, db_session_id)
 
-    msg_queue = queue.Queue()
-    flush_event = threading.Event()
-    shutdown_event = threading.Event()
-
-    reader_thread = threading.Thread(
-        target=pipe_reader,
-        args=(stdout_pipe, stderr_pipe, msg_queue, flush_event, shutdown_event),
-        daemon=True,
-    )
-    flusher_thread = threading.Thread(
-        target=flusher,
-        args=(stdout_pipe, stderr_pipe, flush_event, shutdown_event),
-        daemon=True,
+    # the pipes are read and echoed by one event loop in this thread;
+    # lines for the database go through a bounded queue to a writer
+    # thread so that a slow commit never holds up the terminal.  Past
+    # its capacity the queue spills, drops or blocks according to
+    # CRUCIBLE_LOG_DB_BUFFER_OVERFLOW.
+    console = ConsoleWriter(sys.stdout.fileno(), sys.stderr.fileno())
+    db_queue = LineBuffer.from_env("CRUCIBLE_LOG_DB_BUFFER")
+    # every commit wakes up whoever runs `log view --follow` on log_db
+    notifier = FollowNotifier(log_db)
+    db_thread = threading.Thread(
+        target=db_writer,
+        args=(db_queue, inserter, None, notifier.notify),
     )
-    writer_thread = threading.Thread(
-        target=db_writer_and_output,
-        args=(msg_queue, inserter),
-    )
-
-    reader_thread.start()
-    flusher_thread.start()
-    writer_thread.start()
-
-    writer_thread.join()
-    reader_thread.join()
-    shutdown_event.set()
-    flusher_thread.join()
+    db_thread.start()
 
+    try:
+        pipe_reader(stdout_pipe, stderr_pipe, functools.partial(handle_lines, console, db_queue),
+                    on_idle=console.flush)
+    finally:
+        db_queue.put(None)
+        db_thread.join()
+
+    inserter.commit()
+    close_session(conn, db_session_id, db_queue.dropped, db_queue.spilled, inserter.summary())
+    if cold_storage_enabled():
+        pack_session(conn, db_session_id)
+        # followers read what they have not shown yet from the blocks
+        notifier.notify()
     inserter.close()
+    db_queue.close()
+    notifier.close()
+
+    if db_queue.dropped:
+        print(f"WARNING: the logger dropped {db_queue.dropped} line(s) that could not be written "
+              f"to {log_db} in time", file=sys.stderr)
 
     try:
         os.unlink(stdout_pipe)
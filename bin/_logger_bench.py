@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _logger_lib.db import init_db, verify_db
+from _logger_lib.output_writer import ConsoleWriter, write_line
+from _logger_lib.pipe_reader import CLOSE_PIPE_STR
+
+
+LINE = "some representative benchmark debug output, iteration %d of the sample loop\n"
+
+
+def feed_pipe(pipe_path, stream, count):
+    with open(pipe_path, "w") as fh:
+        for i in range(count):
+            fh.write(LINE % i)
+        fh.write(f"{stream}->{CLOSE_PIPE_STR}\n")
+
+
+def run_contention(args):
+    """Run N _logger.py writers against one log database at the same time."""
+    # the pipes, and the database unless --db is given, are removed
+    # afterwards
+    with tempfile.TemporaryDirectory(prefix="logger-bench-") as work_dir:
+        return _contention(args, work_dir)
+
+
+def _contention(args, work_dir):
+    log_db = args.db or os.path.join(work_dir, "log.db")
+    if not os.path.exists(log_db):
+        init_db(log_db)
+
+    # read without verify_db() so that the journal mode of a database
+    # passed in with --db is reported as found
+    conn = sqlite3.connect(log_db)
+    journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    conn.close()
+
+    writers = []
+    feeders = []
+    start = time.time()
+    for n in range(args.writers):
+        stdout_pipe = os.path.join(work_dir, f"stdout-{n}")
+        stderr_pipe = os.path.join(work_dir, f"stderr-{n}")
+        os.mkfifo(stdout_pipe)
+        os.mkfifo(stderr_pipe)
+
+        writers.append(subprocess.Popen(
+            [sys.executable, args.logger, "console", f"bench-{n}-{start}",
+             f"logger-bench___writer___{n}", log_db, stdout_pipe, stderr_pipe],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        ))
+        for pipe_path, stream, count in [
+            (stdout_pipe, "STDOUT", args.lines),
+            (stderr_pipe, "STDERR", args.lines // 10),
+        ]:
+            feeder = multiprocessing.Process(target=feed_pipe, args=(pipe_path, stream, count))
+            feeder.start()
+            feeders.append(feeder)
+
+    elapsed = []
+    pending = list(writers)
+    while pending:
+        for writer in list(pending):
+            rc = writer.poll()
+            if rc is None:
+                continue
+            pending.remove(writer)
+            elapsed.append(time.time() - start)
+            if rc != 0:
+                print(f"ERROR: writer exited with rc={rc}", file=sys.stderr)
+        time.sleep(0.01)
+    for feeder in feeders:
+        feeder.join()
+    total_elapsed = time.time() - start
+
+    conn = verify_db(log_db)
+    # closed sessions are normally packed into line_blocks by now
+    rows = 0
+    for table, count in [("lines", "COUNT(*)"), ("line_blocks", "COALESCE(SUM(line_count), 0)")]:
+        rows += conn.execute(
+            f"SELECT {count} FROM {table} JOIN sessions ON sessions.id = {table}.session "
+            "WHERE sessions.session_id LIKE ?", (f"bench-%-{start}",)
+        ).fetchone()[0]
+    conn.close()
+
+    expected = args.writers * (args.lines + args.lines // 10)
+    print(f"logger:       {args.logger}")
+    print(f"journal mode: {journal_mode}")
+    print(f"writers:      {args.writers}")
+    print(f"lines:        {rows} stored / {expected} written")
+    print(f"elapsed:      {total_elapsed:.2f}s (first writer done {min(elapsed):.2f}s, last {max(elapsed):.2f}s)")
+    print(f"throughput:   {rows / total_elapsed:.0f} lines/s")
+
+    if rows != expected:
+        return 1
+    return 0
+
+
+def write_syscalls():
+    # write(2)/writev(2) calls made by this process so far, or None when
+    # the kernel does not expose per-process I/O accounting
+    try:
+        with open("/proc/self/io") as fh:
+            for line in fh:
+                if line.startswith("syscw:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def echo_per_line(fd, chunks):
+    # the writer the logger used to have: write_line() for every line
+    saved_stdout = sys.stdout
+    sys.stdout = os.fdopen(fd, "w", closefd=False)
+    try:
+        for chunk in chunks:
+            for line in chunk:
+                write_line(0, line)
+    finally:
+        sys.stdout = saved_stdout
+
+
+def echo_vectored(fd, chunks):
+    # ConsoleWriter as the event loop drives it when every chunk is
+    # followed by a moment without input, which is its worst case
+    console = ConsoleWriter(fd, fd)
+    for chunk in chunks:
+        console.write(0, chunk)
+        console.flush()
+
+
+def run_console(args):
+    """Compare the per-line console writer with ConsoleWriter."""
+    lines = [(LINE % i).rstrip("\n").encode() for i in range(args.lines)]
+    chunks = [lines[i:i + args.batch] for i in range(0, len(lines), args.batch)]
+
+    print(f"lines:  {args.lines} in batches of {args.batch}")
+    print(f"output: {args.output or 'pipe to cat'}")
+    print()
+    print(f"{'writer':<10} {'elapsed':>9} {'lines/s':>11} {'writes':>9} {'writes/1k lines':>16}")
+
+    for name, echo in [("per-line", echo_per_line), ("vectored", echo_vectored)]:
+        if args.output:
+            reader = None
+            fd = os.open(args.output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        else:
+            reader = subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            fd = reader.stdin.fileno()
+
+        syscalls = write_syscalls()
+        start = time.perf_counter()
+        echo(fd, chunks)
+        elapsed = time.perf_counter() - start
+        if syscalls is not None:
+            syscalls = write_syscalls() - syscalls
+
+        if reader is None:
+            os.close(fd)
+        else:
+            reader.stdin.close()
+            reader.wait()
+
+        if syscalls is None:
+            writes = per_1k = "n/a"
+        else:
+            writes = str(syscalls)
+            per_1k = f"{syscalls * 1000 / args.lines:.1f}"
+        print(f"{name:<10} {elapsed:>8.3f}s {args.lines / elapsed:>11.0f} {writes:>9} {per_1k:>16}")
+
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="_logger_bench.py",
+                                     description="Logger benchmarks")
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    contention = subparsers.add_parser("contention",
+                                       help="N concurrent _logger.py writers sharing one log database")
+    contention.add_argument("--writers", type=int, default=4)
+    contention.add_argument("--lines", type=int, default=50000,
+                            help="Lines written to each writer's stdout (a tenth as many go to stderr)")
+    contention.add_argument("--db", default=None,
+                            help="Log database to use (default: a new one in a temporary directory)")
+    contention.add_argument("--logger",
+                            default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "_logger.py"),
+                            help="The _logger.py to benchmark")
+
+    console = subparsers.add_parser("console",
+                                    help="Console echo: write per line vs. one vectored write per batch")
+    console.add_argument("--lines", type=int, default=200000)
+    console.add_argument("--batch", type=int, default=100,
+                         help="Lines per batch, as if read from the pipe in one chunk")
+    console.add_argument("--output", default=None,
+                         help="File to write to (default: a pipe to cat, which discards it)")
+
+    args = parser.parse_args()
+
+    if args.mode == "contention":
+        sys.exit(run_contention(args))
+    if args.mode == "console":
+        sys.exit(run_console(args))
+
+
+if __name__ == "__main__":
+    main()
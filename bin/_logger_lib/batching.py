@@ -0,0 +1,59 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import os
+
+
+# A batch is committed as soon as any of these caps is hit:
+#   max_rows  - this many lines are waiting to be committed
+#   max_age   - the oldest waiting line has waited this long (seconds),
+#               which bounds how far `log view --follow` lags behind
+#   idle      - no new input arrived for this long (seconds) and
+#               nothing is queued behind it
+# While input keeps arriving (the queue is not empty) the batch keeps
+# growing until max_rows or max_age, so bursts coalesce into a few
+# large transactions instead of many tiny ones.
+DEFAULT_MAX_ROWS = 20000
+DEFAULT_MAX_AGE = 0.5
+DEFAULT_IDLE = 0.010
+
+
+def _env(name, default, convert):
+    value = os.environ.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        return default
+
+
+class BatchPolicy:
+    def __init__(self, max_rows=DEFAULT_MAX_ROWS, max_age=DEFAULT_MAX_AGE, idle=DEFAULT_IDLE):
+        self.max_rows = max(1, max_rows)
+        self.max_age = max(0.0, max_age)
+        self.idle = max(0.0, min(idle, self.max_age))
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_rows=_env("CRUCIBLE_LOG_BATCH_MAX_ROWS", DEFAULT_MAX_ROWS, int),
+            max_age=_env("CRUCIBLE_LOG_BATCH_MAX_AGE", DEFAULT_MAX_AGE, float),
+            idle=_env("CRUCIBLE_LOG_BATCH_IDLE", DEFAULT_IDLE, float),
+        )
+
+    def should_flush(self, rows, age, queue_depth):
+        if rows == 0:
+            return False
+        if rows >= self.max_rows or age >= self.max_age:
+            return True
+        # nothing is waiting behind this batch and the idle timeout
+        # has already run out
+        return queue_depth == 0 and self.idle == 0
+
+    def wait_timeout(self, rows, age):
+        # how long to wait for more input before committing what is
+        # pending; with nothing pending just wait for input
+        if rows == 0:
+            return None
+        return max(0.0, min(self.idle, self.max_age - age))
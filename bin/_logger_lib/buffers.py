@@ -0,0 +1,188 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import collections
+import os
+import pickle
+import queue
+import tempfile
+import threading
+
+
+# What a LineBuffer does with a new line when it already holds
+# `capacity` lines in memory:
+#   spill       - append it to a temporary file; the spilled lines are
+#                 read back in order once the consumer catches up, so
+#                 nothing is lost, only delayed
+#   drop-oldest - discard the oldest buffered line to make room
+#   block       - make the producer wait for room, which in the end
+#                 blocks whatever is writing into the logger's pipes
+OVERFLOW_POLICIES = ("spill", "drop-oldest", "block")
+
+DEFAULT_CAPACITY = 100000
+DEFAULT_OVERFLOW = "spill"
+
+
+class LineBuffer:
+    """Bounded FIFO between two logger stages.
+
+    Offers the subset of the queue.Queue interface the logger uses
+    (put/get/get_nowait/qsize, plus put_many() and get_many()).  Once the in-memory
+    part is full, new lines are spilled to disk, dropped or made to wait
+    according to the overflow policy; spilled and dropped lines are
+    counted in `spilled` and `dropped`.  A None sentinel is always accepted and is delivered
+    after every line that was put before it.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, overflow=DEFAULT_OVERFLOW, spill_dir=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"unknown overflow policy: {overflow}")
+        self.capacity = max(1, capacity)
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.dropped = 0
+        self.spilled = 0
+
+        self._items = collections.deque()
+        lock = threading.Lock()
+        self._cond = threading.Condition(lock)
+        self._not_full = threading.Condition(lock)
+        self._waiting = 0
+        self._blocked = 0
+        self._spill_fh = None
+        self._spill_read_pos = 0
+        self._spill_pending = 0
+
+    @classmethod
+    def from_env(cls, prefix):
+        capacity = DEFAULT_CAPACITY
+        value = os.environ.get(f"{prefix}_LINES")
+        if value:
+            try:
+                capacity = int(value)
+            except ValueError:
+                pass
+        overflow = os.environ.get(f"{prefix}_OVERFLOW") or DEFAULT_OVERFLOW
+        if overflow not in OVERFLOW_POLICIES:
+            overflow = DEFAULT_OVERFLOW
+        return cls(capacity=capacity, overflow=overflow)
+
+    def put(self, item):
+        with self._cond:
+            self._put(item)
+            if self._waiting:
+                self._cond.notify()
+
+    def put_many(self, items):
+        """put() each of `items` in order, taking the lock once unless
+        the block policy has to wait for room."""
+        with self._cond:
+            for item in items:
+                self._put(item)
+            if self._waiting:
+                self._cond.notify()
+
+    def get(self, timeout=None):
+        with self._cond:
+            self._wait(timeout)
+            return self._pop()
+
+    def get_many(self, limit, timeout=None):
+        """Wait up to `timeout` for at least one item, then return up to
+        `limit` items taken under a single lock acquisition.  A None
+        sentinel, if reached, is the last item returned."""
+        with self._cond:
+            self._wait(timeout)
+            if not self._items:
+                self._unspill()
+            popleft = self._items.popleft
+            items = [popleft() for _ in range(min(limit, len(self._items)))]
+            if self._blocked:
+                self._not_full.notify_all()
+            return items
+
+    def get_nowait(self):
+        with self._cond:
+            if not self._available():
+                raise queue.Empty
+            return self._pop()
+
+    def qsize(self):
+        with self._cond:
+            return len(self._items) + self._spill_pending
+
+    def close(self):
+        with self._cond:
+            if self._spill_fh is not None:
+                self._spill_fh.close()
+                self._spill_fh = None
+            self._spill_pending = 0
+
+    def _put(self, item):
+        if not self._spill_pending and (len(self._items) < self.capacity or item is None):
+            self._items.append(item)
+        elif self._spill_pending:
+            # keep FIFO order: while anything is on disk, every new line
+            # (and the sentinel) has to go behind it
+            self._spill(item)
+        elif self.overflow == "spill":
+            self._spill(item)
+        elif self.overflow == "block":
+            self._blocked += 1
+            try:
+                # let the consumer at what is already buffered
+                if self._waiting:
+                    self._cond.notify()
+                self._not_full.wait_for(lambda: len(self._items) < self.capacity)
+            finally:
+                self._blocked -= 1
+            self._items.append(item)
+        else:
+            self._items.popleft()
+            self._items.append(item)
+            self.dropped += 1
+
+    def _wait(self, timeout):
+        if self._available():
+            return
+        self._waiting += 1
+        try:
+            if not self._cond.wait_for(self._available, timeout):
+                raise queue.Empty
+        finally:
+            self._waiting -= 1
+
+    def _available(self):
+        return bool(self._items) or self._spill_pending > 0
+
+    def _spill(self, item):
+        if self._spill_fh is None:
+            self._spill_fh = tempfile.TemporaryFile(prefix="crucible-logger-spill-", dir=self.spill_dir)
+        self._spill_fh.seek(0, os.SEEK_END)
+        pickle.dump(item, self._spill_fh, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spill_pending += 1
+        if item is not None:
+            self.spilled += 1
+
+    def _unspill(self):
+        # read back up to a buffer's worth of spilled lines in the order
+        # they were written
+        self._spill_fh.seek(self._spill_read_pos)
+        count = min(self._spill_pending, self.capacity)
+        for _ in range(count):
+            self._items.append(pickle.load(self._spill_fh))
+        self._spill_pending -= count
+        if self._spill_pending:
+            self._spill_read_pos = self._spill_fh.tell()
+        else:
+            self._spill_fh.seek(0)
+            self._spill_fh.truncate()
+            self._spill_read_pos = 0
+
+    def _pop(self):
+        if not self._items:
+            self._unspill()
+        item = self._items.popleft()
+        if self._blocked:
+            self._not_full.notify()
+        return item
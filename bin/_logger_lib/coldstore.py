@@ -0,0 +1,157 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import lzma
+import os
+import struct
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+
+
+# Once a session is closed its rows in `lines` are replaced by rows in
+# `line_blocks`, each holding up to BLOCK_LINES lines in timestamp order:
+#
+#   count        uint32
+#   timestamps   count doubles
+#   streams      count bytes (stream ids)
+#   text         the lines joined with "\n", UTF-8
+#
+# compressed with one of CODECS.  The logger never stores a line with a
+# "\n" in it, so the text splits back into exactly `count` lines.  The
+# ids the lines had in `lines` are kept next to the block (as deltas, in
+# the same order, zlib compressed) for the grep index, see search.py.
+BLOCK_LINES = 4096
+
+CODECS = {
+    "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+    "lzma": (lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+DEFAULT_CODEC = "zlib"
+
+COUNT_FORMAT = "<I"
+COUNT_SIZE = struct.calcsize(COUNT_FORMAT)
+
+
+def cold_storage_enabled():
+    return os.environ.get("CRUCIBLE_LOG_COLD_STORAGE", "1") != "0"
+
+
+def cold_storage_codec():
+    codec = os.environ.get("CRUCIBLE_LOG_COLD_CODEC") or DEFAULT_CODEC
+    return codec if codec in CODECS else DEFAULT_CODEC
+
+
+def encode_block(rows, codec=DEFAULT_CODEC):
+    """Pack (timestamp, stream id, line) rows into a compressed block."""
+    compress = CODECS[codec][0]
+    payload = b"".join([
+        struct.pack(COUNT_FORMAT, len(rows)),
+        array("d", [row[0] for row in rows]).tobytes(),
+        bytes(row[1] for row in rows),
+        "\n".join(row[2] or "" for row in rows).encode(),
+    ])
+    return compress(payload)
+
+
+def _unpack(data, codec):
+    # (timestamps, streams, text) of a block, the text still encoded
+    payload = CODECS[codec][1](data)
+    count = struct.unpack_from(COUNT_FORMAT, payload)[0]
+    offset = COUNT_SIZE
+    timestamps = array("d")
+    timestamps.frombytes(payload[offset:offset + 8 * count])
+    offset += 8 * count
+    streams = payload[offset:offset + count]
+    offset += count
+    return timestamps, streams, payload[offset:]
+
+
+def decode_block(data, codec):
+    """Unpack a block into a list of (timestamp, stream id, line) rows."""
+    timestamps, streams, text = _unpack(data, codec)
+    lines = text.decode().split("\n") if timestamps else []
+    return list(zip(timestamps, streams, lines))
+
+
+def count_block(data, codec, stream=None, since=None, until=None):
+    """Count a block's lines from `stream` between `since` and `until`
+    without decoding the text; the lines are in timestamp order, so the
+    time range is a slice."""
+    timestamps, streams, _ = _unpack(data, codec)
+    start = bisect_left(timestamps, since) if since else 0
+    end = bisect_right(timestamps, until) if until else len(timestamps)
+    if start >= end:
+        return 0
+    if stream is None:
+        return end - start
+    return streams.count(stream, start, end)
+
+
+def encode_ids(ids):
+    return zlib.compress(array("q", [b - a for a, b in zip([0] + ids, ids)]).tobytes())
+
+
+def decode_ids(data):
+    deltas = array("q")
+    deltas.frombytes(zlib.decompress(data))
+    return list(accumulate(deltas))
+
+
+def pack_session(conn, session_id, codec=None):
+    """Move a session's lines into compressed blocks.
+
+    Runs as one transaction, so readers see either the rows in `lines`
+    or the blocks, never both or neither.  Returns the number of lines
+    packed.
+    """
+    if codec is None:
+        codec = cold_storage_codec()
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        cursor = conn.execute(
+            "SELECT timestamp, stream, line, id FROM lines WHERE session = ? ORDER BY timestamp, id",
+            (session_id,),
+        )
+        packed = 0
+        while True:
+            rows = cursor.fetchmany(BLOCK_LINES)
+            if not rows:
+                break
+            conn.execute(
+                "INSERT INTO line_blocks "
+                "(session, first_timestamp, last_timestamp, line_count, codec, data, line_ids) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (session_id, rows[0][0], rows[-1][0], len(rows), codec, encode_block(rows, codec),
+                 encode_ids([row[3] for row in rows])),
+            )
+            packed += len(rows)
+        conn.execute("DELETE FROM lines WHERE session = ?", (session_id,))
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    # give the pages the rows took back to the filesystem (they leave
+    # the file at the next checkpoint); sqlite3 steps a statement that
+    # returns no rows only once, executescript() runs it to completion
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        conn.executescript("PRAGMA incremental_vacuum")
+    return packed
+
+
+def pack_closed_sessions(conn, codec=None):
+    """Pack every closed session that still has rows in `lines`.
+
+    Returns (sessions, lines) packed.
+    """
+    session_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM sessions WHERE closed_timestamp IS NOT NULL "
+        "AND EXISTS (SELECT 1 FROM lines WHERE lines.session = sessions.id) "
+        "ORDER BY id"
+    )]
+    lines = 0
+    for session_id in session_ids:
+        lines += pack_session(conn, session_id, codec)
+    return len(session_ids), lines
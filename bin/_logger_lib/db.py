@@ -3,10 +3,17 @@
 
 import sqlite3
 import time
+from collections import Counter
+from operator import itemgetter
 from pathlib import Path
 
+from _logger_lib.coldstore import count_block
+from _logger_lib.search import (
+    create_search_index, has_search_index, index_lines, search_index_enabled,
+)
 
-SCHEMA_VERSION = 1
+
+SCHEMA_VERSION = 5
 
 INIT_SQL = """
 CREATE TABLE IF NOT EXISTS streams (
@@ -48,16 +55,111 @@ CREATE TABLE IF NOT EXISTS db_state (
 );
 """
 
+# WAL lets any number of readers (view --follow, info, ...) run
+# alongside the writers of concurrent sessions, and with WAL
+# synchronous=NORMAL only syncs at checkpoints while staying consistent
+# across crashes.  journal_mode is persistent, the rest are set on
+# every connection.
+BUSY_TIMEOUT_MS = 30000
+CACHE_SIZE_KIB = 16384
+MMAP_SIZE = 256 * 1024 * 1024
+
+CONNECTION_PRAGMAS = (
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA cache_size = -{CACHE_SIZE_KIB}",
+    f"PRAGMA mmap_size = {MMAP_SIZE}",
+    "PRAGMA temp_store = MEMORY",
+)
+
 MIGRATION_SQL = """
 CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY NOT NULL);
 CREATE INDEX IF NOT EXISTS idx_lines_session_timestamp ON lines (session, timestamp);
 CREATE INDEX IF NOT EXISTS idx_lines_stream ON lines (stream);
 CREATE INDEX IF NOT EXISTS idx_sessions_timestamp ON sessions (timestamp);
+
+-- cold storage: the lines of a closed session packed into compressed
+-- blocks, see coldstore.py
+CREATE TABLE IF NOT EXISTS line_blocks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session INTEGER NOT NULL REFERENCES sessions (id),
+    first_timestamp REAL NOT NULL,
+    last_timestamp REAL NOT NULL,
+    line_count INTEGER NOT NULL,
+    codec TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_line_blocks_session ON line_blocks (session, first_timestamp);
+
+-- grep index: the range of line ids each document in line_search
+-- covers, see search.py
+CREATE TABLE IF NOT EXISTS search_chunks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session INTEGER NOT NULL REFERENCES sessions (id),
+    first_line_id INTEGER NOT NULL,
+    last_line_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_search_chunks_session ON search_chunks (session, first_line_id);
 """
 
+# columns added to existing tables after the initial schema; ALTER TABLE
+# has no IF NOT EXISTS so these are only added when missing, and the
+# optional statement fills them in for the rows already there
+MIGRATION_COLUMNS = (
+    # lines the logger could not store in time (overflow policy
+    # drop-oldest) and lines it had to spill to a temporary file
+    ("sessions", "dropped_lines", "INTEGER NOT NULL DEFAULT 0", None),
+    ("sessions", "spilled_lines", "INTEGER NOT NULL DEFAULT 0", None),
+    # set by the logger when it exits; sessions from before this column
+    # existed are taken to be closed, except the latest one, which may
+    # still be written by a logger that predates it (the migration runs
+    # before the migrating logger adds its own session)
+    ("sessions", "closed_timestamp", "REAL",
+     "UPDATE sessions SET closed_timestamp = "
+     "COALESCE((SELECT MAX(timestamp) FROM lines WHERE lines.session = sessions.id), timestamp) "
+     "WHERE id != (SELECT id FROM sessions ORDER BY timestamp DESC, id DESC LIMIT 1)"),
+    # set when every line of the session is in the grep index; sessions
+    # logged before it existed are searched by scanning them
+    ("sessions", "search_indexed", "INTEGER NOT NULL DEFAULT 0", None),
+    ("line_blocks", "line_ids", "BLOB", None),
+    # written when the session is closed, so the viewer never has to go
+    # through a session's lines for its duration or line counts;
+    # sessions closed before these existed get them from `log tidy`
+    ("sessions", "first_line_timestamp", "REAL", None),
+    ("sessions", "last_line_timestamp", "REAL", None),
+    ("sessions", "stdout_lines", "INTEGER", None),
+    ("sessions", "stderr_lines", "INTEGER", None),
+)
+
+
+def connect_db(db_path, **kwargs):
+    # sqlite's busy handler (backing off and retrying internally until
+    # busy_timeout expires) takes care of lock contention between
+    # sessions, so callers never need to sleep and retry themselves
+    conn = sqlite3.connect(str(db_path), timeout=BUSY_TIMEOUT_MS / 1000, **kwargs)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _enable_wal(conn):
+    try:
+        mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+    except sqlite3.OperationalError:
+        # another connection is in the middle of using the rollback
+        # journal, a later connection will switch the database over
+        return False
+    return mode == "wal"
+
 
 def init_db(db_path):
-    conn = sqlite3.connect(str(db_path), timeout=30)
+    conn = connect_db(db_path)
+    # lets `log prune` hand the pages it frees back to the filesystem
+    # a few at a time instead of rebuilding the whole file; this only
+    # takes effect before the first table is created (older databases
+    # are converted by the VACUUM in `log tidy`)
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    _enable_wal(conn)
     conn.executescript(INIT_SQL)
     conn.execute("INSERT OR REPLACE INTO db_state (timestamp) VALUES (?)", (time.time(),))
     conn.commit()
@@ -66,13 +168,23 @@ def init_db(db_path):
 
 def _run_migrations(conn):
     try:
-        row = conn.execute("SELECT version FROM schema_version").fetchone()
-        current = row[0] if row else 0
+        row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+        current = row[0] or 0
     except sqlite3.OperationalError:
         current = 0
 
     if current < SCHEMA_VERSION:
         conn.executescript(MIGRATION_SQL)
+        # hold the write lock while looking for missing columns so that
+        # two loggers migrating at the same time cannot both add one
+        conn.execute("BEGIN IMMEDIATE")
+        for table, column, definition, backfill in MIGRATION_COLUMNS:
+            existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            if column not in existing:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                if backfill:
+                    conn.execute(backfill)
+        create_search_index(conn)
         conn.execute(
             "INSERT OR REPLACE INTO schema_version (version) VALUES (?)",
             (SCHEMA_VERSION,),
@@ -81,12 +193,16 @@ def _run_migrations(conn):
 
 
 def verify_db(db_path):
-    conn = sqlite3.connect(str(db_path), timeout=30, check_same_thread=False)
+    conn = connect_db(db_path, check_same_thread=False)
     try:
         conn.execute("SELECT timestamp FROM db_state")
     except sqlite3.OperationalError:
         conn.close()
         raise RuntimeError(f"SQLite log DB '{db_path}' does not appear to be initialized")
+    # databases created before WAL was the default are converted the
+    # first time they are opened
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+        _enable_wal(conn)
     return conn
 
 
@@ -124,37 +240,130 @@ def setup_session(conn, source, session_id, command):
     return row[0]
 
 
+def session_summary(conn, session_id):
+    """(first line timestamp, last line timestamp, stdout lines, stderr
+    lines) of a session, worked out from its lines and blocks."""
+    stream_ids = get_stream_ids(conn)
+    stdout_id, stderr_id = stream_ids["STDOUT"], stream_ids["STDERR"]
+    first_ts, last_ts, stdout_lines, stderr_lines = conn.execute(
+        "SELECT MIN(timestamp), MAX(timestamp), COALESCE(SUM(stream = ?), 0), COALESCE(SUM(stream = ?), 0) "
+        "FROM lines WHERE session = ?",
+        (stdout_id, stderr_id, session_id),
+    ).fetchone()
+    for block_first_ts, block_last_ts, data, codec in conn.execute(
+        "SELECT first_timestamp, last_timestamp, data, codec FROM line_blocks WHERE session = ?",
+        (session_id,),
+    ):
+        first_ts = block_first_ts if first_ts is None else min(first_ts, block_first_ts)
+        last_ts = block_last_ts if last_ts is None else max(last_ts, block_last_ts)
+        stdout_lines += count_block(data, codec, stdout_id)
+        stderr_lines += count_block(data, codec, stderr_id)
+    return first_ts, last_ts, stdout_lines, stderr_lines
+
+
+def close_session(conn, session_id, dropped=0, spilled=0, summary=None):
+    # the logger passes the summary its LogInserter kept while writing
+    # the lines, anyone else has it worked out from the database
+    if summary is None:
+        summary = session_summary(conn, session_id)
+    conn.execute(
+        "UPDATE sessions SET closed_timestamp = ?, dropped_lines = ?, spilled_lines = ?, "
+        "first_line_timestamp = ?, last_line_timestamp = ?, stdout_lines = ?, stderr_lines = ? "
+        "WHERE id = ?",
+        (time.time(), dropped, spilled, *summary, session_id),
+    )
+    conn.commit()
+
+
+def summarize_closed_sessions(conn):
+    """Fill in the summary of closed sessions that do not have one yet,
+    returning how many there were."""
+    session_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM sessions WHERE closed_timestamp IS NOT NULL AND stdout_lines IS NULL"
+    )]
+    for session_id in session_ids:
+        conn.execute(
+            "UPDATE sessions SET first_line_timestamp = ?, last_line_timestamp = ?, "
+            "stdout_lines = ?, stderr_lines = ? WHERE id = ?",
+            (*session_summary(conn, session_id), session_id),
+        )
+    conn.commit()
+    return len(session_ids)
+
+
+INSERT_LINE_SQL = (
+    "INSERT INTO lines (session, timestamp, stream, line) VALUES (?, ?, ?, ?)"
+)
+
+
+def get_stream_ids(conn):
+    return dict(
+        (stream, stream_id)
+        for stream_id, stream in conn.execute("SELECT id, stream FROM streams")
+    )
+
+
 class LogInserter:
     def __init__(self, conn, session_id):
         self.conn = conn
         self.session_id = session_id
         self.in_transaction = False
+        # the streams table is fixed at init time so resolve the ids
+        # once instead of looking them up for every inserted line
+        self.stream_ids = get_stream_ids(conn)
+        # the session's summary, kept up to date as lines are inserted
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.line_counts = Counter()
+        self.search_index = search_index_enabled() and has_search_index(conn)
+        if self.search_index:
+            conn.execute("UPDATE sessions SET search_indexed = 1 WHERE id = ?", (session_id,))
+            conn.commit()
 
     def begin(self):
         if not self.in_transaction:
-            self.conn.execute("BEGIN")
+            # take the write lock up front so any wait for another
+            # session's writer happens here, inside the busy handler
+            self.conn.execute("BEGIN IMMEDIATE")
             self.in_transaction = True
 
     def insert(self, timestamp, stream_name, message):
+        self.insert_many([(timestamp, self.stream_ids[stream_name], message)])
+
+    def insert_many(self, rows):
+        # rows are (timestamp, stream id, line) tuples; the statement
+        # text never changes so sqlite3 reuses its prepared statement
         self.begin()
-        self.conn.execute(
-            "INSERT INTO lines (session, timestamp, stream, line) "
-            "SELECT ?, ?, id, ? FROM streams WHERE stream = ?",
-            (self.session_id, timestamp, message, stream_name),
+        session = self.session_id
+        self.conn.executemany(
+            INSERT_LINE_SQL,
+            [(session, timestamp, stream, line) for timestamp, stream, line in rows],
+        )
+        if not rows:
+            return
+        first_ts = min(rows, key=itemgetter(0))[0]
+        last_ts = max(rows, key=itemgetter(0))[0]
+        if self.first_timestamp is None or first_ts < self.first_timestamp:
+            self.first_timestamp = first_ts
+        if self.last_timestamp is None or last_ts > self.last_timestamp:
+            self.last_timestamp = last_ts
+        self.line_counts.update(map(itemgetter(1), rows))
+        if self.search_index:
+            index_lines(self.conn, session, [row[2] for row in rows])
+
+    def summary(self):
+        # what close_session() records for the session
+        return (
+            self.first_timestamp,
+            self.last_timestamp,
+            self.line_counts[self.stream_ids["STDOUT"]],
+            self.line_counts[self.stream_ids["STDERR"]],
         )
 
-    def commit(self, max_retries=5, retry_delay=0.5):
+    def commit(self):
         if self.in_transaction:
-            for attempt in range(max_retries):
-                try:
-                    self.conn.commit()
-                    self.in_transaction = False
-                    return
-                except sqlite3.OperationalError:
-                    if attempt < max_retries - 1:
-                        time.sleep(retry_delay * (attempt + 1))
-                    else:
-                        raise
+            self.conn.commit()
+            self.in_transaction = False
 
     def rollback(self):
         if self.in_transaction:
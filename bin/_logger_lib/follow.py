@@ -0,0 +1,132 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import os
+import select
+import socket
+import uuid
+
+
+# Every `log view --follow` binds a Unix datagram socket in a directory
+# next to the database, and every logger sends each of those sockets a
+# one byte datagram after it commits lines.  A follower sleeps in
+# select() until one arrives and then reads only the lines it has not
+# seen yet, so it costs nothing while the log is quiet and the loggers
+# pay one non-blocking sendto() per follower per commit.  The sockets
+# are plain files in a directory both containers mount, so this works
+# between the logger's container and the viewer's.
+FOLLOW_DIR_SUFFIX = ".follow"
+
+# followers still take a look this often on their own, for loggers
+# that cannot reach the directory (or predate it)
+FALLBACK_INTERVAL = 5.0
+
+# how often to look when the follower could not set up its socket
+POLL_INTERVAL = 0.25
+
+
+def follow_dir(db_path):
+    return f"{db_path}{FOLLOW_DIR_SUFFIX}"
+
+
+class FollowNotifier:
+    """The logger's end: wake every follower of a database."""
+
+    def __init__(self, db_path):
+        self.path = follow_dir(db_path)
+        self._sock = None
+        self._mtime = None
+        self._targets = []
+
+    def notify(self):
+        # the directory only changes when a follower comes or goes, so
+        # it is listed again only when its mtime does
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self._mtime = mtime
+            try:
+                self._targets = [os.path.join(self.path, name) for name in os.listdir(self.path)
+                                 if name.endswith(".sock")]
+            except OSError:
+                self._targets = []
+        if not self._targets:
+            return
+
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+        for target in list(self._targets):
+            try:
+                self._sock.sendto(b"\0", target)
+            except BlockingIOError:
+                # its queue is full, so it has a wake-up waiting already
+                pass
+            except (ConnectionRefusedError, FileNotFoundError):
+                # a follower that went away without removing its socket
+                self._targets.remove(target)
+                try:
+                    os.unlink(target)
+                except OSError:
+                    pass
+            except OSError:
+                pass
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+class FollowListener:
+    """A follower's end: wait until a logger has committed new lines.
+
+    Create it before reading what is already there; anything committed
+    after that leaves a datagram behind for the next wait().
+    """
+
+    def __init__(self, db_path):
+        self.path = None
+        self._sock = None
+        if not db_path:
+            # an in-memory database has nobody to wake it up
+            return
+        directory = follow_dir(db_path)
+        path = os.path.join(directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            sock.bind(path)
+        except OSError:
+            # read-only directory, path too long for a socket, ...:
+            # fall back to looking every POLL_INTERVAL
+            sock.close()
+            return
+        sock.setblocking(False)
+        self.path = path
+        self._sock = sock
+
+    def wait(self, timeout=FALLBACK_INTERVAL):
+        """Return once new lines may have been committed (or after
+        `timeout` seconds)."""
+        if self._sock is None:
+            select.select([], [], [], min(timeout, POLL_INTERVAL))
+            return
+        if select.select([self._sock], [], [], timeout)[0]:
+            # one look at the database covers every wake-up so far
+            while True:
+                try:
+                    self._sock.recv(64)
+                except BlockingIOError:
+                    break
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
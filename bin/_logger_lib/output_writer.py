@@ -1,10 +1,105 @@
 # -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
 # vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
 
+import os
 import sys
+import time
+
+
+# Echoed lines are held until the event loop runs out of input or
+# until either of these is reached, whichever comes first, so a flood
+# of output turns into a few large writes while a lone line still
+# shows up right away:
+#   max_delay - seconds the oldest held line may wait
+#   max_bytes - bytes held
+DEFAULT_MAX_DELAY = 0.020
+DEFAULT_MAX_BYTES = 1024 * 1024
+
+LINE_END = b"\r\n"
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
 
 
 def write_line(stream_id, message):
+    # message is the line as read from the pipe, in bytes; one write(2)
+    # per line, see ConsoleWriter for the buffered version
     target = sys.stdout if stream_id == 0 else sys.stderr
-    target.buffer.write((message + "\r\n").encode())
+    target.buffer.write(message + LINE_END)
     target.buffer.flush()
+
+
+def writev_all(fd, buffers):
+    # os.writev() takes at most IOV_MAX buffers and, like write(2), may
+    # write less than it was given
+    if len(buffers) == 1:
+        data = buffers[0]
+        written = os.write(fd, data)
+        while written < len(data):
+            data = data[written:]
+            written = os.write(fd, data)
+        return
+    buffers = list(buffers)
+    while buffers:
+        chunk = buffers[:IOV_MAX]
+        written = os.writev(fd, chunk)
+        total = sum(len(buf) for buf in chunk)
+        if written == total:
+            del buffers[:len(chunk)]
+            continue
+        # drop what was written, including part of the first buffer
+        # that was not written completely
+        while written >= len(buffers[0]):
+            written -= len(buffers.pop(0))
+        buffers[0] = buffers[0][written:]
+
+
+class ConsoleWriter:
+    """Echo lines to stdout/stderr with one vectored write per batch.
+
+    Lines for the same stream are collected until flush() is called,
+    the other stream has something to write (so stdout and stderr stay
+    interleaved in the order they were read), or one of the caps above
+    is reached.
+    """
+
+    def __init__(self, stdout_fd=1, stderr_fd=2,
+                 max_delay=DEFAULT_MAX_DELAY, max_bytes=DEFAULT_MAX_BYTES):
+        self.fds = (stdout_fd, stderr_fd)
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+
+        self._stream_id = None
+        self._buffers = []
+        self._bytes = 0
+        self._oldest = None
+
+    def write(self, stream_id, lines):
+        if stream_id != self._stream_id:
+            self.flush()
+            self._stream_id = stream_id
+
+        # one buffer per call, the join is cheaper than handing writev()
+        # two buffers per line
+        data = LINE_END.join(lines) + LINE_END
+        if self._buffers:
+            self._buffers.append(data)
+            self._bytes += len(data)
+            if self._bytes >= self.max_bytes or time.monotonic() - self._oldest >= self.max_delay:
+                self.flush()
+        else:
+            self._buffers.append(data)
+            self._bytes = len(data)
+            self._oldest = time.monotonic()
+            if self._bytes >= self.max_bytes or self.max_delay <= 0:
+                self.flush()
+
+    def flush(self):
+        if self._buffers:
+            writev_all(self.fds[self._stream_id], self._buffers)
+            self._buffers = []
+            self._bytes = 0
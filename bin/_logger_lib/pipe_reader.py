@@ -2,76 +2,96 @@
 # vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
 
 import os
-import select
-import threading
+import selectors
 import time
 
 
-PIPE_FLUSH_STR = "CRUCIBLE_PIPE_FLUSH"
 CLOSE_PIPE_STR = "CRUCIBLE_CLOSE_LOG_PIPE"
 
+CLOSE_PIPE_BYTES = CLOSE_PIPE_STR.encode()
 
-def pipe_reader(stdout_pipe, stderr_pipe, msg_queue, flush_event, shutdown_event):
-    stdout_fh = open(stdout_pipe, "r")
-    stderr_fh = open(stderr_pipe, "r")
+# as much as a pipe holds by default, so one read usually empties it
+READ_SIZE = 65536
 
-    fd_map = {
-        stdout_fh.fileno(): (stdout_fh, "STDOUT", 0),
-        stderr_fh.fileno(): (stderr_fh, "STDERR", 1),
-    }
-    open_fds = set(fd_map.keys())
 
-    while open_fds:
-        readable, _, _ = select.select(list(open_fds), [], [], 0.1)
+def split_lines(data):
+    """Split a chunk of pipe data into complete lines.
 
-        if not readable:
-            flush_event.set()
-            continue
+    Returns (lines, rest, closed): the lines as bytes without their line
+    endings, the trailing partial line, and whether a close marker was
+    seen, in which case the lines after it are discarded.
+    """
+    lines = data.split(b"\n")
+    rest = lines.pop()
+    if b"\r" in data:
+        lines = [line.rstrip(b"\r") for line in lines]
 
-        for fd in readable:
-            fh, stream, stream_id = fd_map[fd]
-            line = fh.readline()
-
-            if not line:
-                open_fds.discard(fd)
-                fh.close()
+    # the marker is rare, so only look at individual lines when it
+    # shows up somewhere in the chunk
+    closed = False
+    if CLOSE_PIPE_BYTES in data:
+        for i, line in enumerate(lines):
+            if CLOSE_PIPE_BYTES in line:
+                lines = lines[:i]
+                closed = True
+                break
+    return lines, rest, closed
+
+
+def pipe_reader(stdout_pipe, stderr_pipe, handle_lines, on_idle=None):
+    """Read both pipes until each one is closed, calling
+    handle_lines(stream, stream_id, ts, lines) for every chunk of
+    complete lines, and on_idle() whenever all input read so far has
+    been handled and nothing more is ready.
+
+    Everything runs in the calling thread around one selector (epoll
+    on Linux) with non-blocking reads, and it only wakes up when there
+    is something to read: no timeouts, no polling.
+    """
+    selector = selectors.DefaultSelector()
+    partial = {}
+    for pipe_path, stream, stream_id in [
+        (stdout_pipe, "STDOUT", 0),
+        (stderr_pipe, "STDERR", 1),
+    ]:
+        # the open blocks until crucible has opened the pipe for
+        # writing; only the reads are non-blocking, otherwise an early
+        # read would see end of file
+        fd = os.open(pipe_path, os.O_RDONLY)
+        os.set_blocking(fd, False)
+        selector.register(fd, selectors.EVENT_READ, (stream, stream_id))
+        partial[fd] = b""
+
+    while selector.get_map():
+        events = selector.select(0)
+        if not events:
+            if on_idle is not None:
+                on_idle()
+            events = selector.select()
+
+        for key, _ in events:
+            fd = key.fd
+            stream, stream_id = key.data
+            try:
+                data = os.read(fd, READ_SIZE)
+            except BlockingIOError:
                 continue
-
             ts = time.time()
-            line = line.rstrip("\n").rstrip("\r")
 
-            if PIPE_FLUSH_STR in line:
-                continue
-
-            if CLOSE_PIPE_STR in line:
-                open_fds.discard(fd)
-                fh.close()
-                continue
+            if data:
+                lines, partial[fd], closed = split_lines(partial[fd] + data)
+            else:
+                # EOF, anything left over is an unterminated last line
+                lines = split_lines(partial[fd] + b"\n")[0] if partial[fd] else []
+                closed = True
 
-            msg_queue.put((ts, stream, stream_id, line))
+            if lines:
+                handle_lines(stream, stream_id, ts, lines)
 
-    msg_queue.put(None)
-    shutdown_event.set()
-
-
-def flusher(stdout_pipe, stderr_pipe, flush_event, shutdown_event):
-    stdout_flush = f"STDOUT->{PIPE_FLUSH_STR}\n"
-    stderr_flush = f"STDERR->{PIPE_FLUSH_STR}\n"
-
-    while not shutdown_event.is_set():
-        if flush_event.wait(timeout=1.0):
-            flush_event.clear()
-
-            if shutdown_event.is_set():
-                break
+            if closed:
+                selector.unregister(fd)
+                os.close(fd)
 
-            for pipe_path, flush_str in [
-                (stdout_pipe, stdout_flush),
-                (stderr_pipe, stderr_flush),
-            ]:
-                try:
-                    fd = os.open(pipe_path, os.O_WRONLY | os.O_NONBLOCK)
-                    os.write(fd, flush_str.encode())
-                    os.close(fd)
-                except OSError:
-                    pass
+    selector.close()
+    if on_idle is not None:
+        on_idle()
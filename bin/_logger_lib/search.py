@@ -0,0 +1,242 @@
+# -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
+# vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
+
+import os
+import re
+import sqlite3
+
+from _logger_lib.coldstore import decode_block, decode_ids
+
+
+# `log view --grep` is answered from an FTS5 trigram index when the
+# pattern contains literal text every match has to include.  The index
+# does not hold one document per line: every batch the logger commits
+# becomes one document (a row in search_chunks, mapping it to the range
+# of line ids it covers), which keeps indexing at ingest to a fraction
+# of the cost of the insert itself.  A chunk keeps its line ids when the
+# session is packed into cold storage, so packing never touches the
+# index.  The index only narrows the search down to candidate chunks,
+# the regular expression still decides which lines match.
+SEARCH_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS line_search USING fts5(
+    text, content='', tokenize='trigram case_sensitive 1'
+);
+"""
+
+# trigrams: anything shorter cannot be looked up in the index
+MIN_TERM_LENGTH = 3
+
+# escapes that stand for one literal character; any other escaped
+# letter or digit is a class, an anchor or a back reference
+_ESCAPES = {"a": "\a", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+
+def search_index_enabled():
+    # off unless asked for: the index is about as big as the text it
+    # covers, several times the size of the packed blocks
+    return os.environ.get("CRUCIBLE_LOG_SEARCH_INDEX", "0") != "0"
+
+
+def create_search_index(conn):
+    # FTS5 is part of every SQLite Python normally ships with, but it is
+    # a compile time option; without it grep keeps scanning
+    try:
+        conn.execute(SEARCH_SQL)
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def has_search_index(conn):
+    try:
+        conn.execute("SELECT rowid FROM line_search LIMIT 0")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def index_lines(conn, session_id, lines):
+    """Index the lines just inserted for a session as one chunk.
+
+    Must run in the transaction that inserted them: while it holds the
+    write lock nobody else can insert lines, so they have consecutive
+    ids ending at last_insert_rowid().
+    """
+    last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    cursor = conn.execute(
+        "INSERT INTO search_chunks (session, first_line_id, last_line_id) VALUES (?, ?, ?)",
+        (session_id, last_id - len(lines) + 1, last_id),
+    )
+    conn.execute(
+        "INSERT INTO line_search (rowid, text) VALUES (?, ?)",
+        (cursor.lastrowid, "\n".join(line or "" for line in lines)),
+    )
+
+
+def unindex_session(conn, session_id):
+    """Remove a session's chunks from the index.
+
+    The index does not keep the text it was given, and removing a
+    document means handing it the same text again, so each chunk is
+    rebuilt from the session's lines and blocks; call this before
+    deleting them.
+
+    FTS5 records a removal by adding to the index, so this makes it
+    bigger until optimize_search_index() merges it.  Returns the number
+    of lines removed.
+    """
+    chunks = conn.execute(
+        "SELECT id, first_line_id, last_line_id FROM search_chunks WHERE session = ?",
+        (session_id,),
+    ).fetchall()
+    if not chunks:
+        return 0
+
+    lines = dict(conn.execute("SELECT id, line FROM lines WHERE session = ?", (session_id,)))
+    for data, codec, line_ids in conn.execute(
+        "SELECT data, codec, line_ids FROM line_blocks WHERE session = ?", (session_id,)
+    ):
+        if line_ids is not None:
+            lines.update(zip(decode_ids(line_ids), (row[2] for row in decode_block(data, codec))))
+
+    conn.executemany(
+        "INSERT INTO line_search (line_search, rowid, text) VALUES ('delete', ?, ?)",
+        [
+            (chunk_id, "\n".join(lines.get(line_id) or "" for line_id in range(first_id, last_id + 1)))
+            for chunk_id, first_id, last_id in chunks
+        ],
+    )
+    conn.execute("DELETE FROM search_chunks WHERE session = ?", (session_id,))
+    if conn.execute("SELECT 1 FROM search_chunks LIMIT 1").fetchone() is None:
+        # nothing left to find, start over from an empty index
+        conn.execute("INSERT INTO line_search (line_search) VALUES ('delete-all')")
+    return sum(last_id - first_id + 1 for _, first_id, last_id in chunks)
+
+
+def search_index_size(conn):
+    """Return the bytes the index takes and the number of lines it
+    covers; a session's share of the former is about its share of the
+    latter."""
+    if not has_search_index(conn):
+        return 0, 0
+    size = conn.execute("SELECT COALESCE(SUM(LENGTH(block)), 0) FROM line_search_data").fetchone()[0]
+    lines = conn.execute(
+        "SELECT COALESCE(SUM(last_line_id - first_line_id + 1), 0) FROM search_chunks"
+    ).fetchone()[0]
+    return size, lines
+
+
+def clear_search_index(conn):
+    if has_search_index(conn):
+        conn.execute("INSERT INTO line_search (line_search) VALUES ('delete-all')")
+    conn.execute("DELETE FROM search_chunks")
+
+
+def optimize_search_index(conn):
+    # merge the index's many small segments (one or more per commit)
+    if has_search_index(conn):
+        conn.execute("INSERT INTO line_search (line_search) VALUES ('optimize')")
+        conn.commit()
+
+
+def _skip_set(pattern, i):
+    # index just past the "]" closing the set that starts at i; a "]"
+    # right after "[" or "[^" is part of the set
+    i += 1
+    if pattern[i:i + 1] == "^":
+        i += 1
+    if pattern[i:i + 1] == "]":
+        i += 1
+    while i < len(pattern):
+        if pattern[i] == "\\":
+            i += 2
+            continue
+        if pattern[i] == "]":
+            return i + 1
+        i += 1
+    return len(pattern)
+
+
+def _skip_group(pattern, i):
+    # index just past the ")" closing the group that starts at i
+    depth = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            i += 2
+            continue
+        if char == "[":
+            i = _skip_set(pattern, i)
+            continue
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return len(pattern)
+
+
+def search_terms(pattern):
+    """Literal substrings every match of `pattern` must contain.
+
+    Errs on the side of returning fewer or shorter substrings: anything
+    inside a group or a set, anything a quantifier makes optional and
+    anything after an escape it does not know counts as unknown text.
+    Returns None when nothing long enough to look up is left, or when an
+    alternation or a flag makes the literals unreliable.
+    """
+    flags = re.compile(pattern).flags
+    if flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+
+    runs = []
+    run = ""
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "|":
+            return None
+        if char == "\\":
+            escaped = pattern[i + 1:i + 2]
+            i += 2
+            if escaped in _ESCAPES:
+                run += _ESCAPES[escaped]
+                continue
+            if escaped and not escaped.isalnum():
+                run += escaped
+                continue
+            if escaped in ("x", "u", "U", "N") or escaped.isdigit():
+                # character codes and back references take arguments
+                return None
+        elif char == "[":
+            i = _skip_set(pattern, i)
+        elif char == "(":
+            i = _skip_group(pattern, i)
+        elif char in "*?{":
+            # the preceding character is optional (or repeated a
+            # number of times that may be zero)
+            run = run[:-1]
+            end = pattern.find("}", i) if char == "{" else i
+            i = end + 1 if end >= 0 else len(pattern)
+        elif char not in ".^$+)":
+            run += char
+            i += 1
+            continue
+        else:
+            i += 1
+        runs.append(run)
+        run = ""
+    runs.append(run)
+
+    terms = [run for run in runs if len(run) >= MIN_TERM_LENGTH]
+    return terms or None
+
+
+def match_expression(pattern):
+    """The FTS5 query for a grep pattern, or None to scan instead."""
+    terms = search_terms(pattern)
+    if terms is None:
+        return None
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
@@ -1,24 +1,61 @@
 # -*- mode: python; indent-tabs-mode: nil; python-indent-level: 4 -*-
 # vim: autoindent tabstop=4 shiftwidth=4 expandtab softtabstop=4 filetype=python
 
+import heapq
 import json
+import os
 import re
 import sqlite3
-import time
+import sys
+from bisect import bisect_right
 from datetime import datetime
+from functools import lru_cache
+from itertools import groupby, islice
+from operator import itemgetter
+
+from _logger_lib.coldstore import (
+    cold_storage_enabled, count_block, decode_block, decode_ids, pack_closed_sessions,
+)
+from _logger_lib.db import get_stream_ids, summarize_closed_sessions
+from _logger_lib.follow import FALLBACK_INTERVAL, FollowListener
+from _logger_lib.search import (
+    clear_search_index, has_search_index, match_expression, optimize_search_index,
+    search_index_size, unindex_session,
+)
+
+
+# rows are read from `lines` this many at a time, and written out
+# as many at a time
+FETCH_ROWS = 4096
+
+
+@lru_cache(maxsize=1024)
+def _format_second(second):
+    # consecutive lines mostly share their second, so strftime() runs
+    # about once per second of log rather than once per line
+    return datetime.fromtimestamp(second).strftime("%Y-%m-%d %H:%M:%S")
 
 
 def format_ts(epoch):
-    dt = datetime.fromtimestamp(epoch)
-    ms = int((epoch - int(epoch)) * 1000)
-    return dt.strftime("%Y-%m-%d %H:%M:%S") + f".{ms:03d}"
+    second = int(epoch)
+    ms = int((epoch - second) * 1000)
+    return f"{_format_second(second)}.{ms:03d}"
 
 
-def view_sessions(conn, filter_cmd=None, filter_arg=None,
-                  stream_filter=None, grep_pattern=None,
-                  since=None, until=None, output_format="plain",
-                  use_color=False, count_only=False, tail=None,
-                  head=None, follow=False, raw=False):
+SESSION_QUERY = (
+    "SELECT sessions.id, sessions.session_id, sessions.timestamp, "
+    "commands.command, sources.source, sessions.search_indexed, "
+    "sessions.first_line_timestamp, sessions.last_line_timestamp, "
+    "sessions.stdout_lines, sessions.stderr_lines "
+    "FROM sessions "
+    "JOIN sources ON sources.id = sessions.source "
+    "JOIN commands ON commands.id = sessions.command "
+    "{where} "
+    "ORDER BY sessions.timestamp, sessions.id"
+)
+
+
+def _session_conditions(filter_cmd=None, filter_arg=None):
     conditions = []
     params = []
 
@@ -35,68 +72,311 @@ def view_sessions(conn, filter_cmd=None, filter_arg=None,
     elif filter_cmd == "sessionid" and filter_arg:
         conditions.append("sessions.session_id = ?")
         params.append(filter_arg)
+    return conditions, params
 
-    if stream_filter:
-        conditions.append("streams.stream = ?")
-        params.append(stream_filter.upper())
 
+def _select_sessions(conn, filter_cmd=None, filter_arg=None):
+    conditions, params = _session_conditions(filter_cmd, filter_arg)
+    where = ""
+    if conditions:
+        where = "WHERE " + " AND ".join(conditions)
+    return conn.execute(SESSION_QUERY.format(where=where), params).fetchall()
+
+
+def _session_chunks(conn, session, stream=None, since=None, until=None, match=None,
+                    reverse=False):
+    """Yield lists of (timestamp, stream id, line) for one session in
+    timestamp order, from its cold storage blocks and then from `lines`,
+    or the other way round with `reverse`: a block at a time, and
+    FETCH_ROWS rows at a time from `lines`.  Rows are read as they are
+    consumed, so stopping early also stops the reading.
+
+    With a `match` expression for the grep index, only the lines of the
+    chunks it finds are yielded; the session has to be indexed.
+    """
+    order = " DESC" if reverse else ""
+    block_conditions = ["session = ?"]
+    line_conditions = ["lines.session = ?"]
+    params = [session]
     if since:
-        conditions.append("lines.timestamp >= ?")
+        block_conditions.append("last_timestamp >= ?")
+        line_conditions.append("lines.timestamp >= ?")
         params.append(since)
-
     if until:
-        conditions.append("lines.timestamp <= ?")
+        block_conditions.append("first_timestamp <= ?")
+        line_conditions.append("lines.timestamp <= ?")
         params.append(until)
 
-    where = ""
-    if conditions:
-        where = "WHERE " + " AND ".join(conditions)
+    chunks = None
+    if match is not None:
+        chunks = _matching_chunks(conn, session, match)
+        if chunks is None:
+            # the index cannot rule anything out, scanning is cheaper
+            match = None
+        elif not chunks:
+            return
 
-    query = (
-        "SELECT "
-        "sessions.session_id AS session_id, "
-        "sessions.timestamp AS session_timestamp, "
-        "commands.command AS session_command, "
-        "sources.source AS session_source, "
-        "lines.timestamp AS line_timestamp, "
-        "lines.line AS line, "
-        "streams.stream AS line_stream "
-        "FROM sessions "
-        "JOIN lines ON sessions.id = lines.session "
-        "JOIN streams ON streams.id = lines.stream "
-        "JOIN sources ON sources.id = sessions.source "
-        "JOIN commands ON commands.id = sessions.command "
-        f"{where} "
-        "ORDER BY sessions.timestamp, lines.timestamp"
-    )
+    if match is None:
+        blocks = conn.execute(
+            "SELECT data, codec, NULL FROM line_blocks WHERE " + " AND ".join(block_conditions)
+            + f" ORDER BY first_timestamp{order}, id{order}",
+            params,
+        )
+    else:
+        blocks = _matching_blocks(conn, chunks, block_conditions, params, order)
+
+    def _block_rows():
+        for data, codec, wanted in blocks:
+            rows = decode_block(data, codec)
+            if wanted is not None:
+                # only the lines from matching chunks
+                rows = [row for row, keep in zip(rows, wanted) if keep]
+            if reverse:
+                rows.reverse()
+            if stream or since or until:
+                rows = [row for row in rows
+                        if (not stream or row[1] == stream)
+                        and (not since or row[0] >= since)
+                        and (not until or row[0] <= until)]
+            if rows:
+                yield rows
+
+    if stream:
+        line_conditions.append("lines.stream = ?")
+        params = params + [stream]
+    if match is None:
+        line_rows = conn.execute(
+            "SELECT timestamp, stream, line FROM lines WHERE " + " AND ".join(line_conditions)
+            + f" ORDER BY timestamp{order}, id{order}",
+            params,
+        )
+    else:
+        # CROSS JOIN keeps sqlite from scanning the session's lines
+        # instead of starting from the (few) chunks the index finds
+        line_rows = conn.execute(
+            "SELECT lines.timestamp, lines.stream, lines.line FROM line_search "
+            "CROSS JOIN search_chunks ON search_chunks.id = line_search.rowid "
+            "CROSS JOIN lines ON lines.id BETWEEN search_chunks.first_line_id AND search_chunks.last_line_id "
+            "WHERE line_search MATCH ? AND search_chunks.session = ? AND " + " AND ".join(line_conditions)
+            + f" ORDER BY lines.timestamp{order}, lines.id{order}",
+            [match, session] + params,
+        )
 
-    cursor = conn.execute(query, params)
+    def _line_rows():
+        while True:
+            rows = line_rows.fetchmany(FETCH_ROWS)
+            if not rows:
+                return
+            yield rows
+
+    if reverse:
+        yield from _line_rows()
+        yield from _block_rows()
+    else:
+        yield from _block_rows()
+        yield from _line_rows()
+
+
+def _session_lines(conn, session, stream=None, since=None, until=None, match=None,
+                   reverse=False):
+    """The rows of _session_chunks() one at a time."""
+    for rows in _session_chunks(conn, session, stream, since, until, match, reverse):
+        yield from rows
+
+
+def _session_count(conn, session, stream=None, since=None, until=None):
+    # the number of lines _session_lines() would yield, counted by
+    # sqlite and from the block headers; only blocks cut by `since` or
+    # `until`, or that mix streams when one is asked for, are unpacked
+    line_conditions = ["session = ?"]
+    line_params = [session]
+    block_conditions = ["session = ?"]
+    block_params = [session]
+    if stream:
+        line_conditions.append("stream = ?")
+        line_params.append(stream)
+    if since:
+        line_conditions.append("timestamp >= ?")
+        line_params.append(since)
+        block_conditions.append("last_timestamp >= ?")
+        block_params.append(since)
+    if until:
+        line_conditions.append("timestamp <= ?")
+        line_params.append(until)
+        block_conditions.append("first_timestamp <= ?")
+        block_params.append(until)
+
+    count = conn.execute(
+        "SELECT COUNT(*) FROM lines WHERE " + " AND ".join(line_conditions), line_params
+    ).fetchone()[0]
+
+    for block_id, first_ts, last_ts, line_count in conn.execute(
+        "SELECT id, first_timestamp, last_timestamp, line_count FROM line_blocks WHERE "
+        + " AND ".join(block_conditions),
+        block_params,
+    ).fetchall():
+        if not stream and (not since or first_ts >= since) and (not until or last_ts <= until):
+            count += line_count
+            continue
+        data, codec = conn.execute(
+            "SELECT data, codec FROM line_blocks WHERE id = ?", (block_id,)
+        ).fetchone()
+        count += count_block(data, codec, stream, since, until)
+    return count
+
+
+def _matching_chunks(conn, session, match):
+    # (first line id, last line id) of the session's chunks matching
+    # `match`, in order, or None if that is all of them
+    chunks = conn.execute(
+        "SELECT search_chunks.first_line_id, search_chunks.last_line_id FROM line_search "
+        "CROSS JOIN search_chunks ON search_chunks.id = line_search.rowid "
+        "WHERE line_search MATCH ? AND search_chunks.session = ? "
+        "ORDER BY search_chunks.first_line_id",
+        (match, session),
+    ).fetchall()
+    total = conn.execute("SELECT COUNT(*) FROM search_chunks WHERE session = ?", (session,)).fetchone()[0]
+    return None if len(chunks) == total else chunks
 
-    if count_only:
-        count = 0
-        for row in cursor:
-            line = row[5]
-            if grep_pattern and not re.search(grep_pattern, line or ""):
-                continue
-            count += 1
-        print(count)
-        return
 
-    # Pre-fetch session durations
-    session_durations = {}
-    for sid, dur in conn.execute(
-        "SELECT sessions.session_id, MAX(lines.timestamp) - MIN(lines.timestamp) "
-        "FROM sessions JOIN lines ON sessions.id = lines.session "
-        "GROUP BY sessions.id"
+def _matching_blocks(conn, chunks, block_conditions, params, order=""):
+    # yields (data, codec, wanted) for the blocks holding lines from
+    # `chunks`, wanted flagging those lines; blocks with none of them
+    # are not even read
+    starts = [chunk[0] for chunk in chunks]
+
+    def _wanted(line_id):
+        i = bisect_right(starts, line_id) - 1
+        return i >= 0 and line_id <= chunks[i][1]
+
+    for block_id, line_ids in conn.execute(
+        "SELECT id, line_ids FROM line_blocks WHERE " + " AND ".join(block_conditions)
+        + f" ORDER BY first_timestamp{order}, id{order}",
+        params,
     ).fetchall():
-        session_durations[sid] = dur
+        line_ids = decode_ids(line_ids)
+        i = bisect_right(starts, max(line_ids)) - 1
+        if i < 0 or chunks[i][1] < min(line_ids):
+            continue
+        wanted = [_wanted(line_id) for line_id in line_ids]
+        if any(wanted):
+            data, codec = conn.execute(
+                "SELECT data, codec FROM line_blocks WHERE id = ?", (block_id,)
+            ).fetchone()
+            yield data, codec, wanted
+
+
+def _session_duration(conn, session):
+    # `session` is a SESSION_QUERY row; closed sessions have their first
+    # and last line timestamps in it
+    first_ts, last_ts, stdout_lines = session[6:9]
+    if stdout_lines is None:
+        # still running (or closed before sessions had a summary); each
+        # MIN() and MAX() on its own is a single index lookup
+        first_ts, last_ts = conn.execute(
+            "SELECT MIN(first_ts), MAX(last_ts) FROM ("
+            "SELECT (SELECT MIN(timestamp) FROM lines WHERE session = ?) AS first_ts, "
+            "(SELECT MAX(timestamp) FROM lines WHERE session = ?) AS last_ts "
+            "UNION ALL "
+            "SELECT (SELECT MIN(first_timestamp) FROM line_blocks WHERE session = ?), "
+            "(SELECT MAX(last_timestamp) FROM line_blocks WHERE session = ?))",
+            (session[0],) * 4,
+        ).fetchone()
+    if first_ts is None:
+        return None
+    return last_ts - first_ts
+
+
+def view_sessions(conn, filter_cmd=None, filter_arg=None,
+                  stream_filter=None, grep_pattern=None,
+                  since=None, until=None, output_format="plain",
+                  use_color=False, count_only=False, tail=None,
+                  head=None, follow=False, raw=False, db_path=None):
+    stream_ids = get_stream_ids(conn)
+    stream_names = dict((stream_id, stream) for stream, stream_id in stream_ids.items())
+    stream_id = stream_ids.get(stream_filter.upper(), -1) if stream_filter else None
+    grep = re.compile(grep_pattern) if grep_pattern else None
+    # the grep index narrows down the lines to check, the regular
+    # expression still has the final say
+    match = match_expression(grep_pattern) if grep and has_search_index(conn) else None
+
+    sessions = _select_sessions(conn, filter_cmd, filter_arg)
+
+    def _session_rows(session, reverse=False):
+        rows = _session_lines(conn, session[0], stream_id, since, until,
+                              match if session[5] else None, reverse)
+        if grep:
+            rows = (row for row in rows if grep.search(row[2] or ""))
+        return rows
+
+    def _chunks():
+        # (session row, rows) for the lines that pass the filters, a
+        # chunk of rows at a time and never an empty one; --head and
+        # --tail stop reading a session once they have their lines,
+        # --tail by reading it backwards
+        for session in sessions:
+            if head:
+                rows = list(islice(_session_rows(session), head))
+                if tail:
+                    rows = rows[-tail:]
+            elif tail:
+                rows = list(islice(_session_rows(session, reverse=True), tail))
+                rows.reverse()
+            else:
+                for rows in _session_chunks(conn, session[0], stream_id, since, until,
+                                            match if session[5] else None):
+                    if grep:
+                        rows = [row for row in rows if grep.search(row[2] or "")]
+                    if rows:
+                        yield session, rows
+                continue
+            if rows:
+                yield session, rows
+
+    def _count(session):
+        first_ts, last_ts, stdout_lines, stderr_lines = session[6:10]
+        if grep:
+            return sum(1 for _ in _session_rows(session))
+        if stdout_lines is not None and (
+            first_ts is None
+            or ((not since or since <= first_ts) and (not until or until >= last_ts))
+        ):
+            # the whole session is in range, its summary has the answer
+            if stream_id is None:
+                return stdout_lines + stderr_lines
+            return {stream_ids["STDOUT"]: stdout_lines, stream_ids["STDERR"]: stderr_lines}.get(stream_id, 0)
+        return _session_count(conn, session[0], stream_id, since, until)
+
+    if count_only:
+        print(sum(_count(session) for session in sessions))
+        return
 
-    last_session_ts = -1
+    last_session = None
     sep = "=" * 94
+    # everything goes out through one writer, a chunk of lines per write
+    write = sys.stdout.write
+    # only the line text differs from one JSON row to the next: the rest
+    # is encoded once per stream and once per session
+    encode = json.JSONEncoder().encode
+    json_streams = dict(
+        (line_stream, f', "stream": {encode(name)}, "line": ')
+        for line_stream, name in stream_names.items()
+    )
 
-    def _format_line(line_ts_fmt, line_stream, line):
+    def _json_lines(session_id, rows):
+        # what json.dumps() makes of {"session_id", "timestamp",
+        # "stream", "line"}, one object per line
+        prefix = f'{{"session_id": {encode(session_id)}, "timestamp": '
+        return [f"{prefix}{line_ts!r}{json_streams[line_stream]}{encode(line or '')}}}"
+                for line_ts, line_stream, line in rows]
+
+    def _plain_lines(rows):
         if raw:
-            return line
+            return [line or "" for _, _, line in rows]
+        return [_format_line(format_ts(line_ts), stream_names[line_stream], line or "")
+                for line_ts, line_stream, line in rows]
+
+    def _format_line(line_ts_fmt, line_stream, line):
         if use_color and line_stream == "STDERR":
             return f"\033[2m[{line_ts_fmt}]\033[0m[\033[31m{line_stream}\033[0m] \033[31m{line}\033[0m"
         elif use_color:
@@ -104,168 +384,191 @@ def view_sessions(conn, filter_cmd=None, filter_arg=None,
         else:
             return f"[{line_ts_fmt}][{line_stream}] {line}"
 
-    def _print_session_header(session_ts_fmt, session_id, session_cmd, session_src, dur_str):
+    def _session_header(session_ts_fmt, session_id, session_cmd, session_src, dur_str):
         session_id = _strip_quotes(session_id)
         session_cmd = _strip_quotes(session_cmd)
         if use_color:
-            print(f"\033[1;36m{sep}\033[0m")
-            print(f"\033[1msession id:  {session_id}\033[0m")
+            lines = [f"\033[1;36m{sep}\033[0m", f"\033[1msession id:  {session_id}\033[0m"]
         else:
-            print(sep)
-            print(f"session id:  {session_id}")
-        print(f"command:     {session_cmd}")
-        print(f"timestamp:   {session_ts_fmt}")
-        print(f"duration:    {dur_str}")
-        print(f"source:      {session_src}")
-        print()
-
-    pending_header = None
-    pending_lines = []
-
-    def _flush_pending():
-        nonlocal pending_header, pending_lines
-        if pending_header is None:
-            return
-        _print_session_header(*pending_header)
-        lines_to_print = pending_lines[-tail:] if tail else pending_lines
-        for l in lines_to_print:
-            print(l)
-        pending_header = None
-        pending_lines = []
-
-    last_line_id = 0
-    session_line_count = 0
-
-    for row in cursor:
-        session_id = row[0]
-        session_ts = row[1]
-        session_cmd = row[2]
-        session_src = row[3]
-        line_ts = row[4]
-        line = row[5] or ""
-        line_stream = row[6]
-
-        if grep_pattern and not re.search(grep_pattern, line):
-            continue
+            lines = [sep, f"session id:  {session_id}"]
+        lines += [
+            f"command:     {session_cmd}",
+            f"timestamp:   {session_ts_fmt}",
+            f"duration:    {dur_str}",
+            f"source:      {session_src}",
+            "",
+        ]
+        return lines
+
+    for session, rows in _chunks():
+        session_db_id, session_id, session_ts, session_cmd, session_src = session[:5]
 
         if output_format == "json":
-            print(json.dumps({
-                "session_id": session_id,
-                "timestamp": line_ts,
-                "stream": line_stream,
-                "line": line,
-            }))
+            write("\n".join(_json_lines(session_id, rows)) + "\n")
             continue
 
-        session_ts_fmt = format_ts(session_ts)
-        line_ts_fmt = format_ts(line_ts)
-
-        if session_ts != last_session_ts:
-            _flush_pending()
-            session_line_count = 0
-            dur = session_durations.get(session_id)
+        lines = _plain_lines(rows)
+        if session_db_id != last_session:
+            dur = _session_duration(conn, session)
             dur_str = _format_duration(dur) if dur is not None else "n/a"
-            pending_header = (session_ts_fmt, session_id, session_cmd, session_src, dur_str)
-            last_session_ts = session_ts
-
-        session_line_count += 1
-        if head and session_line_count > head:
-            continue
-
-        formatted = _format_line(line_ts_fmt, line_stream, line)
-        if tail:
-            pending_lines.append(formatted)
-        else:
-            if pending_header:
-                _print_session_header(*pending_header)
-                pending_header = None
-            print(formatted)
-
-    _flush_pending()
+            lines[:0] = _session_header(format_ts(session_ts), session_id, session_cmd, session_src, dur_str)
+            last_session = session_db_id
+        write("\n".join(lines) + "\n")
 
     if not follow:
         return
 
-    import sys
-    # Flush stdout after every print in follow mode since the container
-    # may not have a TTY and Python defaults to full buffering
-    sys.stdout.reconfigure(line_buffering=True)
-
-    # Enable WAL mode for concurrent read/write access and switch to
-    # autocommit so each poll sees the latest committed data
-    conn.execute("PRAGMA journal_mode=WAL")
+    # Switch to autocommit so each poll sees the latest committed data
+    # (the database is already in WAL mode, see verify_db())
     conn.isolation_level = None
 
-    # Get the highest line ID for the follow query starting point
-    row = conn.execute("SELECT MAX(id) FROM lines").fetchone()
+    # Listen before reading the highest line id, so a commit landing in
+    # between is not slept through
+    if db_path is None:
+        db_path = conn.execute("PRAGMA database_list").fetchone()[2]
+    listener = FollowListener(db_path)
+
+    # Get the highest line and block IDs for the follow query starting
+    # point, both from the same snapshot
+    row = conn.execute(
+        "SELECT (SELECT MAX(id) FROM lines), (SELECT MAX(id) FROM line_blocks)"
+    ).fetchone()
     last_line_id = row[0] if row[0] else 0
-
-    # Build the follow query with the same filters
-    follow_conditions = list(conditions)
+    last_block_id = row[1] if row[1] else 0
+
+    # Build the follow query with the same filters; new lines land in
+    # `lines`, but a session is packed into `line_blocks` as soon as it
+    # is closed, which can be before its last lines were read here
+    follow_conditions, params = _session_conditions(filter_cmd, filter_arg)
+    block_conditions = follow_conditions + ["line_blocks.id > ?", "line_blocks.line_ids IS NOT NULL"]
+    block_params = list(params)
+    if since:
+        block_conditions.append("line_blocks.last_timestamp >= ?")
+        block_params.append(since)
+    if until:
+        block_conditions.append("line_blocks.first_timestamp <= ?")
+        block_params.append(until)
+    if stream_filter:
+        follow_conditions.append("lines.stream = ?")
+        params.append(stream_id)
+    if since:
+        follow_conditions.append("lines.timestamp >= ?")
+        params.append(since)
+    if until:
+        follow_conditions.append("lines.timestamp <= ?")
+        params.append(until)
     follow_conditions.append("lines.id > ?")
     follow_where = "WHERE " + " AND ".join(follow_conditions)
 
+    # CROSS JOIN keeps `lines` the outer loop, so every wake-up reads
+    # only the new rows off the end of the rowid range; left to itself
+    # the planner starts from the session and walks all of its lines.
+    # Session details are looked up once per session, not per line.
     follow_query = (
-        "SELECT "
-        "sessions.session_id, sessions.timestamp, commands.command, "
-        "sources.source, lines.timestamp, lines.line, streams.stream, lines.id "
-        "FROM sessions "
-        "JOIN lines ON sessions.id = lines.session "
-        "JOIN streams ON streams.id = lines.stream "
-        "JOIN sources ON sources.id = sessions.source "
-        "JOIN commands ON commands.id = sessions.command "
+        "SELECT lines.id, lines.session, lines.timestamp, lines.stream, lines.line "
+        "FROM lines CROSS JOIN sessions ON sessions.id = lines.session "
         f"{follow_where} "
         "ORDER BY lines.id"
     )
+    block_query = (
+        "SELECT line_blocks.id, line_blocks.session, line_blocks.codec, line_blocks.data, line_blocks.line_ids "
+        "FROM line_blocks CROSS JOIN sessions ON sessions.id = line_blocks.session "
+        f"WHERE {' AND '.join(block_conditions)} "
+        "ORDER BY line_blocks.id"
+    )
+    follow_sessions = {}
+
+    def _packed_rows():
+        # the rows of the sessions packed since the last look that were
+        # not read from `lines` yet, as the follow query would return them
+        nonlocal last_block_id
+        packed = []
+        for block_id, session_db_id, codec, data, line_ids in conn.execute(
+            block_query, block_params + [last_block_id]
+        ):
+            last_block_id = block_id
+            line_ids = decode_ids(line_ids)
+            if max(line_ids) <= last_line_id:
+                continue
+            for line_db_id, (line_ts, line_stream, line) in zip(line_ids, decode_block(data, codec)):
+                if (line_db_id > last_line_id
+                        and (stream_id is None or line_stream == stream_id)
+                        and (not since or line_ts >= since)
+                        and (not until or line_ts <= until)):
+                    packed.append((line_db_id, session_db_id, line_ts, line_stream, line))
+        packed.sort()
+        return packed
 
     last_follow_session_id = None
 
     try:
         while True:
-            follow_params = list(params) + [last_line_id]
-            new_rows = conn.execute(follow_query, follow_params).fetchall()
-
-            for row in new_rows:
-                session_id = row[0]
-                session_ts = row[1]
-                session_cmd = row[2]
-                session_src = row[3]
-                line_ts = row[4]
-                line = row[5] or ""
-                line_stream = row[6]
-                line_id = row[7]
-
-                last_line_id = line_id
-
-                if grep_pattern and not re.search(grep_pattern, line):
-                    continue
-
-                if output_format == "json":
-                    print(json.dumps({
-                        "session_id": session_id,
-                        "timestamp": line_ts,
-                        "stream": line_stream,
-                        "line": line,
-                    }))
-                else:
-                    session_ts_fmt = format_ts(session_ts)
-                    line_ts_fmt = format_ts(line_ts)
-
-                    if session_id != last_follow_session_id:
-                        dur_str = "active"
-                        _print_session_header(session_ts_fmt, session_id, session_cmd, session_src, dur_str)
-                        last_follow_session_id = session_id
-
-                    print(_format_line(line_ts_fmt, line_stream, line))
-
-            time.sleep(0.25)
+            # one read transaction per look: packing a session is one
+            # write transaction, so its lines are seen either in `lines`
+            # or in `line_blocks`
+            conn.execute("BEGIN")
+            try:
+                merged = heapq.merge(conn.execute(follow_query, list(params) + [last_line_id]),
+                                     _packed_rows(), key=itemgetter(0))
+                lines = []
+                while True:
+                    new_rows = list(islice(merged, FETCH_ROWS))
+                    if not new_rows:
+                        break
+                    last_line_id = new_rows[-1][0]
+
+                    for session_db_id, rows in groupby(new_rows, itemgetter(1)):
+                        rows = [row[2:] for row in rows]
+                        if grep:
+                            rows = [row for row in rows if grep.search(row[2] or "")]
+                        if not rows:
+                            continue
+
+                        session = follow_sessions.get(session_db_id)
+                        if session is None:
+                            session = follow_sessions[session_db_id] = conn.execute(
+                                "SELECT sessions.session_id, sessions.timestamp, commands.command, sources.source "
+                                "FROM sessions "
+                                "JOIN sources ON sources.id = sessions.source "
+                                "JOIN commands ON commands.id = sessions.command "
+                                "WHERE sessions.id = ?",
+                                (session_db_id,),
+                            ).fetchone()
+                        session_id, session_ts, session_cmd, session_src = session
+
+                        if output_format == "json":
+                            lines += _json_lines(session_id, rows)
+                            continue
+                        if session_id != last_follow_session_id:
+                            lines += _session_header(format_ts(session_ts), session_id, session_cmd,
+                                                     session_src, "active")
+                            last_follow_session_id = session_id
+                        lines += _plain_lines(rows)
+            finally:
+                conn.execute("COMMIT")
+
+            if lines:
+                # the container may not have a TTY, in which case
+                # stdout is fully buffered
+                write("\n".join(lines) + "\n")
+                sys.stdout.flush()
+
+            # sleep until a logger commits something (see follow.py)
+            listener.wait(FALLBACK_INTERVAL)
     except KeyboardInterrupt:
         print()
+    finally:
+        listener.close()
 
 
 def show_info(conn, db_path=None, output_format="plain"):
     session_count = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
     line_count = conn.execute("SELECT COUNT(*) FROM lines").fetchone()[0]
+    packed_sessions, packed_lines, packed_bytes = conn.execute(
+        "SELECT COUNT(DISTINCT session), COALESCE(SUM(line_count), 0), COALESCE(SUM(LENGTH(data)), 0) "
+        "FROM line_blocks"
+    ).fetchone()
+    line_count += packed_lines
 
     first_ts = conn.execute(
         "SELECT MIN(timestamp) FROM sessions"
@@ -273,20 +576,15 @@ def show_info(conn, db_path=None, output_format="plain"):
     last_ts = conn.execute(
         "SELECT MAX(timestamp) FROM sessions"
     ).fetchone()[0]
+    dropped, dropped_sessions, spilled, spilled_sessions = conn.execute(
+        "SELECT COALESCE(SUM(dropped_lines), 0), COALESCE(SUM(dropped_lines > 0), 0), "
+        "COALESCE(SUM(spilled_lines), 0), COALESCE(SUM(spilled_lines > 0), 0) FROM sessions"
+    ).fetchone()
 
     db_size = None
     if db_path:
-        import os
         try:
-            size_bytes = os.path.getsize(db_path)
-            if size_bytes >= 1073741824:
-                db_size = f"{size_bytes / 1073741824:.1f}G"
-            elif size_bytes >= 1048576:
-                db_size = f"{size_bytes / 1048576:.1f}M"
-            elif size_bytes >= 1024:
-                db_size = f"{size_bytes / 1024:.1f}K"
-            else:
-                db_size = f"{size_bytes}"
+            db_size = _format_size(os.path.getsize(db_path))
         except OSError:
             pass
 
@@ -295,8 +593,15 @@ def show_info(conn, db_path=None, output_format="plain"):
         "db_size": db_size,
         "sessions": session_count,
         "lines": line_count,
+        "packed_sessions": packed_sessions,
+        "packed_lines": packed_lines,
+        "packed_bytes": packed_bytes,
         "first_session": format_ts(first_ts) if first_ts else None,
         "last_session": format_ts(last_ts) if last_ts else None,
+        "dropped_lines": dropped,
+        "dropped_sessions": dropped_sessions,
+        "spilled_lines": spilled,
+        "spilled_sessions": spilled_sessions,
     }
 
     if output_format == "json":
@@ -313,19 +618,147 @@ def show_info(conn, db_path=None, output_format="plain"):
         if last_ts:
             print(fmt % ("Last session:", format_ts(last_ts)))
         print(fmt % ("Total sessions:", session_count))
+        print(fmt % ("Total lines:", line_count))
+        print(fmt % ("Packed lines:", f"{packed_lines} (in {packed_sessions} session(s), "
+                                      f"{_format_size(packed_bytes)} compressed)"))
+        print(fmt % ("Dropped lines:", f"{dropped} (in {dropped_sessions} session(s))"))
+        print(fmt % ("Spilled lines:", f"{spilled} (in {spilled_sessions} session(s))"))
         print()
 
 
+def _format_size(size_bytes):
+    if size_bytes >= 1073741824:
+        return f"{size_bytes / 1073741824:.1f}G"
+    elif size_bytes >= 1048576:
+        return f"{size_bytes / 1048576:.1f}M"
+    elif size_bytes >= 1024:
+        return f"{size_bytes / 1024:.1f}K"
+    else:
+        return f"{size_bytes}"
+
+
+def _incremental_vacuum(conn):
+    # returns False when the database was created before auto_vacuum was
+    # enabled and has not been converted by `log tidy` yet
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return False
+    # sqlite3 steps a statement that returns no rows only once, which
+    # frees a single page; executescript() runs it to completion
+    conn.executescript("PRAGMA incremental_vacuum")
+    # the truncated pages only leave the main file once the WAL is
+    # written back to it
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return True
+
+
+def _delete_session(conn, session):
+    # unindex_session() needs the lines, so it has to come first
+    conn.execute("DELETE FROM line_blocks WHERE session = ?", (session,))
+    conn.execute("DELETE FROM lines WHERE session = ?", (session,))
+    conn.execute("DELETE FROM sessions WHERE id = ?", (session,))
+
+
+def _used_bytes(conn):
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return (page_count - free_pages) * page_size
+
+
+def prune_db(conn, db_path=None, older_than=None, max_size=None):
+    """Remove closed sessions, oldest first, that started before
+    `older_than` (epoch seconds) and then as many more as it takes for
+    the data to fit in `max_size` bytes.
+
+    Each session is deleted in its own transaction and the freed pages
+    are released with an incremental vacuum, so the work is
+    proportional to what is removed rather than to the size of the log;
+    only the grep index, if anything is removed from it, is merged as a
+    whole, once.  Sessions that are still being written are never
+    removed.
+    """
+    sessions = conn.execute(
+        "SELECT id, timestamp FROM sessions WHERE closed_timestamp IS NOT NULL "
+        "ORDER BY timestamp, id"
+    ).fetchall()
+
+    # removals from the grep index only free space once the index is
+    # merged, and merging rewrites all of it, so that happens once at
+    # the end.  Until then a removed session is counted as freeing its
+    # share of the index, by lines, plus what its removal added (FTS5
+    # writes that out at the commit).
+    index_bytes, index_lines = search_index_size(conn) if max_size is not None else (0, 0)
+    unmerged = False
+    unmerged_bytes = 0
+
+    pruned = 0
+    lines = 0
+    for session, session_ts in sessions:
+        too_old = older_than is not None and session_ts < older_than
+        too_big = max_size is not None and _used_bytes(conn) - unmerged_bytes > max_size
+        if not too_old and not too_big:
+            break
+        lines += conn.execute(
+            "SELECT (SELECT COUNT(*) FROM lines WHERE session = ?) + "
+            "(SELECT COALESCE(SUM(line_count), 0) FROM line_blocks WHERE session = ?)",
+            (session, session),
+        ).fetchone()[0]
+        unindexed = unindex_session(conn, session)
+        _delete_session(conn, session)
+        used = _used_bytes(conn)
+        conn.commit()
+        pruned += 1
+        if unindexed:
+            unmerged = True
+            unmerged_bytes += _used_bytes(conn) - used
+            if index_lines:
+                unmerged_bytes += index_bytes * unindexed // index_lines
+
+    if unmerged:
+        optimize_search_index(conn)
+    if pruned:
+        conn.execute("DELETE FROM commands WHERE id NOT IN (SELECT command FROM sessions)")
+        conn.execute("DELETE FROM sources WHERE id NOT IN (SELECT source FROM sessions)")
+        conn.commit()
+
+    size_before = os.path.getsize(db_path) if db_path else None
+    vacuumed = _incremental_vacuum(conn)
+
+    print(f"Pruned {pruned} session(s) ({lines} line(s))")
+    if db_path:
+        size_after = os.path.getsize(db_path)
+        print(f"Log size: {_format_size(size_before)} -> {_format_size(size_after)}")
+    if pruned and not vacuumed:
+        print("The freed space will be reused for new sessions; run 'crucible log tidy' once "
+              "to let prune shrink the log file from now on")
+
+
 def clear_db(conn):
+    conn.execute("DELETE FROM line_blocks")
     conn.execute("DELETE FROM lines")
     conn.execute("DELETE FROM sessions")
     conn.execute("DELETE FROM sources")
     conn.execute("DELETE FROM commands")
+    clear_search_index(conn)
     conn.commit()
-    conn.execute("VACUUM")
+    if not _incremental_vacuum(conn):
+        tidy_db(conn)
 
 
 def tidy_db(conn):
+    # closed sessions left in `lines` (from before cold storage) are
+    # packed before the file is rebuilt, unless cold storage is off
+    if cold_storage_enabled():
+        sessions, lines = pack_closed_sessions(conn)
+        if sessions:
+            print(f"Packed {lines} line(s) from {sessions} session(s)")
+    summarized = summarize_closed_sessions(conn)
+    if summarized:
+        print(f"Summarized {summarized} session(s)")
+    optimize_search_index(conn)
+    # the rebuild also switches older databases to incremental
+    # auto_vacuum for `log prune`
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
     conn.execute("VACUUM")
 
 
@@ -356,8 +789,11 @@ def list_sessions(conn, grep_pattern=None, output_format="plain",
     direction = "DESC" if sort_order == "desc" else "ASC"
     query = (
         "SELECT sessions.timestamp, sessions.session_id, commands.command, "
-        "  (SELECT MAX(lines.timestamp) - MIN(lines.timestamp) "
-        "   FROM lines WHERE lines.session = sessions.id) AS duration "
+        "  COALESCE(sessions.last_line_timestamp - sessions.first_line_timestamp, "
+        "           (SELECT MAX(lines.timestamp) FROM lines WHERE lines.session = sessions.id) "
+        "           - (SELECT MIN(lines.timestamp) FROM lines WHERE lines.session = sessions.id), "
+        "           (SELECT MAX(line_blocks.last_timestamp) - MIN(line_blocks.first_timestamp) "
+        "            FROM line_blocks WHERE line_blocks.session = sessions.id)) AS duration "
         "FROM sessions "
         "JOIN commands ON commands.id = sessions.command "
         f"ORDER BY {order_col} {direction}"
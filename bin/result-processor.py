@@ -11,7 +11,11 @@ import re
 import lzma
 import json
 import time
-import datetime
+import sqlite3
+import tempfile
+import concurrent.futures
+import itertools
+import multiprocessing
 from pathlib import Path
 from dataclasses import dataclass
 
@@ -26,6 +30,8 @@ class global_vars:
     log = None
     run_dir = None
     archive_dir = None
+    result_index = None
+    ls_record_count = 0
 
 
 def process_options():
@@ -45,6 +51,12 @@ def process_options():
                         type = str,
                         default = "/var/lib/crucible/archive")
 
+    parser.add_argument("--crucible-result-index",
+                        dest = "crucible_result_index",
+                        help = "Where is the Crucible run result index stored",
+                        type = str,
+                        default = "/var/lib/crucible/result-index.db")
+
     parser.add_argument("--log-level",
                         dest = "log_level",
                         help = "Control how much logging output should be generated",
@@ -66,13 +78,19 @@ def process_options():
                                    type = str,
                                    default = "run-dir")
 
+    parser_completion.add_argument("--cache-dir",
+                                   dest = "cache_dir",
+                                   help = "Where to store the completion listing for fast lookup by the bash completion (empty to disable)",
+                                   type = str,
+                                   default = "/var/lib/crucible/completion-cache")
+
 
     parser_ls = subparsers.add_parser("ls",
                                       help = "result listing help")
     parser_ls.add_argument("--type",
                            dest = "type",
                            help = "What type of result listing to display",
-                           choices = [ "tags", "run-id", "short", "archive" ],
+                           choices = [ "tags", "run-id", "short", "usage", "archive" ],
                            type = str,
                            default = "tags")
 
@@ -102,22 +120,108 @@ def process_options():
                            action = 'append',
                            default = [])
 
+    parser_ls.add_argument("--filter-match",
+                           dest = "filter_match",
+                           help = "Whether a result must match any or all of the tag filters",
+                           choices = [ "any", "all" ],
+                           type = str,
+                           default = "any")
+
+    parser_ls.add_argument("--format",
+                           dest = "format",
+                           help = "How to format the result listing; json and ndjson stream one record per result",
+                           choices = [ "text", "json", "ndjson" ],
+                           type = str,
+                           default = "text")
+
+    parser_ls.add_argument("--sort",
+                           dest = "sort",
+                           help = "How to order a usage listing (size = largest first, age = oldest first)",
+                           choices = [ "name", "size", "age" ],
+                           type = str,
+                           default = "name")
+
+    parser_ls.add_argument("--min-size",
+                           dest = "min_size",
+                           help = "Only list results using at least this much disk space (e.g. 500M, 10G) in a usage listing",
+                           type = parse_size,
+                           default = None)
+
+    parser_ls.add_argument("--older-than",
+                           dest = "older_than",
+                           help = "Only list results not modified for this long (e.g. 12h, 30d, 2w) in a usage listing",
+                           type = parse_age,
+                           default = None)
+
+    parser_ls.add_argument("--rescan",
+                           dest = "rescan",
+                           help = "Walk every result directory for a usage listing instead of using the totals cached in the run result index; "
+                                  "the cache only notices changes to a result's top level, run/ and config/ directories, "
+                                  "so use this after adding or changing files deeper in a completed result",
+                           action = "store_true",
+                           default = False)
+
+    parser_ls.add_argument("--no-index",
+                           dest = "no_index",
+                           help = "Do not use the run result index; load every rickshaw-run.json[.xz] directly",
+                           action = "store_true",
+                           default = False)
+
+    parser_ls.add_argument("--jobs",
+                           dest = "jobs",
+                           help = "How many rickshaw-run.json[.xz] files to load in parallel (0 = one per CPU)",
+                           type = int,
+                           default = 1)
+
 
     parser_tags = subparsers.add_parser("tags",
                                        help = "tags result help")
     parser_tags.add_argument("--action",
                              dest = "action",
                              help = "What to do with the tag(s)",
-                             choices = [ "add", "remove", "ls" ],
+                             choices = [ "add", "remove", "ls", "compact" ],
                              type = str,
                              default = "ls")
 
-    parser_tags.add_argument("--result-dir",
-                             dest = "result_dir",
-                             help = "A specific result directory to operate on",
+    parser_tags_select = parser_tags.add_mutually_exclusive_group(required = True)
+    parser_tags_select.add_argument("--result-dir",
+                                    dest = "result_dir",
+                                    help = "A specific result directory to operate on",
+                                    type = str,
+                                    default = None)
+
+    parser_tags_select.add_argument("--glob",
+                                    dest = "globs",
+                                    help = "Operate on the result directories matching one or more globs (relative to the run directory)",
+                                    type = str,
+                                    action = 'append',
+                                    default = [])
+
+    parser_tags_select.add_argument("--filters",
+                                    dest = "filters",
+                                    help = "Operate on the result directories having one or more tags; with optional value separated by ':'",
+                                    type = str,
+                                    action = 'append',
+                                    default = [])
+
+    parser_tags_select.add_argument("--stdin",
+                                    dest = "stdin",
+                                    help = "Operate on the result directories listed (one per line) on stdin",
+                                    action = "store_true",
+                                    default = False)
+
+    parser_tags.add_argument("--filter-match",
+                             dest = "filter_match",
+                             help = "Whether a result must have any or all of the --filters tags",
+                             choices = [ "any", "all" ],
                              type = str,
-                             default = None,
-                             required = True)
+                             default = "any")
+
+    parser_tags.add_argument("--jobs",
+                             dest = "jobs",
+                             help = "How many result directories to process in parallel (0 = one per CPU)",
+                             type = int,
+                             default = 1)
 
     parser_tags.add_argument("--tags",
                              dest = "tags",
@@ -130,9 +234,9 @@ def process_options():
     myglobal.args = parser.parse_args()
 
     if myglobal.args.log_level == 'debug':
-        logging.basicConfig(level = logging.DEBUG, format = myglobal.log_debug_format, stream = sys.stdout)
+        logging.basicConfig(level = logging.DEBUG, format = myglobal.log_debug_format, stream = log_stream())
     elif myglobal.args.log_level == 'normal':
-        logging.basicConfig(level = logging.INFO, format = myglobal.log_normal_format, stream = sys.stdout)
+        logging.basicConfig(level = logging.INFO, format = myglobal.log_normal_format, stream = log_stream())
 
     myglobal.log = logging.getLogger(__file__)
 
@@ -144,62 +248,869 @@ def process_options():
     myglobal.archive_dir = myglobal.args.crucible_archive_dir
 
 
-def load_rickshaw_run(result_directory):
-    data = None
-    status = "complete"
+JSON_STRING_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+JSON_SCALAR_RE = re.compile(r'[^,}\]\s]+')
+JSON_WHITESPACE_RE = re.compile(r'\s*')
+JSON_DELIMITER_RE = re.compile(r'\s*[,}]')
+
+
+class json_key_extractor:
+    '''Pull selected top-level keys out of a JSON object stream
+
+    The document is read in chunks and only the values of the
+    requested keys are kept, every other value is stepped over one
+    buffer at a time so the whole document is never materialized.
+    Reading stops as soon as all of the requested keys have been
+    found; of each group of keys in `alternatives` (keys a document
+    only ever has one of) finding one is enough.
+    '''
+
+    def __init__(self, json_file, keys, chunk_size = 262144, alternatives = ()):
+        self.json_file = json_file
+        self.keys = set(keys)
+        self.wanted = len(self.keys)
+        for group in alternatives:
+            present = self.keys.intersection(group)
+            if len(present) > 1:
+                self.wanted -= len(present) - 1
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+
+        chunk = self.json_file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+        return True
+
+    def error(self, msg):
+        raise json.JSONDecodeError(msg, self.buf, self.pos)
+
+    def next_char(self):
+        while True:
+            self.pos = JSON_WHITESPACE_RE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                self.error("Unexpected end of JSON document")
+
+    def match(self, regex):
+        # a match that runs into the end of the buffer may be truncated
+        while True:
+            m = regex.match(self.buf, self.pos)
+            if m is not None and (m.end() < len(self.buf) or self.eof):
+                break
+            if not self.fill():
+                m = regex.match(self.buf, self.pos)
+                break
+
+        if m is None:
+            self.error("Invalid JSON value")
+        self.pos = m.end()
+
+        return m.group()
+
+    def decode_value(self):
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number that runs into the end of the buffer may
+                # be truncated, only trust a value once its delimiter
+                # has been seen
+                if self.eof or JSON_DELIMITER_RE.match(self.buf, end):
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def skip_container(self):
+        closing = ']' if self.buf[self.pos] == '[' else '}'
+        self.pos += 1
+
+        if self.next_char() == closing:
+            self.pos += 1
+            return
+
+        while True:
+            if closing == '}':
+                if self.next_char() != '"':
+                    self.error("Expecting property name enclosed in double quotes")
+                self.match(JSON_STRING_RE)
+
+                if self.next_char() != ':':
+                    self.error("Expecting ':' delimiter")
+                self.pos += 1
+
+            self.skip_value()
+
+            char = self.next_char()
+            self.pos += 1
+            if char == closing:
+                return
+            elif char != ',':
+                self.error("Expecting ',' delimiter")
+
+    def skip_value(self):
+        char = self.next_char()
+        if char == '"':
+            self.match(JSON_STRING_RE)
+        elif char == '[' or char == '{':
+            try:
+                # when the whole value is already buffered let the C
+                # decoder step over it, the result is thrown away
+                self.pos = self.decoder.raw_decode(self.buf, self.pos)[1]
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+                # the value continues past the end of the buffer so
+                # descend into it and skip its members one at a time
+                self.skip_container()
+        else:
+            self.match(JSON_SCALAR_RE)
+
+    def extract(self):
+        data = {}
+
+        if self.next_char() != '{':
+            self.error("Expecting a JSON object")
+        self.pos += 1
+
+        while len(data) < self.wanted:
+            char = self.next_char()
+            if char == '}':
+                break
+            elif char != '"':
+                self.error("Expecting property name enclosed in double quotes")
+            key = json.loads(self.match(JSON_STRING_RE))
+
+            if self.next_char() != ':':
+                self.error("Expecting ':' delimiter")
+            self.pos += 1
+
+            if key in self.keys:
+                self.next_char()
+                data[key] = self.decode_value()
+            else:
+                self.skip_value()
 
-    rickshaw_run_output = result_directory / 'run' / 'rickshaw-run.json.xz'
-    if rickshaw_run_output.exists():
-        myglobal.log.debug("found %s" % (rickshaw_run_output))
-        with lzma.open(rickshaw_run_output, 'rt') as json_file:
-            data = json.load(json_file)
-    else:
-        myglobal.log.debug("did not find %s" % (rickshaw_run_output))
+            char = self.next_char()
+            self.pos += 1
+            if char == '}':
+                break
+            elif char != ',':
+                self.error("Expecting ',' delimiter")
 
-        rickshaw_run_output = result_directory / 'run' / 'rickshaw-run.json'
-        if rickshaw_run_output.exists():
-            myglobal.log.debug("found %s" % (rickshaw_run_output))
-            with open(rickshaw_run_output, 'rt') as json_file:
-                data = json.load(json_file)
-        else:
-            myglobal.log.debug("did not find %s" % (rickshaw_run_output))
+        return data
+
+
+def load_json(json_file, keys = None, alternatives = ()):
+    if keys is None:
+        return json.load(json_file)
+
+    return json_key_extractor(json_file, keys, alternatives = alternatives).extract()
+
+
+# where to look for the rickshaw-run document, in order of preference;
+# only a run that has written its run/ copy is complete
+RICKSHAW_RUN_LOCATIONS = [ ('run', 'rickshaw-run.json.xz'),
+                           ('run', 'rickshaw-run.json'),
+                           ('config', 'rickshaw-run.json.xz'),
+                           ('config', 'rickshaw-run.json') ]
 
+# the run id is stored as 'id', or as 'run-id' by older versions of
+# rickshaw, never both
+RICKSHAW_RUN_ALTERNATIVE_KEYS = [ ('id', 'run-id') ]
+
+# tag edits are recorded in this overlay, next to the rickshaw-run
+# document it applies to, rather than by rewriting the document; an
+# overlay written next to config/'s copy while the run was incomplete
+# still applies once run/'s copy exists
+RICKSHAW_RUN_TAGS = 'rickshaw-run.tags.json'
+
+
+def find_rickshaw_run(result_directory):
+    status = "complete"
+
+    for subdir, name in RICKSHAW_RUN_LOCATIONS:
+        if subdir == 'config' and status == "complete":
             myglobal.log.debug("incomplete run")
             status = "incomplete"
 
-            rickshaw_run_output = result_directory / 'config' / 'rickshaw-run.json.xz'
-            if rickshaw_run_output.exists():
-                myglobal.log.debug("found %s" % (rickshaw_run_output))
-                with lzma.open(rickshaw_run_output, 'rt') as json_file:
-                    data = json.load(json_file)
-            else:
-                myglobal.log.debug("did not find %s" % (rickshaw_run_output))
+        rickshaw_run = result_directory / subdir / name
+        if rickshaw_run.exists():
+            myglobal.log.debug("found %s" % (rickshaw_run))
+            return rickshaw_run, status
+
+        myglobal.log.debug("did not find %s" % (rickshaw_run))
+
+    return None, status
+
+
+def open_rickshaw_run(rickshaw_run):
+    if rickshaw_run.suffix == '.xz':
+        return lzma.open(rickshaw_run, 'rt')
+
+    return open(rickshaw_run, 'rt')
 
-                rickshaw_run_output = result_directory / 'config' / 'rickshaw-run.json'
-                if rickshaw_run_output.exists():
-                    myglobal.log.debug("found %s" % (rickshaw_run_output))
-                    with open(rickshaw_run_output, 'rt') as json_file:
-                        data = json.load(json_file)
-                else:
-                    myglobal.log.debug("did not find %s" % (rickshaw_run_output))
+
+def rickshaw_run_tags_file(rickshaw_run):
+    return rickshaw_run.parent / RICKSHAW_RUN_TAGS
+
+
+def rickshaw_run_tags_files(rickshaw_run):
+    # the overlays that apply to a rickshaw-run document, the one that
+    # wins first
+    tags_files = [ rickshaw_run_tags_file(rickshaw_run) ]
+    if rickshaw_run.parent.name == 'run':
+        tags_files.append(rickshaw_run.parent.parent / 'config' / RICKSHAW_RUN_TAGS)
+
+    return tags_files
+
+
+def load_rickshaw_run_tags(rickshaw_run):
+    for tags_file in rickshaw_run_tags_files(rickshaw_run):
+        try:
+            with open(tags_file, 'rt') as json_file:
+                tags = json.load(json_file)['tags']
+        except FileNotFoundError:
+            continue
+
+        myglobal.log.debug("found %s" % (tags_file))
+
+        return tags
+
+    return None
+
+
+def load_rickshaw_run(result_directory, keys = None):
+    data = None
+
+    rickshaw_run, status = find_rickshaw_run(result_directory)
+    if rickshaw_run is None:
+        return data, status
+
+    tags = None
+    if keys is None or 'tags' in keys:
+        tags = load_rickshaw_run_tags(rickshaw_run)
+        if tags is not None and keys is not None:
+            # the overlay supersedes whatever tags the document has so
+            # there is no need to extract them
+            keys = [ key for key in keys if key != 'tags' ]
+
+    with open_rickshaw_run(rickshaw_run) as json_file:
+        data = load_json(json_file, keys, RICKSHAW_RUN_ALTERNATIVE_KEYS)
+
+    if tags is not None:
+        data['tags'] = tags
 
     return data, status
 
 
-def write_json_fp(json_fp, json_data):
-    return json.dump(json_data, json_fp, indent = 4, separators = (',', ': '), sort_keys = True)
+# the subset of the rickshaw-run document that result listings need
+RESULT_SUMMARY_KEYS = [ 'tags', 'id', 'run-id', 'partial', 'dropped-engines' ]
+
+# bump whenever RESULT_INDEX_SQL changes, the index is only a cache so
+# an outdated one is simply dropped and rebuilt
+RESULT_INDEX_VERSION = 3
+
+RESULT_INDEX_SQL = """
+CREATE TABLE IF NOT EXISTS results (
+    path TEXT PRIMARY KEY NOT NULL,
+    inode INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    run_mtime_ns INTEGER NOT NULL,
+    config_mtime_ns INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    found INTEGER NOT NULL,
+    run_id TEXT,
+    partial INTEGER NOT NULL,
+    dropped_engines TEXT,
+    tags TEXT
+);
+
+CREATE TABLE IF NOT EXISTS result_tags (
+    path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    val TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_result_tags_name_val ON result_tags (name, val);
+CREATE INDEX IF NOT EXISTS idx_result_tags_path ON result_tags (path);
+
+CREATE TABLE IF NOT EXISTS result_usage (
+    path TEXT PRIMARY KEY NOT NULL,
+    inode INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    run_mtime_ns INTEGER NOT NULL,
+    config_mtime_ns INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    files INTEGER NOT NULL,
+    newest_mtime_ns INTEGER NOT NULL
+);
+"""
+
+RESULT_INDEX_DROP_SQL = """
+DROP TABLE IF EXISTS results;
+DROP TABLE IF EXISTS result_tags;
+DROP TABLE IF EXISTS result_usage;
+"""
+
+
+def summarize_rickshaw_run(data):
+    if data is None:
+        return None
+
+    return { key: data[key] for key in RESULT_SUMMARY_KEYS if key in data }
+
+
+def result_directory_signature(result_directory):
+    # the rickshaw-run.json[.xz] files live in the run/ and config/
+    # subdirectories, any rewrite of them (which is always done by
+    # creating a new file) changes the mtime of the containing
+    # directory
+    dir_stat = result_directory.stat()
+    signature = [ dir_stat.st_ino, dir_stat.st_mtime_ns ]
+    for subdir in [ 'run', 'config' ]:
+        try:
+            signature.append((result_directory / subdir).stat().st_mtime_ns)
+        except OSError:
+            signature.append(0)
+
+    return tuple(signature)
+
+
+def open_result_index():
+    if hasattr(myglobal.args, 'no_index') and myglobal.args.no_index:
+        myglobal.log.debug("the result index is disabled")
+        return 1
+
+    try:
+        myglobal.result_index = sqlite3.connect(myglobal.args.crucible_result_index, timeout = 30)
+        version = myglobal.result_index.execute("PRAGMA user_version").fetchone()[0]
+        if version != RESULT_INDEX_VERSION:
+            myglobal.log.debug("rebuilding result index (version %d != %d)" % (version, RESULT_INDEX_VERSION))
+            myglobal.result_index.executescript(RESULT_INDEX_DROP_SQL)
+        myglobal.result_index.executescript(RESULT_INDEX_SQL)
+        myglobal.result_index.execute("PRAGMA user_version = %d" % (RESULT_INDEX_VERSION))
+    except sqlite3.Error as e:
+        myglobal.log.debug("could not open result index %s: %s" % (myglobal.args.crucible_result_index, e))
+        myglobal.result_index = None
+        return 1
+
+    return 0
+
+
+def close_result_index():
+    if myglobal.result_index is None:
+        return 0
+
+    try:
+        myglobal.result_index.commit()
+    except sqlite3.Error as e:
+        myglobal.log.debug("could not commit result index updates: %s" % (e))
+
+    myglobal.result_index.close()
+    myglobal.result_index = None
+
+    return 0
+
+
+def result_index_signatures():
+    signatures = {}
+    for row in myglobal.result_index.execute("SELECT path, inode, mtime_ns, run_mtime_ns, config_mtime_ns FROM results"):
+        signatures[row[0]] = tuple(row[1:])
+
+    return signatures
+
+
+def read_result_index(result_directory):
+    row = myglobal.result_index.execute("SELECT status, found, run_id, partial, dropped_engines, tags "
+                                        "FROM results WHERE path = ?",
+                                        (str(result_directory.absolute()),)).fetchone()
+    if row is None:
+        return None
+
+    status = row[0]
+    if not row[1]:
+        return None, status
+
+    data = { 'partial': bool(row[3]) }
+    if row[2] is not None:
+        data['id'] = row[2]
+    if row[4] is not None:
+        data['dropped-engines'] = json.loads(row[4])
+    if row[5] is not None:
+        data['tags'] = json.loads(row[5])
+
+    return data, status
+
+
+def update_result_index(result_directory, signature, data, status):
+    path = str(result_directory.absolute())
+    run_id = None
+    partial = False
+    dropped_engines = None
+    tags = None
+    tag_rows = []
+    if data is not None:
+        run_id = data.get('id', data.get('run-id'))
+        partial = bool(data.get('partial'))
+        if 'dropped-engines' in data:
+            dropped_engines = json.dumps(data['dropped-engines'])
+        if 'tags' in data:
+            tags = json.dumps(data['tags'])
+            tag_rows = [ (path, tag['name'], tag['val']) for tag in data['tags'] ]
+
+    try:
+        myglobal.result_index.execute("INSERT OR REPLACE INTO results (path, inode, mtime_ns, run_mtime_ns, config_mtime_ns, "
+                                      "status, found, run_id, partial, dropped_engines, tags) "
+                                      "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                      (path, *signature,
+                                       status, data is not None, run_id, partial, dropped_engines, tags))
+        myglobal.result_index.execute("DELETE FROM result_tags WHERE path = ?", (path,))
+        myglobal.result_index.executemany("INSERT INTO result_tags (path, name, val) VALUES (?, ?, ?)", tag_rows)
+    except sqlite3.Error as e:
+        myglobal.log.debug("could not update result index for %s: %s" % (result_directory, e))
+        return 1
+
+    return 0
+
+
+def update_result_index_tags(result_directory, old_signature, signature, tags):
+    # only carry the entry forward if it was current before the tag
+    # edit, otherwise drop it so the next listing reloads the result
+    path = str(result_directory.absolute())
+    try:
+        cursor = myglobal.result_index.execute("UPDATE results SET inode = ?, mtime_ns = ?, run_mtime_ns = ?, config_mtime_ns = ?, tags = ? "
+                                               "WHERE path = ? AND inode = ? AND mtime_ns = ? AND run_mtime_ns = ? AND config_mtime_ns = ?",
+                                               (*signature, None if tags is None else json.dumps(tags), path, *old_signature))
+        myglobal.result_index.execute("DELETE FROM result_tags WHERE path = ?", (path,))
+        if cursor.rowcount:
+            myglobal.result_index.executemany("INSERT INTO result_tags (path, name, val) VALUES (?, ?, ?)",
+                                              [ (path, tag['name'], tag['val']) for tag in tags or [] ])
+        else:
+            myglobal.result_index.execute("DELETE FROM results WHERE path = ?", (path,))
+    except sqlite3.Error as e:
+        myglobal.log.debug("could not update result index tags for %s: %s" % (result_directory, e))
+        return 1
+
+    return 0
+
 
+def prune_result_index(run_dir, dir_list):
+    present = set(str(result.absolute()) for result in dir_list)
+    prefix = str(run_dir.absolute()) + os.sep
 
-def backup_rickshaw_run(rickshaw_run):
-    timestamp = datetime.datetime.fromtimestamp(time.time())
-    timestamp = timestamp.strftime(".%Y-%m-%d_%H:%M:%S.%f")
+    stale = []
+    for (path,) in myglobal.result_index.execute("SELECT path FROM results UNION SELECT path FROM result_usage"):
+        if path.startswith(prefix) and path not in present:
+            stale.append((path,))
 
-    rickshaw_run_backup = rickshaw_run.parent / (rickshaw_run.name + timestamp)
-    rickshaw_run.rename(rickshaw_run_backup)
+    if len(stale):
+        myglobal.log.debug("pruning %d stale result index entries" % (len(stale)))
+        myglobal.result_index.executemany("DELETE FROM results WHERE path = ?", stale)
+        myglobal.result_index.executemany("DELETE FROM result_tags WHERE path = ?", stale)
+        myglobal.result_index.executemany("DELETE FROM result_usage WHERE path = ?", stale)
 
     return 0
 
 
+def query_tag_index(tag_filters, match_all):
+    matches = None
+    for tag_filter in tag_filters:
+        match = split_tag(tag_filter)
+        if match:
+            rows = myglobal.result_index.execute("SELECT path FROM result_tags WHERE name = ? AND val = ?",
+                                                 (match.group(1), match.group(2)))
+        else:
+            rows = myglobal.result_index.execute("SELECT path FROM result_tags WHERE name = ?", (tag_filter,))
+        paths = set(path for (path,) in rows)
+
+        myglobal.log.debug("tag_filter '%s' matches %d result directories" % (tag_filter, len(paths)))
+
+        if matches is None:
+            matches = paths
+        elif match_all:
+            matches &= paths
+        else:
+            matches |= paths
+
+    if matches is None:
+        matches = set()
+
+    return matches
+
+
+def rickshaw_run_status(result_directory):
+    # a run is only complete once rickshaw-run.json[.xz] has been
+    # written to the run/ directory (see find_rickshaw_run())
+    for subdir, name in RICKSHAW_RUN_LOCATIONS:
+        if subdir == 'run' and (result_directory / subdir / name).exists():
+            return "complete"
+
+    return "incomplete"
+
+
+def tag_filtering():
+    return myglobal.args.mode != "completion" and len(myglobal.args.filters) and myglobal.args.filter_type == "tags"
+
+
+def match_all_filters():
+    return hasattr(myglobal.args, 'filter_match') and myglobal.args.filter_match == "all"
+
+
+def structured_output():
+    return myglobal.args.mode == "ls" and hasattr(myglobal.args, 'format') and myglobal.args.format != "text"
+
+
+def log_stream():
+    # a json/ndjson listing owns stdout; anything else written there
+    # (errors, debug output) would leave it unparseable
+    if structured_output():
+        return sys.stderr
+    return sys.stdout
+
+
+def metadata_only():
+    # run-dir completion only prints directory names, so it can be
+    # answered without opening (or even indexing) the rickshaw-run
+    # files; every ls listing can show partial runs, which takes the
+    # rickshaw-run (or the result index)
+    return myglobal.args.mode == "completion" and myglobal.args.type == "run-dir"
+
+
+def summary_keys():
+    if myglobal.result_index is not None:
+        # the index must be able to answer any type of listing
+        return RESULT_SUMMARY_KEYS
+
+    if structured_output():
+        # every record carries all of the summary fields
+        return RESULT_SUMMARY_KEYS
+
+    keys = [ 'partial', 'dropped-engines' ]
+    if myglobal.args.type == "tags" or tag_filtering():
+        keys.append('tags')
+    if myglobal.args.type == "run-id":
+        keys.extend([ 'id', 'run-id' ])
+
+    return keys
+
+
+def load_rickshaw_run_summary(result_directory, keys = RESULT_SUMMARY_KEYS):
+    data, status = load_rickshaw_run(result_directory, keys)
+
+    return summarize_rickshaw_run(data), status
+
+
+def get_jobs():
+    jobs = 1
+    if hasattr(myglobal.args, 'jobs') and myglobal.args.jobs is not None:
+        jobs = myglobal.args.jobs
+        if jobs == 0:
+            jobs = os.cpu_count() or 1
+
+    return jobs
+
+
+def map_in_processes(function, jobs, *iterables):
+    # the workers are forked so that they inherit myglobal, but a
+    # sqlite connection must not be carried across fork() -- a child
+    # that touches it (or just tears it down) can corrupt the parent's
+    # locks -- so the result index is committed and closed while the
+    # pool is up and opened again afterwards
+    reopen_index = myglobal.result_index is not None
+    close_result_index()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers = jobs, mp_context = multiprocessing.get_context("fork")) as executor:
+            return list(executor.map(function, *iterables, chunksize = max(1, len(iterables[0]) // (jobs * 4))))
+    finally:
+        if reopen_index:
+            open_result_index()
+
+
+def load_rickshaw_run_summaries(result_list):
+    keys = summary_keys()
+    jobs = min(get_jobs(), len(result_list))
+    if jobs > 1:
+        # lzma decompression and json parsing are CPU bound so use
+        # processes rather than threads; results are collected in
+        # submission order so the listing order is preserved
+        myglobal.log.debug("loading %d rickshaw-run files with %d jobs" % (len(result_list), jobs))
+        return map_in_processes(load_rickshaw_run_summary, jobs, result_list, itertools.repeat(keys))
+
+    return [ load_rickshaw_run_summary(result, keys) for result in result_list ]
+
+
+def refresh_result_index(result_list):
+    indexed = result_index_signatures()
+
+    stale = []
+    signatures = []
+    for result in result_list:
+        signature = result_directory_signature(result)
+        if indexed.get(str(result.absolute())) == signature:
+            myglobal.log.debug("result index hit for %s" % (result))
+            continue
+
+        myglobal.log.debug("result index miss for %s" % (result))
+        stale.append(result)
+        signatures.append(signature)
+
+    loaded = load_rickshaw_run_summaries(stale)
+    if myglobal.result_index is None:
+        # it could not be opened again after loading in parallel
+        return dict(zip(stale, loaded))
+
+    for result, signature, (data, status) in zip(stale, signatures, loaded):
+        update_result_index(result, signature, data, status)
+
+    return dict(zip(stale, loaded))
+
+
+def load_result_summaries(result_list):
+    summaries = {}
+    if metadata_only():
+        # completion output is only the directory name
+        for result in result_list:
+            summaries[result] = (None, None)
+
+        return summaries
+
+    if myglobal.result_index is None:
+        return dict(zip(result_list, load_rickshaw_run_summaries(result_list)))
+
+    loaded = refresh_result_index(result_list)
+    for result in result_list:
+        if result in loaded:
+            summaries[result] = loaded[result]
+        else:
+            summaries[result] = read_result_index(result)
+
+    return summaries
+
+
+def filter_results_by_tags(result_list, tag_filters, match_all):
+    # answer the tag filters from the inverted tag index rather than
+    # decoding and checking the tags of every result
+    refresh_result_index(result_list)
+    if myglobal.result_index is None:
+        return scan_results_by_tags(result_list, tag_filters, match_all)
+
+    matches = query_tag_index(tag_filters, match_all)
+
+    return [ result for result in result_list if str(result.absolute()) in matches ]
+
+
+def scan_results_by_tags(result_list, tag_filters, match_all):
+    matches = []
+    for result, (data, status) in zip(result_list, load_rickshaw_run_summaries(result_list)):
+        if data is None or not 'tags' in data:
+            continue
+
+        found = [ not check_for_tag_filter(data, tag_filter) for tag_filter in tag_filters ]
+        if (match_all and all(found)) or (not match_all and any(found)):
+            matches.append(result)
+
+    return matches
+
+
+def load_result_summary(result_directory):
+    return load_result_summaries([ result_directory ])[result_directory]
+
+
+SIZE_UNITS = { '': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4 }
+AGE_UNITS = { 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800 }
+
+
+def parse_size(size):
+    match = re.search(r"^([0-9]+(?:\.[0-9]+)?)([KMGT]?)i?B?$", size, re.IGNORECASE)
+    if not match:
+        raise argparse.ArgumentTypeError("invalid size '%s' (expected e.g. 500M, 10G)" % (size))
+
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def parse_age(age):
+    match = re.search(r"^([0-9]+)([smhdw])$", age)
+    if not match:
+        raise argparse.ArgumentTypeError("invalid age '%s' (expected e.g. 12h, 30d, 2w)" % (age))
+
+    return int(match.group(1)) * AGE_UNITS[match.group(2)]
+
+
+def format_size(size):
+    for unit in [ 'B', 'KiB', 'MiB', 'GiB' ]:
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TiB'
+
+    if unit == 'B':
+        return "%d B" % (size)
+
+    return "%.1f %s" % (size, unit)
+
+
+def format_age(seconds):
+    seconds = max(0, int(seconds))
+    if seconds >= 86400:
+        return "%dd%02dh" % (seconds // 86400, (seconds % 86400) // 3600)
+    elif seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, (seconds % 3600) // 60)
+
+    return "%dm%02ds" % (seconds // 60, seconds % 60)
+
+
+def walk_result_directory(result_directory):
+    # an explicit stack of os.scandir() calls, the stat results come
+    # from the directory entries so only one syscall is made per file;
+    # hard linked files are only counted once
+    root_stat = result_directory.stat()
+    total_bytes = root_stat.st_blocks * 512
+    files = 0
+    newest_mtime_ns = root_stat.st_mtime_ns
+    seen = set()
+
+    stack = [ str(result_directory) ]
+    while len(stack):
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        entry_stat = entry.stat(follow_symlinks = False)
+                        is_dir = entry.is_dir(follow_symlinks = False)
+                    except OSError:
+                        continue
+
+                    if is_dir:
+                        stack.append(entry.path)
+                    else:
+                        files += 1
+                        if entry_stat.st_nlink > 1:
+                            if (entry_stat.st_dev, entry_stat.st_ino) in seen:
+                                continue
+                            seen.add((entry_stat.st_dev, entry_stat.st_ino))
+
+                    total_bytes += entry_stat.st_blocks * 512
+                    newest_mtime_ns = max(newest_mtime_ns, entry_stat.st_mtime_ns)
+        except OSError as e:
+            myglobal.log.debug("could not scan %s: %s" % (e.filename, e))
+
+    return total_bytes, files, newest_mtime_ns
+
+
+def read_usage_index(result_directory, signature):
+    row = myglobal.result_index.execute("SELECT bytes, files, newest_mtime_ns FROM result_usage "
+                                        "WHERE path = ? AND inode = ? AND mtime_ns = ? AND run_mtime_ns = ? AND config_mtime_ns = ?",
+                                        (str(result_directory.absolute()), *signature)).fetchone()
+    if row is None:
+        return None
+
+    return tuple(row)
+
+
+def update_usage_index(result_directory, signature, usage):
+    try:
+        myglobal.result_index.execute("INSERT OR REPLACE INTO result_usage (path, inode, mtime_ns, run_mtime_ns, config_mtime_ns, "
+                                      "bytes, files, newest_mtime_ns) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                      (str(result_directory.absolute()), *signature, *usage))
+    except sqlite3.Error as e:
+        myglobal.log.debug("could not update result usage index for %s: %s" % (result_directory, e))
+        return 1
+
+    return 0
+
+
+def load_result_usage(result_list):
+    # runs are (almost) never modified once complete so their totals are
+    # cached in the result index; a run that is still being written is
+    # always walked, as is everything when --rescan is given.  The cache
+    # is keyed on result_directory_signature(), which only sees the
+    # result directory and its run/ and config/ subdirectories: checking
+    # anything deeper would mean walking the tree, the very thing the
+    # cache is there to avoid, and files rewritten in place would still
+    # go unnoticed.
+    usage = {}
+    pending = []
+    signatures = {}
+    for result in result_list:
+        if myglobal.result_index is not None and rickshaw_run_status(result) == "complete":
+            signatures[result] = result_directory_signature(result)
+            if not myglobal.args.rescan:
+                usage[result] = read_usage_index(result, signatures[result])
+                if usage[result] is not None:
+                    continue
+
+        pending.append(result)
+
+    # walking is dominated by waiting on stat() so threads are enough
+    jobs = min(get_jobs(), len(pending))
+    if jobs > 1:
+        myglobal.log.debug("walking %d result directories with %d jobs" % (len(pending), jobs))
+        with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as executor:
+            walked = list(executor.map(walk_result_directory, pending))
+    else:
+        walked = [ walk_result_directory(result) for result in pending ]
+
+    for result, result_usage in zip(pending, walked):
+        usage[result] = result_usage
+        if result in signatures:
+            update_usage_index(result, signatures[result], result_usage)
+
+    return usage
+
+
+def usage_filtering():
+    return myglobal.args.min_size is not None or myglobal.args.older_than is not None or myglobal.args.sort != "name"
+
+
+def select_results_by_usage(result_list, usage):
+    now_ns = time.time_ns()
+
+    selected = []
+    for result in result_list:
+        total_bytes, files, newest_mtime_ns = usage[result]
+        if myglobal.args.min_size is not None and total_bytes < myglobal.args.min_size:
+            continue
+        if myglobal.args.older_than is not None and now_ns - newest_mtime_ns < myglobal.args.older_than * 1000000000:
+            continue
+        selected.append(result)
+
+    if myglobal.args.sort == "size":
+        selected.sort(key = lambda result: usage[result][0], reverse = True)
+    elif myglobal.args.sort == "age":
+        selected.sort(key = lambda result: usage[result][2])
+
+    return selected
+
+
+def log_result_usage(usage):
+    total_bytes, files, newest_mtime_ns = usage
+    myglobal.log.info("size:   %s (%d file(s))" % (format_size(total_bytes), files))
+    myglobal.log.info("age:    %s" % (format_age(time.time() - newest_mtime_ns / 1000000000)))
+
+    return 0
+
+
+def write_json_fp(json_fp, json_data):
+    return json.dump(json_data, json_fp, indent = 4, separators = (',', ': '), sort_keys = True)
+
+
 def new_rickshaw_run_xz(rickshaw_run, data):
     with lzma.open(rickshaw_run, 'wt') as json_file:
         write_json_fp(json_file, data)
@@ -214,48 +1125,89 @@ def new_rickshaw_run(rickshaw_run, data):
     return 0
 
 
-def replace_rickshaw_run(result_directory, data):
-    rickshaw_run_output = result_directory / 'run' / 'rickshaw-run.json.xz'
-    if rickshaw_run_output.exists():
-        myglobal.log.debug("found %s" % (rickshaw_run_output))
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
-        backup_rickshaw_run(rickshaw_run_output)
+    return 0
 
-        new_rickshaw_run_xz(rickshaw_run_output, data)
-    else:
-        myglobal.log.debug("did not find %s" % (rickshaw_run_output))
 
-        rickshaw_run_output = result_directory / 'run' / 'rickshaw-run.json'
-        if rickshaw_run_output.exists():
-            myglobal.log.debug("found %s" % (rickshaw_run_output))
+def replace_file(path, writer, data):
+    # write a complete new copy next to the original and rename it into
+    # place, a crash at any point leaves either the old or the new file
+    # but never a partially written one
+    try:
+        mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o644
 
-            backup_rickshaw_run(rickshaw_run_output)
+    fd, tmp_path = tempfile.mkstemp(dir = path.parent, prefix = ".%s." % (path.name))
+    os.close(fd)
+    try:
+        writer(tmp_path, data)
+        fsync_path(tmp_path)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    fsync_path(path.parent)
 
-            new_rickshaw_run(rickshaw_run_output, data)
-        else:
-            myglobal.log.debug("did not find %s" % (rickshaw_run_output))
+    return 0
 
-            rickshaw_run_output = result_directory / 'config' / 'rickshaw-run.json.xz'
-            if rickshaw_run_output.exists():
-                myglobal.log.debug("found %s" % (rickshaw_run_output))
 
-                backup_rickshaw_run(rickshaw_run_output)
+def new_rickshaw_run_tags(tags_file, tags):
+    return new_rickshaw_run(tags_file, { 'tags': tags })
 
-                new_rickshaw_run_xz(rickshaw_run_output, data)
-            else:
-                myglobal.log.debug("did not find %s" % (rickshaw_run_output))
 
-                rickshaw_run_output = result_directory / 'config' / 'rickshaw-run.json'
-                if rickshaw_run_output.exists():
-                    myglobal.log.debug("found %s" % (rickshaw_run_output))
+def replace_rickshaw_run_tags(result_directory, tags):
+    rickshaw_run, status = find_rickshaw_run(result_directory)
+    if rickshaw_run is None:
+        return 1
 
-                    backup_rickshaw_run(rickshaw_run_output)
+    tags_file = rickshaw_run_tags_file(rickshaw_run)
+    myglobal.log.debug("writing %s" % (tags_file))
 
-                    new_rickshaw_run(rickshaw_run_output, data)
-                else:
-                    myglobal.log.debug("did not find %s" % (rickshaw_run_output))
+    try:
+        replace_file(tags_file, new_rickshaw_run_tags, tags)
+    except OSError as e:
+        myglobal.log.error("Could not write %s: %s" % (tags_file, e))
+        return 1
+
+    return 0
+
+
+def compact_rickshaw_run(result_directory):
+    rickshaw_run, status = find_rickshaw_run(result_directory)
+    if rickshaw_run is None:
+        return 1
+
+    tags_files = [ tags_file for tags_file in rickshaw_run_tags_files(rickshaw_run) if tags_file.exists() ]
+    if len(tags_files) == 0:
+        myglobal.log.debug("there is no %s to compact" % (rickshaw_run_tags_file(rickshaw_run)))
+        return 0
+
+    data, status = load_rickshaw_run(result_directory)
 
-                    return 1
+    try:
+        if rickshaw_run.suffix == '.xz':
+            replace_file(rickshaw_run, new_rickshaw_run_xz, data)
+        else:
+            replace_file(rickshaw_run, new_rickshaw_run, data)
+
+        # the document now carries the same tags as the overlay so it
+        # does not matter if we crash before the overlays are removed;
+        # any other overlay was superseded by it
+        for tags_file in tags_files:
+            tags_file.unlink()
+            fsync_path(tags_file.parent)
+    except OSError as e:
+        myglobal.log.error("Could not compact %s into %s: %s" % (tags_files[0], rickshaw_run, e))
+        return 1
+    myglobal.log.debug("compacted %s into %s" % (tags_files[0], rickshaw_run))
 
     return 0
 
@@ -336,19 +1288,20 @@ def log_run_id(run_id):
     return 0
 
 
+def format_tags(tags):
+    formatted = []
+    for tag in tags:
+        if re.search(r"^.*\s.*$", tag['val']):
+            formatted.append("%s:\"%s\"" % (tag['name'], tag['val']))
+        else:
+            formatted.append("%s:%s" % (tag['name'], tag['val']))
+
+    return ", ".join(formatted)
+
+
 def show_tags(data):
     if 'tags' in data:
-        tags = ""
-        for tag in data['tags']:
-            if len(tags):
-                tags += ", "
-            tags += "%s:" % (tag['name'])
-            match = re.search(r"^.*\s.*$", tag['val'])
-            if match:
-                tags += "\"%s\"" % (tag['val'])
-            else:
-                tags += tag['val']
-        myglobal.log.info("tags:   %s" % (tags))
+        myglobal.log.info("tags:   %s" % (format_tags(data['tags'])))
     else:
         myglobal.log.error("tags:   Not Found")
 
@@ -398,31 +1351,129 @@ def ls_archive(archive):
     return 0
 
 
-def ls_result_directory(result_directory):
+def result_matches_tag_filters(result_directory, data):
+    if data is None:
+        myglobal.log.debug("result directory '%s' has no rickshaw-run" % (result_directory))
+        return False
+
+    if not 'tags' in data:
+        myglobal.log.debug("result directory '%s' has no tags to filter on" % (result_directory))
+        return False
+
+    found_match = False
+    missed_match = False
+    for tag_filter in myglobal.args.filters:
+        if check_for_tag_filter(data, tag_filter):
+            myglobal.log.debug("result directory '%s' does not match tag filter '%s'" % (result_directory, tag_filter))
+            missed_match = True
+        else:
+            found_match = True
+
+    if not found_match:
+        myglobal.log.debug("result directory does not match any tag filters")
+        return False
+
+    if missed_match and match_all_filters():
+        myglobal.log.debug("result directory does not match all tag filters")
+        return False
+
+    return True
+
+
+def result_run_id(result_directory, data):
+    # check if the result directory conforms to the "new" format where
+    # the session-id/run-id is embedded in the directory name
+    match = re.search(r"^([a-zA-Z0-9]+)--([0-9-]+)_([0-9:]+)--([a-f0-9-]+)$", result_directory.name)
+    if match:
+        # found the run-id in the directory name
+        return match.group(4)
+
+    # the result directory is in the "old" name format so we need to
+    # load the run-id from the rickshaw-run json
+    if data is not None:
+        if 'id' in data:
+            return data['id']
+        elif 'run-id' in data:
+            return data['run-id']
+
+    return None
+
+
+def open_ls_output():
+    myglobal.ls_record_count = 0
+    if myglobal.args.format == "json":
+        sys.stdout.write("[")
+
+    return 0
+
+
+def write_ls_record(record):
+    # records are written (and flushed) as each result is processed so
+    # consumers can start working before the listing is complete
+    if myglobal.args.format == "json":
+        if myglobal.ls_record_count:
+            sys.stdout.write(",")
+        sys.stdout.write("\n" + json.dumps(record))
+    else:
+        sys.stdout.write(json.dumps(record) + "\n")
+    sys.stdout.flush()
+    myglobal.ls_record_count += 1
+
+    return 0
+
+
+def close_ls_output():
+    if myglobal.args.format == "json":
+        if myglobal.ls_record_count:
+            sys.stdout.write("\n")
+        sys.stdout.write("]\n")
+        sys.stdout.flush()
+
+    return 0
+
+
+def result_record(result_directory, status, data):
+    record = {
+        'name': result_directory.name,
+        'symlink-target': None,
+        'status': status,
+        'partial': False,
+        'dropped-engines': [],
+        'tags': None,
+        'run-id': result_run_id(result_directory, data)
+    }
+
+    if result_directory.is_symlink():
+        record['symlink-target'] = result_directory.readlink().name
+
+    if data is not None:
+        record['partial'] = bool(data.get('partial'))
+        record['dropped-engines'] = data.get('dropped-engines', [])
+        record['tags'] = data.get('tags')
+
+    return record
+
+
+def ls_result_directory(result_directory, summary=None, usage=None):
     if validate_result_directory(result_directory):
         return 1
 
-    data, status = load_rickshaw_run(result_directory)
+    if summary is None:
+        summary = load_result_summary(result_directory)
+    data, status = summary
 
-    if myglobal.args.mode != "completion" and len(myglobal.args.filters) and myglobal.args.filter_type == "tags":
-        if data is not None:
-            if 'tags' in data:
-                found_match = False
-                for tag_filter in myglobal.args.filters:
-                    if check_for_tag_filter(data, tag_filter):
-                        myglobal.log.debug("result directory '%s' does not match tag filter '%s'" % (result_directory, tag_filter))
-                    else:
-                        found_match = True
+    if myglobal.args.type == "usage" and usage is None:
+        usage = load_result_usage([ result_directory ])[result_directory]
 
-                if not found_match:
-                    myglobal.log.debug("result directory does not match any tag filters")
-                    return 0
-            else:
-                myglobal.log.debug("result directory '%s' has no tags to filter on" % (result_directory))
-                return 0
-        else:
-            myglobal.log.debug("result directory '%s' has no rickshaw-run" % (result_directory))
-            return 0
+    if tag_filtering() and not result_matches_tag_filters(result_directory, data):
+        return 0
+
+    if structured_output():
+        record = result_record(result_directory, status, data)
+        if usage is not None:
+            record['size'], record['files'], newest_mtime_ns = usage
+            record['mtime'] = newest_mtime_ns / 1000000000
+        return write_ls_record(record)
 
     log_result_directory(result_directory, status, data)
 
@@ -434,33 +1485,17 @@ def ls_result_directory(result_directory):
         else:
             if myglobal.args.mode != "completion":
                 myglobal.log.error("Could not find a valid rickshaw-run.json[.xz]")
+    elif myglobal.args.type == "usage":
+        log_result_usage(usage)
     elif myglobal.args.type == "run-id":
-        # check if the result directory conforms to the "new"
-        # format where the session-id/run-id is embedded in
-        # the directory name
-        match = re.search(r"^([a-zA-Z0-9]+)--([0-9-]+)_([0-9:]+)--([a-f0-9-]+)$", result_directory.name)
-        if match:
-            # found the run-id in the directory name
-            log_run_id(match.group(4))
-        else:
-            # the result directory is in the "old" name format
-            # so we need to load the run-id from the
-            # rickshaw-run json
-            run_id = None
+        run_id = result_run_id(result_directory, data)
+        if run_id is not None:
+            log_run_id(run_id)
+        elif myglobal.args.mode != "completion":
             if data is not None:
-                run_id = None
-                if 'id' in data:
-                    run_id = data['id']
-                elif 'run-id' in data:
-                    run_id = data['run-id']
-                if run_id is not None:
-                    log_run_id(run_id)
-                else:
-                    if myglobal.args.mode != "completion":
-                        myglobal.log.error("run-id: Not Found")
+                myglobal.log.error("run-id: Not Found")
             else:
-                if myglobal.args.mode != "completion":
-                    myglobal.log.error("Could not find a valid rickshaw-run.json[.xz]")
+                myglobal.log.error("Could not find a valid rickshaw-run.json[.xz]")
 
     if myglobal.args.mode != "completion":
         myglobal.log.info("")
@@ -589,6 +1624,10 @@ def archives_ls_mode():
     return 0
 
 
+# how many results to load between bursts of listing output
+LS_CHUNK_SIZE = 64
+
+
 def run_results_ls_mode():
     if myglobal.args.mode != "completion" and myglobal.args.result_dir is not None:
         return ls_result_directory(Path(myglobal.args.result_dir))
@@ -610,6 +1649,10 @@ def run_results_ls_mode():
                 dir_list.extend(run_dir.iterdir())
 
             dir_list = sorted(dir_list)
+            if myglobal.result_index is not None and not (myglobal.args.mode != "completion" and len(myglobal.args.filters) and myglobal.args.filter_type == "name"):
+                prune_result_index(run_dir, dir_list)
+
+            result_list = []
             for result in dir_list:
                 if result.name == "latest":
                     continue
@@ -617,7 +1660,34 @@ def run_results_ls_mode():
                 if not result.is_dir():
                     continue
 
-                ls_result_directory(result)
+                result_list.append(result)
+
+            if myglobal.result_index is not None and tag_filtering():
+                result_list = filter_results_by_tags(result_list, myglobal.args.filters, match_all_filters())
+
+            usage = {}
+            if myglobal.args.type == "usage":
+                # the selection and ordering depend on every result's
+                # usage so tag filters have to be settled up front
+                if myglobal.result_index is None and tag_filtering():
+                    result_list = scan_results_by_tags(result_list, myglobal.args.filters, match_all_filters())
+
+                usage = load_result_usage(result_list)
+                result_list = select_results_by_usage(result_list, usage)
+
+            # load and list the results a chunk at a time so output
+            # starts flowing before the whole run directory is loaded
+            chunk_size = max(LS_CHUNK_SIZE, get_jobs() * 16)
+            for offset in range(0, len(result_list), chunk_size):
+                chunk = result_list[offset:offset + chunk_size]
+                summaries = load_result_summaries(chunk)
+                for result in chunk:
+                    ls_result_directory(result, summaries[result], usage.get(result))
+
+            if myglobal.args.type == "usage" and not structured_output():
+                myglobal.log.info("total:  %s (%d file(s)) in %d result(s)" % (format_size(sum(usage[result][0] for result in result_list)),
+                                                                           sum(usage[result][1] for result in result_list),
+                                                                           len(result_list)))
         else:
             myglobal.log.error("Invalid Crucible run results directory '%s'!" % (myglobal.run_dir))
             return 1
@@ -687,13 +1757,27 @@ def remove_tags(data):
     return 0
 
 
+# what the tags mode needs from the rickshaw-run document
+RESULT_TAG_KEYS = [ 'tags', 'partial', 'dropped-engines' ]
+
+
+def index_tagged_result(result_directory, signature, tags):
+    # keep the result index (and its tag index) in step with the tag
+    # edit so the next listing does not have to reload the result
+    if myglobal.result_index is None:
+        return 0
+
+    return update_result_index_tags(result_directory, signature, result_directory_signature(result_directory), tags)
+
+
 def run_results_tag_mode():
     run_dir = Path(myglobal.args.result_dir)
 
     if validate_result_directory(run_dir):
         return 1
 
-    data, status = load_rickshaw_run(run_dir)
+    signature = result_directory_signature(run_dir)
+    data, status = load_rickshaw_run(run_dir, RESULT_TAG_KEYS)
 
     log_result_directory(run_dir, status, data)
 
@@ -704,12 +1788,20 @@ def run_results_tag_mode():
             if add_tags(data):
                 return 1
 
-            replace_rickshaw_run(run_dir, data)
+            if replace_rickshaw_run_tags(run_dir, data['tags']):
+                return 1
+            index_tagged_result(run_dir, signature, data['tags'])
         elif myglobal.args.action == "remove":
             if remove_tags(data):
                 return 1
 
-            replace_rickshaw_run(run_dir, data)
+            if replace_rickshaw_run_tags(run_dir, data['tags']):
+                return 1
+            index_tagged_result(run_dir, signature, data['tags'])
+        elif myglobal.args.action == "compact":
+            if compact_rickshaw_run(run_dir):
+                return 1
+            index_tagged_result(run_dir, signature, data.get('tags'))
     else:
         myglobal.log.error("Could not find a valid rickshaw-run.json[.xz]")
         return 1
@@ -717,22 +1809,249 @@ def run_results_tag_mode():
     return 0
 
 
+class capture_log_handler(logging.Handler):
+    '''Collect warnings and errors so they can be reported per result directory'''
+
+    def __init__(self):
+        super().__init__(level = logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def bulk_tag_result_directory(result_directory):
+    # this may run in a worker process so it does not touch the result
+    # index, the parent applies the index updates and reports the
+    # outcome from what is returned here
+    handler = capture_log_handler()
+    log = myglobal.log
+    myglobal.log = logging.getLogger(log.name + ".bulk")
+    myglobal.log.propagate = False
+    myglobal.log.addHandler(handler)
+
+    rc = 1
+    signature = None
+    tags = None
+    try:
+        if not validate_result_directory(result_directory):
+            signature = result_directory_signature(result_directory)
+            data, status = load_rickshaw_run(result_directory, [ 'tags' ])
+            if data is None:
+                myglobal.log.error("Could not find a valid rickshaw-run.json[.xz]")
+            elif myglobal.args.action == "ls":
+                rc = 0
+            elif myglobal.args.action == "add":
+                if not add_tags(data):
+                    rc = replace_rickshaw_run_tags(result_directory, data['tags'])
+            elif myglobal.args.action == "remove":
+                if not remove_tags(data):
+                    rc = replace_rickshaw_run_tags(result_directory, data['tags'])
+            elif myglobal.args.action == "compact":
+                rc = compact_rickshaw_run(result_directory)
+
+            if data is not None:
+                tags = data.get('tags')
+    except Exception as e:
+        myglobal.log.error("%s" % (e))
+        rc = 1
+    finally:
+        myglobal.log.removeHandler(handler)
+        myglobal.log = log
+
+    return rc, signature, tags, handler.messages
+
+
+def resolve_result_directory(name):
+    result_directory = Path(name)
+    if not result_directory.is_absolute():
+        result_directory = Path(myglobal.run_dir) / result_directory
+
+    return result_directory
+
+
+def bulk_tag_results():
+    if myglobal.args.stdin:
+        # an explicit list is used as given so that any bad entries
+        # show up as failures in the report
+        result_list = []
+        for line in sys.stdin:
+            line = line.strip()
+            if len(line) and not resolve_result_directory(line) in result_list:
+                result_list.append(resolve_result_directory(line))
+
+        return result_list
+
+    dir_list = []
+    if len(myglobal.args.globs):
+        for pattern in myglobal.args.globs:
+            dir_list.extend(Path(myglobal.run_dir).glob(pattern))
+    else:
+        dir_list.extend(Path(myglobal.run_dir).iterdir())
+
+    result_list = sorted(set(result for result in dir_list if result.name != "latest" and result.is_dir()))
+
+    if len(myglobal.args.filters):
+        if myglobal.result_index is not None:
+            result_list = filter_results_by_tags(result_list, myglobal.args.filters, match_all_filters())
+        else:
+            result_list = scan_results_by_tags(result_list, myglobal.args.filters, match_all_filters())
+
+    return result_list
+
+
+def run_results_bulk_tag_mode():
+    if not myglobal.args.stdin and not Path(myglobal.run_dir).is_dir():
+        myglobal.log.error("Invalid Crucible run results directory '%s'!" % (myglobal.run_dir))
+        return 1
+
+    result_list = bulk_tag_results()
+    if len(result_list) == 0:
+        myglobal.log.error("No result directories were selected")
+        return 1
+
+    # tag edits only touch the small overlay files but the first edit
+    # of a result still has to decompress its rickshaw-run, so spread
+    # the work over processes like ls does
+    jobs = min(get_jobs(), len(result_list))
+    if jobs > 1:
+        myglobal.log.debug("processing %d result directories with %d jobs" % (len(result_list), jobs))
+        outcomes = map_in_processes(bulk_tag_result_directory, jobs, result_list)
+    else:
+        outcomes = [ bulk_tag_result_directory(result) for result in result_list ]
+
+    failed = 0
+    for result, (rc, signature, tags, messages) in zip(result_list, outcomes):
+        if rc:
+            failed += 1
+            myglobal.log.info("%s: failed (%s)" % (result.name, "; ".join(messages)))
+            continue
+
+        if myglobal.args.action != "ls":
+            index_tagged_result(result, signature, tags)
+
+        if tags is not None:
+            myglobal.log.info("%s: ok [%s]" % (result.name, format_tags(tags)))
+        else:
+            myglobal.log.info("%s: ok" % (result.name))
+
+    myglobal.log.info("%d of %d result directories succeeded" % (len(result_list) - failed, len(result_list)))
+
+    if failed:
+        return 1
+
+    return 0
+
+
+def completion_source_dir():
+    if myglobal.args.type == "archive":
+        return Path(myglobal.archive_dir)
+
+    return Path(myglobal.run_dir)
+
+
+def open_completion_cache():
+    # the bash completion reads the cache file directly for as long as
+    # it is newer than the directory it was generated from, so capture
+    # the completion output (everything logged at INFO) into it
+    if not myglobal.args.cache_dir:
+        return None
+
+    try:
+        source_mtime = completion_source_dir().stat().st_mtime_ns
+        cache_dir = Path(myglobal.args.cache_dir)
+        cache_dir.mkdir(parents = True, exist_ok = True)
+        fd, tmp_path = tempfile.mkstemp(dir = cache_dir, prefix = ".%s." % (myglobal.args.type))
+    except OSError as e:
+        myglobal.log.debug("could not create completion cache: %s" % (e))
+        return None
+
+    handler = logging.StreamHandler(os.fdopen(fd, 'w'))
+    handler.setFormatter(logging.Formatter(myglobal.log_normal_format))
+    handler.addFilter(lambda record: record.levelno == logging.INFO)
+    myglobal.log.addHandler(handler)
+
+    return handler, Path(tmp_path), source_mtime
+
+
+def close_completion_cache(cache, rc):
+    if cache is None:
+        return 0
+
+    handler, tmp_path, source_mtime = cache
+    myglobal.log.removeHandler(handler)
+    handler.close()
+
+    try:
+        # StreamHandler.close() leaves the stream it was given open;
+        # closing it also flushes the listing before it is published
+        handler.stream.close()
+        # do not publish a listing that raced with a change to the
+        # directory it was generated from
+        if rc == 0 and completion_source_dir().stat().st_mtime_ns == source_mtime:
+            tmp_path.chmod(0o644)
+            tmp_path.replace(tmp_path.parent / myglobal.args.type)
+        else:
+            tmp_path.unlink()
+    except OSError as e:
+        myglobal.log.debug("could not update completion cache: %s" % (e))
+        try:
+            tmp_path.unlink()
+        except OSError:
+            pass
+        return 1
+
+    return 0
+
+
 def main():
     '''Primary base function'''
 
     process_options()
 
     if myglobal.args.mode == "ls" or myglobal.args.mode == "completion":
+        cache = None
+        if myglobal.args.mode == "completion":
+            cache = open_completion_cache()
+
+        if myglobal.args.mode == "ls" and myglobal.args.type != "usage" and usage_filtering():
+            myglobal.log.error("--sort, --min-size and --older-than require --type usage")
+            return 1
+
         if myglobal.args.type == "archive":
-            return archives_ls_mode()
+            if structured_output():
+                myglobal.log.error("--format %s is not supported with --type archive" % (myglobal.args.format))
+                return 1
+            rc = archives_ls_mode()
         else:
-            return run_results_ls_mode()
+            if not metadata_only():
+                open_result_index()
+            if structured_output():
+                open_ls_output()
+            rc = run_results_ls_mode()
+            if structured_output():
+                close_ls_output()
+            close_result_index()
+
+        close_completion_cache(cache, rc)
+        return rc
     elif myglobal.args.mode == "tags":
-        return run_results_tag_mode()
+        open_result_index()
+        if myglobal.args.result_dir is not None:
+            rc = run_results_tag_mode()
+        else:
+            rc = run_results_bulk_tag_mode()
+        close_result_index()
+        return rc
 
     return 0
 
 
 if __name__ == "__main__":
     myglobal = global_vars()
-    sys.exit(main())
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        # whatever was consuming a streamed listing stopped reading
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
@@ -0,0 +1,947 @@
+import importlib
+import io
+import json
+import os
+import queue
+import shutil
+import signal
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from contextlib import redirect_stdout
+from datetime import datetime
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _logger_lib.batching import BatchPolicy
+from _logger_lib import output_writer
+from _logger_lib.buffers import LineBuffer
+from _logger_lib.coldstore import BLOCK_LINES, decode_block, encode_block, pack_session
+from _logger_lib.follow import FollowListener, FollowNotifier, follow_dir
+from _logger_lib.output_writer import ConsoleWriter
+from _logger_lib.pipe_reader import pipe_reader, split_lines
+from _logger_lib.search import search_terms
+from _logger_lib.db import (
+    SCHEMA_VERSION, init_db, verify_db, setup_session, close_session, session_summary, LogInserter,
+    _run_migrations, get_stream_ids,
+)
+from _logger_lib import viewer as _logger_viewer
+from _logger_lib.viewer import clear_db, format_ts, prune_db, show_info, tidy_db, view_sessions
+
+# _logger installs its own SIGINT handler on import
+sigint_handler = signal.getsignal(signal.SIGINT)
+_logger = importlib.import_module("_logger")
+signal.signal(signal.SIGINT, sigint_handler)
+
+
+class RecordingInserter:
+    def __init__(self):
+        self.stream_ids = {"STDOUT": 1, "STDERR": 2}
+        self.commits = []
+        self.pending = []
+
+    def insert_many(self, rows):
+        self.pending.extend(rows)
+
+    def commit(self):
+        self.commits.append(self.pending)
+        self.pending = []
+
+
+class RecordingConsole:
+    def __init__(self):
+        self.lines = []
+
+    def write(self, stream_id, lines):
+        self.lines.extend((stream_id, line) for line in lines)
+
+
+class LoggerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp, "log.db")
+        init_db(self.db_path)
+        self.conn = verify_db(self.db_path)
+        _run_migrations(self.conn)
+        self.session = setup_session(self.conn, "console", "session-1", "crucible run foo.json")
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp)
+
+    def lines(self):
+        return self.conn.execute(
+            "SELECT l.timestamp, s.stream, l.line FROM lines l "
+            "JOIN streams s ON s.id = l.stream ORDER BY l.id"
+        ).fetchall()
+
+
+class TestDatabaseSetup(LoggerTestCase):
+
+    def test_wal_from_creation(self):
+        self.assertEqual(self.conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(self.conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+        self.assertEqual(self.conn.execute("PRAGMA busy_timeout").fetchone()[0], 30000)
+
+    def test_old_database_converted(self):
+        old_db = os.path.join(self.tmp, "old.db")
+        conn = sqlite3.connect(old_db)
+        conn.execute("CREATE TABLE db_state (timestamp REAL PRIMARY KEY NOT NULL)")
+        conn.commit()
+        conn.close()
+
+        conn = verify_db(old_db)
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        conn.close()
+
+    def test_concurrent_writers(self):
+        other = verify_db(self.db_path)
+        other_session = setup_session(other, "console", "session-2", "crucible ls")
+        first = LogInserter(self.conn, self.session)
+        second = LogInserter(other, other_session)
+
+        first.insert_many([(1.0, 1, "one")])
+        reader = verify_db(self.db_path)
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM lines").fetchone()[0], 0)
+        first.commit()
+        second.insert_many([(2.0, 1, "two")])
+        second.commit()
+        self.assertEqual(reader.execute("SELECT COUNT(*) FROM lines").fetchone()[0], 2)
+        reader.close()
+        other.close()
+
+
+    def test_migration_adds_overflow_columns(self):
+        old_db = os.path.join(self.tmp, "old.db")
+        init_db(old_db)
+        conn = verify_db(old_db)
+        conn.executescript(
+            "CREATE TABLE schema_version (version INTEGER PRIMARY KEY NOT NULL);"
+            "INSERT INTO schema_version (version) VALUES (1);"
+        )
+        session = setup_session(conn, "console", "old-session", "crucible ls")
+        latest = setup_session(conn, "console", "maybe-running", "crucible run foo.json")
+
+        _run_migrations(conn)
+        _run_migrations(conn)
+        self.assertEqual(conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0], SCHEMA_VERSION)
+        # sessions from before the migration count as closed, except
+        # the latest, which an older logger may still be writing
+        self.assertEqual(
+            conn.execute("SELECT id, dropped_lines, spilled_lines, closed_timestamp IS NOT NULL "
+                         "FROM sessions ORDER BY id").fetchall(),
+            [(session, 0, 0, 1), (latest, 0, 0, 0)],
+        )
+        conn.close()
+
+    def test_session_overflow_in_info(self):
+        close_session(self.conn, self.session, 5, 100)
+        other = setup_session(self.conn, "console", "session-2", "crucible ls")
+        close_session(self.conn, other, 0, 20)
+
+        output = io.StringIO()
+        with redirect_stdout(output):
+            show_info(self.conn, output_format="json")
+        info = json.loads(output.getvalue())
+        self.assertEqual(
+            (info["dropped_lines"], info["dropped_sessions"], info["spilled_lines"], info["spilled_sessions"]),
+            (5, 1, 120, 2),
+        )
+
+
+class TestLogInserter(LoggerTestCase):
+
+    def test_stream_ids(self):
+        inserter = LogInserter(self.conn, self.session)
+        self.assertEqual(inserter.stream_ids, {"STDOUT": 1, "STDERR": 2})
+
+    def test_insert_many(self):
+        inserter = LogInserter(self.conn, self.session)
+        inserter.insert_many([
+            (1.0, inserter.stream_ids["STDOUT"], "one"),
+            (2.0, inserter.stream_ids["STDERR"], "two"),
+        ])
+        inserter.insert(3.0, "STDOUT", "three")
+        inserter.commit()
+
+        self.assertEqual(self.lines(), [
+            (1.0, "STDOUT", "one"),
+            (2.0, "STDERR", "two"),
+            (3.0, "STDOUT", "three"),
+        ])
+
+    def test_rollback(self):
+        inserter = LogInserter(self.conn, self.session)
+        inserter.insert_many([(1.0, 1, "one")])
+        inserter.rollback()
+        self.assertEqual(self.lines(), [])
+
+
+class TestColdStorage(LoggerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        inserter = LogInserter(self.conn, self.session)
+        inserter.insert_many([
+            (1000.0 + i * 0.5, 1 if i % 3 else 2, f"line {i} caf\u00e9" if i % 10 else f"ERROR {i}")
+            for i in range(BLOCK_LINES + 100)
+        ])
+        inserter.commit()
+
+    def view(self, **kwargs):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            view_sessions(self.conn, **kwargs)
+        return output.getvalue()
+
+    def test_block_roundtrip(self):
+        rows = [(1.5, 1, "one"), (2.25, 2, ""), (3.0, 1, "caf\u00e9 \r three")]
+        for codec in ("zlib", "lzma"):
+            self.assertEqual(decode_block(encode_block(rows, codec), codec), rows)
+        self.assertEqual(decode_block(encode_block([], "zlib"), "zlib"), [])
+
+    def test_pack_session(self):
+        views = [
+            {},
+            {"grep_pattern": "ERROR", "stream_filter": "stderr"},
+            {"since": 1100.0, "until": 2100.0, "tail": 3},
+            {"head": 5, "raw": True},
+            {"output_format": "json", "grep_pattern": "9 caf"},
+            {"count_only": True, "since": 2000.0},
+        ]
+        before = [self.view(**kwargs) for kwargs in views]
+
+        self.assertEqual(pack_session(self.conn, self.session), BLOCK_LINES + 100)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM lines").fetchone()[0], 0)
+        # the pages the rows took are not left on the freelist
+        self.assertEqual(self.conn.execute("PRAGMA freelist_count").fetchone()[0], 0)
+        self.assertEqual(
+            self.conn.execute("SELECT COUNT(*), SUM(line_count) FROM line_blocks").fetchone(),
+            (2, BLOCK_LINES + 100),
+        )
+        self.assertEqual([self.view(**kwargs) for kwargs in views], before)
+
+    def test_count_head_tail(self):
+        # setUp's lines are half a second apart, two in three on stdout
+        for packed in (False, True):
+            if packed:
+                pack_session(self.conn, self.session)
+            self.assertEqual(self.view(count_only=True), f"{BLOCK_LINES + 100}\n")
+            self.assertEqual(
+                self.view(count_only=True, stream_filter="stdout", since=1000.0 + 4000 * 0.5),
+                f"{sum(1 for i in range(4000, BLOCK_LINES + 100) if i % 3)}\n",
+            )
+            self.assertEqual(self.view(count_only=True, until=999.0), "0\n")
+
+            tail = self.view(raw=True, tail=3).splitlines()
+            self.assertEqual(tail[-3:], [f"line {i} caf\u00e9" for i in range(BLOCK_LINES + 97, BLOCK_LINES + 100)])
+            head_tail = self.view(raw=True, head=5, tail=2, output_format="json").splitlines()
+            self.assertEqual([json.loads(line)["line"] for line in head_tail], ["line 3 caf\u00e9", "line 4 caf\u00e9"])
+
+    def test_chunked_output(self):
+        # more lines than one fetchmany() or one block returns
+        expected = [
+            json.dumps({"session_id": "session-1", "timestamp": 1000.0 + i * 0.5,
+                        "stream": "STDOUT" if i % 3 else "STDERR",
+                        "line": f"line {i} caf\u00e9" if i % 10 else f"ERROR {i}"})
+            for i in range(BLOCK_LINES + 100)
+        ]
+        for packed in (False, True):
+            if packed:
+                pack_session(self.conn, self.session)
+            self.assertEqual(self.view(output_format="json").splitlines(), expected)
+            plain = self.view().splitlines()
+            self.assertEqual(len(plain), 7 + BLOCK_LINES + 100)
+            self.assertEqual(plain[7], f"[{format_ts(1000.0)}][STDERR] ERROR 0")
+            self.assertEqual(plain[-1], f"[{format_ts(1000.0 + (BLOCK_LINES + 99) * 0.5)}][STDOUT] "
+                                        f"line {BLOCK_LINES + 99} caf\u00e9")
+
+    def test_format_ts(self):
+        for epoch in (1000.0, 1000.25, 1718000000.999, 1718000000.9999997):
+            second = datetime.fromtimestamp(int(epoch)).strftime("%Y-%m-%d %H:%M:%S")
+            self.assertEqual(format_ts(epoch), f"{second}.{int((epoch - int(epoch)) * 1000):03d}")
+
+    def test_session_summary(self):
+        expected = (1000.0, 1000.0 + (BLOCK_LINES + 99) * 0.5,
+                    sum(1 for i in range(BLOCK_LINES + 100) if i % 3), len(range(0, BLOCK_LINES + 100, 3)))
+        self.assertEqual(session_summary(self.conn, self.session), expected)
+        pack_session(self.conn, self.session)
+        self.assertEqual(session_summary(self.conn, self.session), expected)
+
+        # sessions closed before the summary existed get it from tidy
+        close_session(self.conn, self.session)
+        self.conn.execute("UPDATE sessions SET first_line_timestamp = NULL, last_line_timestamp = NULL, "
+                          "stdout_lines = NULL, stderr_lines = NULL")
+        self.conn.commit()
+        with redirect_stdout(io.StringIO()):
+            tidy_db(self.conn)
+        self.assertEqual(
+            self.conn.execute("SELECT first_line_timestamp, last_line_timestamp, stdout_lines, stderr_lines "
+                              "FROM sessions").fetchone(),
+            expected,
+        )
+        self.assertIn("duration:    34m57s", self.view(head=1))
+
+    def test_tidy_packs_closed_sessions(self):
+        open_session = setup_session(self.conn, "console", "session-2", "crucible ls")
+        LogInserter(self.conn, open_session).insert_many([(5000.0, 1, "still running")])
+        self.conn.commit()
+        close_session(self.conn, self.session)
+
+        # cold storage turned off: tidy leaves the lines alone too
+        with patch.dict(os.environ, {"CRUCIBLE_LOG_COLD_STORAGE": "0"}), redirect_stdout(io.StringIO()):
+            tidy_db(self.conn)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM line_blocks").fetchone()[0], 0)
+
+        with redirect_stdout(io.StringIO()):
+            tidy_db(self.conn)
+        self.assertEqual(
+            self.conn.execute("SELECT session, COUNT(*) FROM lines GROUP BY session").fetchall(),
+            [(open_session, 1)],
+        )
+        self.assertEqual(
+            self.conn.execute("SELECT DISTINCT session FROM line_blocks").fetchall(),
+            [(self.session,)],
+        )
+
+
+class TestPrune(LoggerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # five closed sessions a day apart, the first one ten days old,
+        # plus the one from LoggerTestCase that is still open
+        now = time.time()
+        self.closed = []
+        for day in range(5):
+            session = setup_session(self.conn, "console", f"old-{day}", f"crucible run {day}.json")
+            LogInserter(self.conn, session).insert_many([
+                (now, 1, f"{day} {i} " + "x" * 200) for i in range(2000)
+            ])
+            self.conn.commit()
+            close_session(self.conn, session)
+            self.conn.execute("UPDATE sessions SET timestamp = ? WHERE id = ?",
+                              (now - (10 - day) * 86400, session))
+            self.closed.append(session)
+        self.conn.execute("UPDATE sessions SET timestamp = ? WHERE id = ?", (now - 20 * 86400, self.session))
+        self.conn.commit()
+
+    def prune(self, **kwargs):
+        with redirect_stdout(io.StringIO()):
+            prune_db(self.conn, db_path=self.db_path, **kwargs)
+
+    def sessions(self):
+        return [row[0] for row in self.conn.execute("SELECT id FROM sessions ORDER BY id")]
+
+    def test_older_than(self):
+        self.prune(older_than=time.time() - 7.5 * 86400)
+        self.assertEqual(self.sessions(), [self.session] + self.closed[3:])
+        self.assertEqual(
+            self.conn.execute("SELECT COUNT(*) FROM lines").fetchone()[0], 2 * 2000,
+        )
+        self.assertEqual(
+            self.conn.execute("SELECT COUNT(*) FROM commands").fetchone()[0], 3,
+        )
+
+    def test_max_size_shrinks_file(self):
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size = os.path.getsize(self.db_path)
+        self.prune(max_size=size // 2)
+        self.assertLess(os.path.getsize(self.db_path), size // 2)
+        remaining = self.sessions()
+        self.assertIn(self.session, remaining)
+        # oldest first
+        self.assertEqual(remaining[1:], self.closed[len(self.closed) - len(remaining) + 1:])
+
+    def test_open_sessions_are_kept(self):
+        self.prune(older_than=time.time(), max_size=0)
+        self.assertEqual(self.sessions(), [self.session])
+
+    def test_max_size_with_search_index(self):
+        # varied text, so the index is a good part of the file
+        with patch.dict(os.environ, {"CRUCIBLE_LOG_SEARCH_INDEX": "1"}):
+            for day in range(4):
+                session = setup_session(self.conn, "console", f"indexed-{day}", "crucible ls")
+                inserter = LogInserter(self.conn, session)
+                for chunk in range(10):
+                    inserter.insert_many([
+                        (time.time(), 1, f"{day} {chunk} {i} {os.urandom(24).hex()}") for i in range(200)
+                    ])
+                    inserter.commit()
+                close_session(self.conn, session)
+        self.assertEqual(
+            self.conn.execute("SELECT COUNT(*) FROM search_chunks WHERE session > ?",
+                              (self.closed[-1],)).fetchone()[0],
+            40,
+        )
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        size = os.path.getsize(self.db_path)
+
+        # removing sessions from the index must not make it grow, or
+        # prune deletes every session and is still over the limit; and
+        # the index is merged once, not once per session
+        optimize = _logger_viewer.optimize_search_index
+        with patch.object(_logger_viewer, "optimize_search_index", side_effect=optimize) as merges:
+            self.prune(max_size=size // 3)
+        self.assertEqual(merges.call_count, 1)
+        self.assertLess(os.path.getsize(self.db_path), size // 3)
+        remaining = self.sessions()
+        self.assertGreater(len(remaining), 1)
+        self.assertEqual(
+            self.conn.execute("SELECT COUNT(*) FROM search_chunks "
+                              "WHERE session NOT IN (SELECT id FROM sessions)").fetchone()[0],
+            0,
+        )
+        self.conn.execute("INSERT INTO line_search (line_search) VALUES ('integrity-check')")
+
+
+class TestSearchIndex(LoggerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # the index is opt-in
+        env = patch.dict(os.environ, {"CRUCIBLE_LOG_SEARCH_INDEX": "1"})
+        env.start()
+        self.addCleanup(env.stop)
+        # one chunk per insert_many(), only the third one has the needle
+        inserter = LogInserter(self.conn, self.session)
+        for chunk in range(5):
+            inserter.insert_many([
+                (1000.0 + chunk * 100 + i, 1 if i % 4 else 2,
+                 f"chunk {chunk} line {i}" + (" needle[1]" if chunk == 2 and i % 10 == 0 else ""))
+                for i in range(100)
+            ])
+            inserter.commit()
+        close_session(self.conn, self.session)
+
+    def view(self, **kwargs):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            view_sessions(self.conn, **kwargs)
+        return output.getvalue()
+
+    def scanned(self, **kwargs):
+        self.conn.execute("UPDATE sessions SET search_indexed = 0")
+        self.conn.commit()
+        try:
+            return self.view(**kwargs)
+        finally:
+            self.conn.execute("UPDATE sessions SET search_indexed = 1")
+            self.conn.commit()
+
+    def test_search_terms(self):
+        self.assertEqual(search_terms("ERROR"), ["ERROR"])
+        self.assertEqual(search_terms(r"^alpha.*#1[0-9]$"), ["alpha"])
+        self.assertEqual(search_terms(r"colou?r \d+ items?"), ["colo", " item"])
+        self.assertEqual(search_terms(r"needle\[1\]"), ["needle[1]"])
+        self.assertIsNone(search_terms("ERROR|WARNING"))
+        self.assertIsNone(search_terms("(?i)error"))
+        self.assertIsNone(search_terms("ab.cd"))
+
+    def test_grep_matches_scan(self):
+        self.assertEqual(self.conn.execute("SELECT search_indexed FROM sessions").fetchone()[0], 1)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM search_chunks").fetchone()[0], 5)
+        views = [
+            {"grep_pattern": r"needle\[1\]"},
+            {"grep_pattern": "needle", "stream_filter": "stderr"},
+            {"grep_pattern": "line 9", "since": 1150.0, "until": 1350.0},
+            {"grep_pattern": "chunk 2 line 5.", "output_format": "json"},
+            {"grep_pattern": "nowhere to be found", "count_only": True},
+        ]
+        for packed in (False, True):
+            if packed:
+                pack_session(self.conn, self.session)
+            for kwargs in views:
+                self.assertEqual(self.view(**kwargs), self.scanned(**kwargs), kwargs)
+        self.assertEqual(self.view(grep_pattern="needle", count_only=True), "10\n")
+
+    def test_off_by_default(self):
+        with patch.dict(os.environ):
+            os.environ.pop("CRUCIBLE_LOG_SEARCH_INDEX")
+            session = setup_session(self.conn, "console", "session-2", "crucible ls")
+            inserter = LogInserter(self.conn, session)
+            inserter.insert_many([(5000.0, 1, "needle in session 2")])
+            inserter.commit()
+        self.assertEqual(
+            self.conn.execute("SELECT search_indexed FROM sessions WHERE id = ?", (session,)).fetchone()[0], 0,
+        )
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM search_chunks").fetchone()[0], 5)
+        self.assertEqual(self.view(grep_pattern="needle", count_only=True), "11\n")
+
+    def test_prune_and_clear_remove_entries(self):
+        pack_session(self.conn, self.session)
+        other = setup_session(self.conn, "console", "session-2", "crucible ls")
+        inserter = LogInserter(self.conn, other)
+        inserter.insert_many([(5000.0, 1, "needle in session 2")])
+        inserter.commit()
+        close_session(self.conn, other)
+
+        with redirect_stdout(io.StringIO()):
+            prune_db(self.conn, older_than=time.time() + 1, max_size=None)
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM search_chunks").fetchone()[0], 0)
+        self.assertEqual(
+            self.conn.execute("SELECT COUNT(*) FROM line_search WHERE line_search MATCH 'needle'").fetchone()[0],
+            0,
+        )
+        self.conn.execute("INSERT INTO line_search (line_search) VALUES ('integrity-check')")
+
+        LogInserter(self.conn, setup_session(self.conn, "console", "session-3", "crucible ls")).insert_many(
+            [(6000.0, 1, "needle again")]
+        )
+        self.conn.commit()
+        with redirect_stdout(io.StringIO()):
+            clear_db(self.conn)
+        self.assertEqual(
+            self.conn.execute("SELECT COUNT(*) FROM line_search WHERE line_search MATCH 'needle'").fetchone()[0],
+            0,
+        )
+
+
+class TestSessionSummary(LoggerTestCase):
+
+    def test_inserter_summary(self):
+        inserter = LogInserter(self.conn, self.session)
+        inserter.insert_many([(12.0, 1, "b"), (11.0, 2, "a")])
+        inserter.insert_many([(13.0, 1, "c")])
+        inserter.insert_many([])
+        inserter.commit()
+        self.assertEqual(inserter.summary(), (11.0, 13.0, 2, 1))
+        self.assertEqual(inserter.summary(), session_summary(self.conn, self.session))
+
+        # what view and sessions show comes from the recorded summary
+        close_session(self.conn, self.session, summary=(10.0, 70.0, 5, 6))
+        output = io.StringIO()
+        with redirect_stdout(output):
+            view_sessions(self.conn, count_only=True)
+            view_sessions(self.conn, count_only=True, stream_filter="stderr", since=1.0)
+            view_sessions(self.conn, head=1)
+        self.assertEqual(output.getvalue().splitlines()[:2], ["11", "6"])
+        self.assertIn("duration:    1m00s", output.getvalue())
+
+
+class TestFollow(LoggerTestCase):
+
+    def test_notify_wakes_listener(self):
+        listener = FollowListener(self.db_path)
+        notifier = FollowNotifier(self.db_path)
+        try:
+            self.assertIsNotNone(listener.path)
+            start = time.monotonic()
+            notifier.notify()
+            notifier.notify()
+            listener.wait(5.0)
+            self.assertLess(time.monotonic() - start, 1.0)
+
+            # both wake-ups were drained by the first wait
+            start = time.monotonic()
+            listener.wait(0.1)
+            self.assertGreaterEqual(time.monotonic() - start, 0.1)
+        finally:
+            notifier.close()
+            listener.close()
+        self.assertEqual(os.listdir(follow_dir(self.db_path)), [])
+
+    def test_stale_socket_removed(self):
+        listener = FollowListener(self.db_path)
+        # a follower killed before it could clean up leaves its socket
+        listener._sock.close()
+        listener._sock = None
+
+        notifier = FollowNotifier(self.db_path)
+        notifier.notify()
+        notifier.close()
+        self.assertFalse(os.path.exists(listener.path))
+
+    def test_follow_reads_only_new_lines(self):
+        inserter = LogInserter(self.conn, self.session)
+        stdout, stderr = inserter.stream_ids["STDOUT"], inserter.stream_ids["STDERR"]
+        inserter.insert_many([(1000.0, stdout, "old line")])
+        inserter.commit()
+        other = setup_session(self.conn, "console", "session-2", "crucible run bar.json")
+
+        batches = [
+            [(self.session, 1001.0, stdout, "new line"), (other, 1001.5, stdout, "other session"),
+             (self.session, 1002.0, stderr, "new error")],
+            [(self.session, 1003.0, stdout, "newest line")],
+        ]
+
+        def commit_more(listener, timeout):
+            if not batches:
+                raise KeyboardInterrupt
+            self.conn.executemany(
+                "INSERT INTO lines (session, timestamp, stream, line) VALUES (?, ?, ?, ?)",
+                batches.pop(0),
+            )
+
+        # follow mode switches stdout to line buffering
+        out = io.TextIOWrapper(io.BytesIO())
+        with patch.object(FollowListener, "wait", commit_more), patch("sys.stdout", out):
+            view_sessions(self.conn, filter_cmd="sessionid", filter_arg="session-1",
+                          grep_pattern="new", follow=True, output_format="json",
+                          db_path=self.db_path)
+        out.flush()
+
+        rows = [json.loads(line) for line in out.buffer.getvalue().decode().splitlines() if line]
+        self.assertEqual([(row["line"], row["stream"]) for row in rows], [
+            ("new line", "STDOUT"), ("new error", "STDERR"), ("newest line", "STDOUT"),
+        ])
+        self.assertEqual(os.listdir(follow_dir(self.db_path)), [])
+
+    def test_follow_across_pack(self):
+        # a session packed before this follower started is shown once,
+        # by the dump that comes before following
+        old = setup_session(self.conn, "console", "session-0", "crucible run old.json")
+        self.conn.execute("INSERT INTO lines (session, timestamp, stream, line) VALUES (?, 999.0, 1, 'old line')",
+                          (old,))
+        self.conn.commit()
+        close_session(self.conn, old)
+        pack_session(self.conn, old)
+
+        # the logger writes from its own connection
+        writer = verify_db(self.db_path)
+        other = setup_session(writer, "console", "session-2", "crucible run bar.json")
+        stdout = get_stream_ids(writer)["STDOUT"]
+
+        def insert(*rows):
+            writer.executemany("INSERT INTO lines (session, timestamp, stream, line) VALUES (?, ?, ?, ?)",
+                               [(session, ts, stdout, line) for session, ts, line in rows])
+            writer.commit()
+
+        def close_and_pack():
+            # what the logger does as it exits, before the follower
+            # gets to read the last lines from `lines`
+            close_session(writer, self.session)
+            pack_session(writer, self.session)
+
+        batches = [
+            lambda: insert((self.session, 1000.0, "a1"), (self.session, 1000.5, "a2")),
+            lambda: (insert((self.session, 1001.0, "a3"), (other, 1001.5, "b1"), (self.session, 1002.0, "a4")),
+                     close_and_pack()),
+            lambda: insert((other, 1003.0, "b2")),
+        ]
+
+        def commit_more(listener, timeout):
+            if not batches:
+                raise KeyboardInterrupt
+            batches.pop(0)()
+
+        out = io.TextIOWrapper(io.BytesIO())
+        try:
+            with patch.object(FollowListener, "wait", commit_more), patch("sys.stdout", out):
+                view_sessions(self.conn, follow=True, output_format="json", db_path=self.db_path)
+        finally:
+            writer.close()
+        out.flush()
+
+        rows = [json.loads(line) for line in out.buffer.getvalue().decode().splitlines() if line]
+        self.assertEqual([(row["session_id"], row["line"]) for row in rows], [
+            ("session-0", "old line"), ("session-1", "a1"), ("session-1", "a2"), ("session-1", "a3"), ("session-2", "b1"),
+            ("session-1", "a4"), ("session-2", "b2"),
+        ])
+        self.assertEqual(self.conn.execute("SELECT COUNT(*) FROM lines WHERE session = ?",
+                                           (self.session,)).fetchone()[0], 0)
+
+
+class TestBatchPolicy(unittest.TestCase):
+
+    def test_caps(self):
+        policy = BatchPolicy(max_rows=100, max_age=0.5, idle=0.01)
+        self.assertFalse(policy.should_flush(0, 10.0, 0))
+        self.assertTrue(policy.should_flush(100, 0.0, 50))
+        self.assertTrue(policy.should_flush(1, 0.5, 50))
+        self.assertFalse(policy.should_flush(99, 0.1, 50))
+        self.assertFalse(policy.should_flush(99, 0.1, 0))
+
+    def test_wait_timeout(self):
+        policy = BatchPolicy(max_rows=100, max_age=0.5, idle=0.01)
+        self.assertIsNone(policy.wait_timeout(0, 0.0))
+        self.assertEqual(policy.wait_timeout(1, 0.0), 0.01)
+        self.assertAlmostEqual(policy.wait_timeout(1, 0.495), 0.005)
+        self.assertEqual(policy.wait_timeout(1, 1.0), 0.0)
+
+    def test_from_env(self):
+        with patch.dict(os.environ, {"CRUCIBLE_LOG_BATCH_MAX_ROWS": "5", "CRUCIBLE_LOG_BATCH_MAX_AGE": "bogus"}):
+            policy = BatchPolicy.from_env()
+        self.assertEqual(policy.max_rows, 5)
+        self.assertEqual(policy.max_age, 0.5)
+
+
+class TestLineBuffer(unittest.TestCase):
+
+    def drain(self, buf):
+        items = []
+        while True:
+            item = buf.get(timeout=0)
+            if item is None:
+                return items
+            items.append(item)
+
+    def test_spill_keeps_order(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        buf = LineBuffer(capacity=10, overflow="spill", spill_dir=tmp)
+        for i in range(35):
+            buf.put(i)
+        buf.put(None)
+
+        self.assertEqual(buf.qsize(), 36)
+        self.assertEqual(buf.spilled, 25)
+        self.assertEqual(buf.dropped, 0)
+        self.assertEqual(self.drain(buf), list(range(35)))
+
+        # once the spill file has been read back the buffer works from
+        # memory again
+        buf.put("again")
+        self.assertEqual(buf.get_nowait(), "again")
+        self.assertEqual(buf.spilled, 25)
+        buf.close()
+
+    def test_drop_oldest(self):
+        buf = LineBuffer(capacity=10, overflow="drop-oldest")
+        for i in range(35):
+            buf.put(i)
+        buf.put(None)
+
+        self.assertEqual(buf.dropped, 25)
+        self.assertEqual(buf.spilled, 0)
+        self.assertEqual(self.drain(buf), list(range(25, 35)))
+
+    def test_block(self):
+        buf = LineBuffer(capacity=10, overflow="block")
+        producer = threading.Thread(target=lambda: [buf.put(i) for i in list(range(35)) + [None]])
+        producer.start()
+        time.sleep(0.05)
+        # the producer is held at capacity until the consumer takes some
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(buf.qsize(), 10)
+
+        items = []
+        while not items or items[-1] is not None:
+            items.extend(buf.get_many(4, timeout=5))
+        producer.join()
+        self.assertEqual(items, list(range(35)) + [None])
+        self.assertEqual((buf.dropped, buf.spilled), (0, 0))
+
+    def test_empty(self):
+        buf = LineBuffer(capacity=10)
+        self.assertRaises(queue.Empty, buf.get_nowait)
+        self.assertRaises(queue.Empty, buf.get, timeout=0.01)
+
+    def test_from_env(self):
+        with patch.dict(os.environ, {"CRUCIBLE_LOG_DB_BUFFER_LINES": "7", "CRUCIBLE_LOG_DB_BUFFER_OVERFLOW": "bogus"}):
+            buf = LineBuffer.from_env("CRUCIBLE_LOG_DB_BUFFER")
+        self.assertEqual(buf.capacity, 7)
+        self.assertEqual(buf.overflow, "spill")
+
+
+class TestPipeReader(unittest.TestCase):
+
+    def test_split_lines(self):
+        self.assertEqual(split_lines(b"one\ntwo\r\nthr"), ([b"one", b"two"], b"thr", False))
+        self.assertEqual(split_lines(b"partial"), ([], b"partial", False))
+        self.assertEqual(
+            split_lines(b"a\nb\nSTDOUT->CRUCIBLE_CLOSE_LOG_PIPE\nc\n"),
+            ([b"a", b"b"], b"", True),
+        )
+
+    def test_reads_both_pipes(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        stdout_pipe = os.path.join(tmp, "stdout")
+        stderr_pipe = os.path.join(tmp, "stderr")
+        os.mkfifo(stdout_pipe)
+        os.mkfifo(stderr_pipe)
+
+        def feed(pipe_path, data):
+            with open(pipe_path, "wb") as fh:
+                fh.write(data)
+
+        feeders = [
+            threading.Thread(target=feed, args=(stdout_pipe, b"".join(b"out %d\n" % i for i in range(5000))
+                                                + b"STDOUT->CRUCIBLE_CLOSE_LOG_PIPE\n")),
+            # no close marker and no final newline: EOF ends the stream
+            threading.Thread(target=feed, args=(stderr_pipe, b"caf\xc3\xa9\nlast")),
+        ]
+        for feeder in feeders:
+            feeder.start()
+
+        msgs = []
+
+        def handle_lines(stream, stream_id, ts, lines):
+            msgs.extend((ts, stream, stream_id, line) for line in lines)
+
+        idle = []
+        pipe_reader(stdout_pipe, stderr_pipe, handle_lines, on_idle=lambda: idle.append(len(msgs)))
+        for feeder in feeders:
+            feeder.join()
+
+        self.assertEqual([line for ts, stream, stream_id, line in msgs if stream == "STDOUT"],
+                         [b"out %d" % i for i in range(5000)])
+        self.assertEqual([(stream_id, line) for ts, stream, stream_id, line in msgs if stream == "STDERR"],
+                         [(1, b"caf\xc3\xa9"), (1, b"last")])
+        # the last idle call comes after everything was handled
+        self.assertEqual(idle[-1], len(msgs))
+
+
+class TestConsoleWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.out_r, self.out_w = os.pipe()
+        self.err_r, self.err_w = os.pipe()
+        for fd in (self.out_r, self.err_r):
+            os.set_blocking(fd, False)
+        self.writes = []
+        write = os.write
+        writev = os.writev
+
+        def counting_write(fd, data):
+            self.writes.append(fd)
+            return write(fd, data)
+
+        def counting_writev(fd, buffers):
+            self.writes.append(fd)
+            return writev(fd, buffers)
+
+        for name, func in [("write", counting_write), ("writev", counting_writev)]:
+            patcher = patch.object(output_writer.os, name, func)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for fd in (self.out_r, self.out_w, self.err_r, self.err_w):
+            os.close(fd)
+
+    def read(self, fd):
+        try:
+            return os.read(fd, 65536)
+        except BlockingIOError:
+            return b""
+
+    def test_batch_is_one_write(self):
+        console = ConsoleWriter(self.out_w, self.err_w, max_delay=60)
+        console.write(0, [b"one", b"two"])
+        console.write(0, [b"three"])
+        self.assertEqual(self.read(self.out_r), b"")
+
+        console.flush()
+        self.assertEqual(self.read(self.out_r), b"one\r\ntwo\r\nthree\r\n")
+        self.assertEqual(self.writes, [self.out_w])
+
+    def test_streams_stay_interleaved(self):
+        console = ConsoleWriter(self.out_w, self.err_w, max_delay=60)
+        console.write(0, [b"out"])
+        console.write(1, [b"err"])
+        # switching streams wrote out the pending stdout lines first
+        self.assertEqual(self.writes, [self.out_w])
+        console.write(0, [b"out again"])
+        console.flush()
+
+        self.assertEqual(self.writes, [self.out_w, self.err_w, self.out_w])
+        self.assertEqual(self.read(self.out_r), b"out\r\nout again\r\n")
+        self.assertEqual(self.read(self.err_r), b"err\r\n")
+
+    def test_caps(self):
+        console = ConsoleWriter(self.out_w, self.err_w, max_delay=60, max_bytes=10)
+        console.write(0, [b"12345678"])
+        self.assertEqual(self.writes, [self.out_w])
+
+        console = ConsoleWriter(self.out_w, self.err_w, max_delay=0)
+        console.write(0, [b"now"])
+        self.assertEqual(self.read(self.out_r), b"12345678\r\nnow\r\n")
+
+    def test_short_writes(self):
+        written = []
+
+        def short_writev(fd, buffers):
+            data = b"".join(buffers)[:3]
+            written.append(data)
+            return len(data)
+
+        def short_write(fd, data):
+            return short_writev(fd, [data])
+
+        with patch.object(output_writer.os, "writev", short_writev), \
+             patch.object(output_writer.os, "write", short_write):
+            output_writer.writev_all(self.out_w, [b"ab", b"cdef", b"g"])
+            output_writer.writev_all(self.out_w, [b"single"])
+        self.assertEqual(written, [b"abc", b"def", b"g", b"sin", b"gle"])
+
+
+class TestDbWriter(unittest.TestCase):
+
+    def test_burst_coalesces(self):
+        db_queue = LineBuffer(capacity=100)
+        for i in range(1000):
+            db_queue.put((float(i), "STDOUT" if i % 2 else "STDERR", i % 2, f"line {i}".encode()))
+        db_queue.put(None)
+
+        inserter = RecordingInserter()
+        _logger.db_writer(db_queue, inserter, BatchPolicy(max_rows=400))
+        self.assertEqual([len(rows) for rows in inserter.commits], [400, 400, 200])
+        self.assertEqual(inserter.commits[0][0], (0.0, 2, "line 0"))
+        self.assertEqual(inserter.commits[2][-1], (999.0, 1, "line 999"))
+        self.assertEqual(db_queue.spilled, 900)
+
+    def test_lines_decoded_once_at_insert(self):
+        db_queue = LineBuffer(capacity=10)
+        db_queue.put((1.0, "STDOUT", 0, "caf\u00e9".encode()))
+        db_queue.put((2.0, "STDERR", 1, b"bad \xff byte"))
+        db_queue.put(None)
+
+        inserter = RecordingInserter()
+        _logger.db_writer(db_queue, inserter, BatchPolicy())
+        self.assertEqual(inserter.commits, [[(1.0, 1, "caf\u00e9"), (2.0, 2, "bad \ufffd byte")]])
+
+    def test_idle_commits(self):
+        db_queue = LineBuffer(capacity=10)
+        inserter = RecordingInserter()
+        writer = threading.Thread(target=_logger.db_writer,
+                                  args=(db_queue, inserter, BatchPolicy(max_age=5.0, idle=0.02)))
+        writer.start()
+        db_queue.put((1.0, "STDOUT", 0, b"first"))
+        time.sleep(0.2)
+        self.assertEqual(inserter.commits, [[(1.0, 1, "first")]])
+        db_queue.put((2.0, "STDOUT", 0, b"second"))
+        db_queue.put(None)
+        writer.join()
+
+        self.assertEqual([len(rows) for rows in inserter.commits], [1, 1])
+
+    def test_slow_commit_does_not_stall_console(self):
+        db_queue = LineBuffer(capacity=10)
+        release = threading.Event()
+
+        class BlockedInserter(RecordingInserter):
+            def commit(self):
+                release.wait()
+                super().commit()
+
+        inserter = BlockedInserter()
+        writer = threading.Thread(target=_logger.db_writer,
+                                  args=(db_queue, inserter, BatchPolicy(max_rows=5)))
+        writer.start()
+
+        console = RecordingConsole()
+        for i in range(10):
+            _logger.handle_lines(console, db_queue, "STDOUT", 0, float(i), [b"line %d" % i, b"more %d" % i])
+
+        # every line reached the console while the database is stuck,
+        # the overflow went to the spill file
+        self.assertEqual(len(console.lines), 20)
+        self.assertEqual(inserter.commits, [])
+
+        db_queue.put(None)
+        release.set()
+        writer.join()
+        self.assertEqual(sum(len(rows) for rows in inserter.commits), 20)
+        self.assertGreater(db_queue.spilled, 0)
+        db_queue.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
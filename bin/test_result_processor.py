@@ -0,0 +1,668 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import lzma
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import unittest.mock
+from pathlib import Path
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "result-processor.py")
+spec = importlib.util.spec_from_file_location("result_processor", MODULE_PATH)
+result_processor = importlib.util.module_from_spec(spec)
+# registered so that process pool workers can resolve module level functions
+sys.modules["result_processor"] = result_processor
+spec.loader.exec_module(result_processor)
+
+
+def write_rickshaw_run(result_dir, data, subdir="run", compress=True):
+    path = Path(result_dir) / subdir
+    path.mkdir(parents=True, exist_ok=True)
+    if compress:
+        with lzma.open(path / "rickshaw-run.json.xz", "wt") as f:
+            json.dump(data, f, indent=4, sort_keys=True)
+    else:
+        with open(path / "rickshaw-run.json", "wt") as f:
+            json.dump(data, f, indent=4, sort_keys=True)
+
+
+def worker_has_result_index(_):
+    return result_processor.myglobal.result_index is not None
+
+
+class ResultProcessorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.run_dir = Path(self.tmp) / "run"
+        self.run_dir.mkdir()
+        self.index_path = os.path.join(self.tmp, "result-index.db")
+
+        result_processor.myglobal = result_processor.global_vars()
+        result_processor.myglobal.log = logging.getLogger("test_result_processor")
+        result_processor.myglobal.run_dir = str(self.run_dir)
+        self.set_args()
+
+    def tearDown(self):
+        result_processor.close_result_index()
+        shutil.rmtree(self.tmp)
+
+    def set_args(self, **kwargs):
+        args = {
+            "mode": "ls",
+            "type": "tags",
+            "result_dir": None,
+            "filter_type": "name",
+            "filters": [],
+            "no_index": False,
+            "jobs": 1,
+            "crucible_result_index": self.index_path,
+        }
+        args.update(kwargs)
+        result_processor.myglobal.args = argparse.Namespace(**args)
+
+
+class TestResultIndex(ResultProcessorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.result = self.run_dir / "uperf-run"
+        self.data = {
+            "id": "1234",
+            "tags": [{"name": "campaign", "val": "a"}],
+            "partial": True,
+            "dropped-engines": ["client-1"],
+            "iterations": [{"params": list(range(10))}],
+        }
+        write_rickshaw_run(self.result, self.data)
+
+    def test_summary_only_keeps_listing_keys(self):
+        summary = result_processor.summarize_rickshaw_run(self.data)
+        self.assertNotIn("iterations", summary)
+        self.assertEqual(summary["tags"], self.data["tags"])
+        self.assertIsNone(result_processor.summarize_rickshaw_run(None))
+
+    def test_index_round_trip(self):
+        result_processor.open_result_index()
+        data, status = result_processor.load_result_summary(self.result)
+        self.assertEqual(status, "complete")
+
+        cached, cached_status = result_processor.read_result_index(self.result)
+        self.assertEqual(cached_status, "complete")
+        self.assertEqual(cached["id"], "1234")
+        self.assertEqual(cached["tags"], data["tags"])
+        self.assertTrue(cached["partial"])
+        self.assertEqual(cached["dropped-engines"], ["client-1"])
+
+    def test_index_invalidated_by_rewrite(self):
+        result_processor.open_result_index()
+        result_processor.load_result_summary(self.result)
+
+        (self.result / "run" / "rickshaw-run.json.xz").unlink()
+        self.data["tags"] = [{"name": "campaign", "val": "b"}]
+        write_rickshaw_run(self.result, self.data, compress=False)
+        # make sure the directory mtime moves even on coarse filesystems
+        os.utime(self.result / "run", ns=(0, 1))
+
+        data, status = result_processor.load_result_summary(self.result)
+        self.assertEqual(data["tags"], [{"name": "campaign", "val": "b"}])
+
+    def test_index_records_missing_rickshaw_run(self):
+        empty = self.run_dir / "empty-run"
+        empty.mkdir()
+        result_processor.open_result_index()
+        self.assertEqual(result_processor.load_result_summary(empty), (None, "incomplete"))
+
+        self.assertEqual(result_processor.read_result_index(empty), (None, "incomplete"))
+
+    def test_prune_removes_deleted_results(self):
+        result_processor.open_result_index()
+        result_processor.load_result_summary(self.result)
+        result_processor.prune_result_index(self.run_dir, [])
+        count = result_processor.myglobal.result_index.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        self.assertEqual(count, 0)
+        count = result_processor.myglobal.result_index.execute("SELECT COUNT(*) FROM result_tags").fetchone()[0]
+        self.assertEqual(count, 0)
+
+    def test_outdated_index_rebuilt(self):
+        index = result_processor.sqlite3.connect(self.index_path)
+        index.execute("CREATE TABLE results (path TEXT PRIMARY KEY)")
+        index.commit()
+        index.close()
+
+        self.assertEqual(result_processor.open_result_index(), 0)
+        data, status = result_processor.load_result_summary(self.result)
+        self.assertEqual(result_processor.read_result_index(self.result), (data, status))
+
+    def test_no_index(self):
+        self.set_args(no_index=True, type="run-id")
+        self.assertEqual(result_processor.open_result_index(), 1)
+        data, status = result_processor.load_result_summary(self.result)
+        self.assertEqual(data["id"], "1234")
+        self.assertFalse(os.path.exists(self.index_path))
+
+    def test_no_index_only_extracts_needed_keys(self):
+        self.set_args(no_index=True, type="tags")
+        data, status = result_processor.load_result_summary(self.result)
+        self.assertEqual(data, {"tags": self.data["tags"], "partial": True, "dropped-engines": ["client-1"]})
+
+
+class TestTagIndex(ResultProcessorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.results = {}
+        for name, tags in [("run-a", {"campaign": "x", "host": "h1"}),
+                           ("run-b", {"campaign": "y", "host": "h1"}),
+                           ("run-c", {"campaign": "x"}),
+                           ("run-d", {})]:
+            self.results[name] = self.run_dir / name
+            write_rickshaw_run(self.results[name], {"tags": [{"name": k, "val": v} for k, v in tags.items()]})
+        result_processor.open_result_index()
+
+    def filtered(self, filters, match="any"):
+        self.set_args(filter_type="tags", filters=filters, filter_match=match)
+        matches = result_processor.filter_results_by_tags(sorted(self.results.values()), filters, match == "all")
+        return [result.name for result in matches]
+
+    def test_name_and_value_filters(self):
+        self.assertEqual(self.filtered(["host"]), ["run-a", "run-b"])
+        self.assertEqual(self.filtered(["campaign:x"]), ["run-a", "run-c"])
+        self.assertEqual(self.filtered(["campaign:z"]), [])
+
+    def test_any_and_all(self):
+        self.assertEqual(self.filtered(["campaign:y", "campaign:x"]), ["run-a", "run-b", "run-c"])
+        self.assertEqual(self.filtered(["campaign:x", "host:h1"], "all"), ["run-a"])
+        self.assertEqual(self.filtered(["campaign:y", "campaign:x"], "all"), [])
+
+    def test_scan_matches_index(self):
+        for match in ["any", "all"]:
+            for filters in [["host"], ["campaign:x", "host:h1"], ["campaign:y", "campaign:x"]]:
+                scanned = result_processor.scan_results_by_tags(sorted(self.results.values()), filters, match == "all")
+                self.assertEqual(self.filtered(filters, match), [result.name for result in scanned])
+
+    def test_tag_mode_updates_index(self):
+        result_processor.refresh_result_index(sorted(self.results.values()))
+        self.set_args(mode="tags", action="add", tags=["campaign:z"], result_dir=str(self.results["run-d"]))
+        self.assertEqual(result_processor.run_results_tag_mode(), 0)
+
+        tags = result_processor.myglobal.result_index.execute(
+            "SELECT name, val FROM result_tags WHERE path = ?", (str(self.results["run-d"].absolute()),)).fetchall()
+        self.assertEqual(tags, [("campaign", "z")])
+        self.assertEqual(self.filtered(["campaign:z"]), ["run-d"])
+
+        self.set_args(mode="tags", action="remove", tags=["campaign"], result_dir=str(self.results["run-a"]))
+        self.assertEqual(result_processor.run_results_tag_mode(), 0)
+        self.assertEqual(self.filtered(["campaign:x"]), ["run-c"])
+
+
+class TestTagOverlay(ResultProcessorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.result = self.run_dir / "uperf-run"
+        self.data = {"id": "1234", "tags": [{"name": "campaign", "val": "a"}], "iterations": list(range(100))}
+        write_rickshaw_run(self.result, self.data)
+        self.rickshaw_run = self.result / "run" / "rickshaw-run.json.xz"
+        self.original = self.rickshaw_run.read_bytes()
+
+    def tag(self, action, tags=[]):
+        self.set_args(mode="tags", action=action, tags=tags, result_dir=str(self.result))
+        return result_processor.run_results_tag_mode()
+
+    def test_edits_only_write_overlay(self):
+        self.assertEqual(self.tag("add", ["host:h1", "campaign:b"]), 0)
+        self.assertEqual(self.tag("remove", ["host"]), 0)
+
+        self.assertEqual(self.rickshaw_run.read_bytes(), self.original)
+        self.assertEqual(sorted(os.listdir(self.result / "run")), ["rickshaw-run.json.xz", "rickshaw-run.tags.json"])
+
+        expected = [{"name": "campaign", "val": "b"}]
+        data, status = result_processor.load_rickshaw_run(self.result)
+        self.assertEqual(data["tags"], expected)
+        self.assertEqual(data["iterations"], self.data["iterations"])
+        data, status = result_processor.load_rickshaw_run(self.result, ["tags", "id"])
+        self.assertEqual(data, {"tags": expected, "id": "1234"})
+
+    def test_compact(self):
+        self.assertEqual(self.tag("compact"), 0)
+        self.assertEqual(self.rickshaw_run.read_bytes(), self.original)
+
+        self.tag("add", ["host:h1"])
+        self.assertEqual(self.tag("compact"), 0)
+        self.assertEqual(os.listdir(self.result / "run"), ["rickshaw-run.json.xz"])
+        with lzma.open(self.rickshaw_run, "rt") as f:
+            data = json.load(f)
+        self.assertEqual(data["tags"], [{"name": "campaign", "val": "a"}, {"name": "host", "val": "h1"}])
+        self.assertEqual(data["iterations"], self.data["iterations"])
+
+    def test_compact_keeps_mode(self):
+        self.rickshaw_run.chmod(0o640)
+        self.tag("add", ["host:h1"])
+        self.assertEqual(self.tag("compact"), 0)
+        self.assertEqual(self.rickshaw_run.stat().st_mode & 0o7777, 0o640)
+
+    def test_overlay_from_incomplete_run(self):
+        result = self.run_dir / "new-run"
+        write_rickshaw_run(result, self.data, subdir="config", compress=False)
+        self.set_args(mode="tags", action="add", tags=["host:h1"], result_dir=str(result))
+        self.assertEqual(result_processor.run_results_tag_mode(), 0)
+        self.assertTrue((result / "config" / "rickshaw-run.tags.json").exists())
+
+        # the run completes: rickshaw writes run/'s copy from the original
+        write_rickshaw_run(result, self.data)
+        expected = [{"name": "campaign", "val": "a"}, {"name": "host", "val": "h1"}]
+        data, status = result_processor.load_rickshaw_run(result)
+        self.assertEqual(status, "complete")
+        self.assertEqual(data["tags"], expected)
+
+        # a later edit goes next to run/'s copy and wins
+        self.set_args(mode="tags", action="remove", tags=["campaign"], result_dir=str(result))
+        self.assertEqual(result_processor.run_results_tag_mode(), 0)
+        self.assertEqual(result_processor.load_rickshaw_run(result)[0]["tags"], [{"name": "host", "val": "h1"}])
+
+        self.set_args(mode="tags", action="compact", tags=[], result_dir=str(result))
+        self.assertEqual(result_processor.run_results_tag_mode(), 0)
+        self.assertEqual(list(result.glob("*/rickshaw-run.tags.json")), [])
+        self.assertEqual(result_processor.load_rickshaw_run(result)[0]["tags"], [{"name": "host", "val": "h1"}])
+
+    def test_failed_replace_keeps_original(self):
+        def failing_writer(path, data):
+            with open(path, "w") as f:
+                f.write("partial")
+            raise OSError("disk full")
+
+        with self.assertRaises(OSError):
+            result_processor.replace_file(self.rickshaw_run, failing_writer, None)
+        self.assertEqual(self.rickshaw_run.read_bytes(), self.original)
+        self.assertEqual(os.listdir(self.result / "run"), ["rickshaw-run.json.xz"])
+
+    def test_index_follows_overlay(self):
+        result_processor.open_result_index()
+        result_processor.load_result_summary(self.result)
+        self.tag("add", ["host:h1"])
+        data, status = result_processor.read_result_index(self.result)
+        self.assertEqual(data["id"], "1234")
+        self.assertEqual(data["tags"], [{"name": "campaign", "val": "a"}, {"name": "host", "val": "h1"}])
+        # the entry was carried forward, not invalidated
+        self.assertEqual(result_processor.refresh_result_index([self.result]), {})
+
+
+class TestBulkTags(ResultProcessorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.results = []
+        for i in range(6):
+            result = self.run_dir / ("run-%d" % (i))
+            tags = [{"name": "campaign", "val": "even" if i % 2 == 0 else "odd"}]
+            write_rickshaw_run(result, {"id": str(i), "tags": tags})
+            self.results.append(result)
+        (self.run_dir / "latest").symlink_to(self.results[-1])
+        result_processor.myglobal.log.setLevel(logging.INFO)
+
+    def tearDown(self):
+        result_processor.myglobal.log.setLevel(logging.NOTSET)
+        super().tearDown()
+
+    def bulk(self, action, tags=[], globs=[], filters=[], stdin=False, jobs=1, match="any"):
+        self.set_args(mode="tags", action=action, tags=tags, result_dir=None, globs=globs,
+                      filters=filters, filter_match=match, stdin=stdin, jobs=jobs)
+        with self.assertLogs(result_processor.myglobal.log, logging.INFO) as logs:
+            rc = result_processor.run_results_bulk_tag_mode()
+        return rc, [record.getMessage() for record in logs.records]
+
+    def tags_of(self, result):
+        data, status = result_processor.load_rickshaw_run(result, ["tags"])
+        return data["tags"]
+
+    def test_glob(self):
+        rc, report = self.bulk("add", ["batch:1"], globs=["run-[0-2]"])
+        self.assertEqual(rc, 0)
+        self.assertEqual(report[-1], "3 of 3 result directories succeeded")
+        self.assertEqual(report[0], "run-0: ok [campaign:even, batch:1]")
+        self.assertNotIn({"name": "batch", "val": "1"}, self.tags_of(self.results[3]))
+
+    def test_tag_filter_parallel(self):
+        result_processor.open_result_index()
+        rc, report = self.bulk("add", ["parity:yes"], filters=["campaign:odd"], jobs=3)
+        self.assertEqual(rc, 0)
+        self.assertEqual(report[:-1], ["run-%d: ok [campaign:odd, parity:yes]" % (i) for i in [1, 3, 5]])
+
+        # the index was updated from the parent process
+        matches = result_processor.filter_results_by_tags(self.results, ["parity:yes"], False)
+        self.assertEqual(matches, self.results[1::2])
+
+    def test_tag_filter_without_index(self):
+        rc, report = self.bulk("ls", filters=["campaign:even", "campaign:odd"], match="all")
+        self.assertEqual(rc, 1)
+        self.assertEqual(report, ["No result directories were selected"])
+
+    def test_stdin_reports_failures(self):
+        stdin = io.StringIO("run-1\n%s\nmissing\n\n" % (self.results[2]))
+        with unittest.mock.patch.object(result_processor.sys, "stdin", stdin):
+            rc, report = self.bulk("remove", ["campaign"], stdin=True)
+        self.assertEqual(rc, 1)
+        self.assertEqual(report[0], "run-1: ok []")
+        self.assertEqual(report[1], "run-2: ok []")
+        self.assertTrue(report[2].startswith("missing: failed (The requested result directory does not exist"))
+        self.assertEqual(report[3], "2 of 3 result directories succeeded")
+        self.assertEqual(self.tags_of(self.results[1]), [])
+
+    def test_compact_all(self):
+        self.bulk("add", ["batch:2"], globs=["run-*"], jobs=2)
+        rc, report = self.bulk("compact", jobs=2)
+        self.assertEqual(rc, 0)
+        self.assertEqual(len(report), 7)
+        self.assertEqual(list(self.run_dir.glob("*/run/rickshaw-run.tags.json")), [])
+        with lzma.open(self.results[0] / "run" / "rickshaw-run.json.xz", "rt") as f:
+            self.assertIn({"name": "batch", "val": "2"}, json.load(f)["tags"])
+
+
+class TestStructuredOutput(ResultProcessorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        write_rickshaw_run(self.run_dir / "old-run", {"id": "1234", "tags": [{"name": "campaign", "val": "a"}],
+                                                      "partial": True, "dropped-engines": ["client-1"]})
+        write_rickshaw_run(self.run_dir / "uperf--2026-01-02_10:00:00--0000-abcd", {"tags": []}, subdir="config")
+        (self.run_dir / "empty-run").mkdir()
+        (self.run_dir / "latest").symlink_to(self.run_dir / "old-run")
+
+    def listing(self, **kwargs):
+        self.set_args(**kwargs)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            result_processor.open_result_index()
+            result_processor.open_ls_output()
+            self.assertEqual(result_processor.run_results_ls_mode(), 0)
+            result_processor.close_ls_output()
+            result_processor.close_result_index()
+        return output.getvalue()
+
+    def test_ndjson(self):
+        lines = self.listing(format="ndjson").splitlines()
+        records = [json.loads(line) for line in lines]
+        self.assertEqual([record["name"] for record in records],
+                         ["empty-run", "old-run", "uperf--2026-01-02_10:00:00--0000-abcd"])
+        self.assertEqual(records[0], {"name": "empty-run", "symlink-target": None, "status": "incomplete",
+                                      "partial": False, "dropped-engines": [], "tags": None, "run-id": None})
+        self.assertEqual(records[1], {"name": "old-run", "symlink-target": None, "status": "complete",
+                                      "partial": True, "dropped-engines": ["client-1"],
+                                      "tags": [{"name": "campaign", "val": "a"}], "run-id": "1234"})
+        self.assertEqual(records[2]["run-id"], "0000-abcd")
+        self.assertEqual(records[2]["status"], "incomplete")
+
+    def test_json(self):
+        records = json.loads(self.listing(format="json", type="short"))
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[1]["tags"], [{"name": "campaign", "val": "a"}])
+
+        self.assertEqual(json.loads(self.listing(format="json", filter_type="tags", filters=["campaign:a"]))[0]["name"], "old-run")
+        self.assertEqual(json.loads(self.listing(format="json", filter_type="name", filters=["nomatch"])), [])
+
+    def test_symlink_target(self):
+        record = json.loads(self.listing(format="ndjson", result_dir=str(self.run_dir / "latest")))
+        self.assertEqual(record["name"], "latest")
+        self.assertEqual(record["symlink-target"], "old-run")
+
+    def test_errors_stay_out_of_stdout(self):
+        for fmt in ("json", "ndjson", "text"):
+            with self.subTest(format=fmt):
+                self.set_args(format=fmt, result_dir=str(self.run_dir / "missing"))
+                stdout, stderr = io.StringIO(), io.StringIO()
+                with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                    handler = logging.StreamHandler(result_processor.log_stream())
+                    result_processor.myglobal.log.addHandler(handler)
+                    try:
+                        result_processor.open_ls_output()
+                        self.assertEqual(result_processor.run_results_ls_mode(), 1)
+                        result_processor.close_ls_output()
+                    finally:
+                        result_processor.myglobal.log.removeHandler(handler)
+                if fmt == "text":
+                    self.assertIn("missing", stdout.getvalue())
+                    continue
+                self.assertIn("missing", stderr.getvalue())
+                if fmt == "json":
+                    self.assertEqual(json.loads(stdout.getvalue()), [])
+                else:
+                    self.assertEqual(stdout.getvalue(), "")
+
+
+class TestUsage(ResultProcessorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.big = self.run_dir / "big-run"
+        write_rickshaw_run(self.big, {"id": "1"})
+        (self.big / "run" / "data").mkdir()
+        (self.big / "run" / "data" / "blob").write_bytes(os.urandom(256 * 1024))
+        os.link(self.big / "run" / "data" / "blob", self.big / "run" / "data" / "blob-link")
+        (self.big / "run" / "dangling").symlink_to("/nonexistent")
+
+        self.small = self.run_dir / "small-run"
+        write_rickshaw_run(self.small, {"id": "2"}, subdir="config")
+        os.utime(self.small, ns=(0, 0))
+        for path in self.small.rglob("*"):
+            os.utime(path, ns=(0, 0), follow_symlinks=False)
+
+        self.set_args(type="usage", sort="name", min_size=None, older_than=None, rescan=False)
+
+    def test_walk(self):
+        total_bytes, files, newest_mtime_ns = result_processor.walk_result_directory(self.big)
+        self.assertEqual(files, 4)
+        # the hard link is only counted once
+        self.assertGreaterEqual(total_bytes, 256 * 1024)
+        self.assertLess(total_bytes, 2 * 256 * 1024)
+        self.assertEqual(result_processor.walk_result_directory(self.small)[2], 0)
+
+    def test_complete_runs_are_cached(self):
+        result_processor.open_result_index()
+        first = result_processor.load_result_usage([self.big, self.small])
+
+        (self.big / "run" / "data" / "blob").write_bytes(b"")
+        (self.small / "config" / "more").write_bytes(os.urandom(64 * 1024))
+        second = result_processor.load_result_usage([self.big, self.small])
+        self.assertEqual(second[self.big], first[self.big])
+        self.assertGreater(second[self.small][0], first[self.small][0])
+
+        self.set_args(type="usage", rescan=True)
+        self.assertLess(result_processor.load_result_usage([self.big])[self.big][0], first[self.big][0])
+
+    def test_select(self):
+        usage = result_processor.load_result_usage([self.big, self.small])
+        results = [self.big, self.small]
+
+        self.set_args(type="usage", sort="age", min_size=None, older_than=None)
+        self.assertEqual(result_processor.select_results_by_usage(results, usage), [self.small, self.big])
+        self.set_args(type="usage", sort="size", min_size=None, older_than=None)
+        self.assertEqual(result_processor.select_results_by_usage(results, usage), [self.big, self.small])
+        self.set_args(type="usage", sort="name", min_size=128 * 1024, older_than=None)
+        self.assertEqual(result_processor.select_results_by_usage(results, usage), [self.big])
+        self.set_args(type="usage", sort="name", min_size=None, older_than=86400)
+        self.assertEqual(result_processor.select_results_by_usage(results, usage), [self.small])
+
+    def test_parse(self):
+        self.assertEqual(result_processor.parse_size("10G"), 10 * 1024 ** 3)
+        self.assertEqual(result_processor.parse_size("1.5m"), int(1.5 * 1024 ** 2))
+        self.assertEqual(result_processor.parse_size("4096"), 4096)
+        self.assertEqual(result_processor.parse_age("2w"), 2 * 604800)
+        for bad in ["", "G", "1X"]:
+            with self.assertRaises(argparse.ArgumentTypeError):
+                result_processor.parse_size(bad)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            result_processor.parse_age("30")
+        self.assertEqual(result_processor.format_size(1536), "1.5 KiB")
+        self.assertEqual(result_processor.format_age(90061), "1d01h")
+
+
+class TestMetadataOnly(ResultProcessorTestCase):
+
+    def test_run_dir_without_opening(self):
+        complete = self.run_dir / "complete"
+        (complete / "run").mkdir(parents=True)
+        # deliberately not valid xz/json, it must never be read
+        (complete / "run" / "rickshaw-run.json.xz").write_text("garbage")
+
+        incomplete = self.run_dir / "incomplete"
+        (incomplete / "config").mkdir(parents=True)
+        (incomplete / "config" / "rickshaw-run.json").write_text("garbage")
+
+        self.set_args(mode="completion", type="run-dir")
+        self.assertTrue(result_processor.metadata_only())
+        summaries = result_processor.load_result_summaries([complete, incomplete])
+        self.assertEqual(summaries[complete], (None, None))
+        self.assertEqual(summaries[incomplete], (None, None))
+
+    def test_short_shows_partial(self):
+        write_rickshaw_run(self.run_dir / "partial-run", {"id": "1234", "partial": True,
+                                                          "dropped-engines": ["client-1", "server-1"]})
+        for ls_type in ("short", "usage"):
+            for no_index in (False, True):
+                with self.subTest(type=ls_type, no_index=no_index):
+                    self.set_args(type=ls_type, no_index=no_index, sort="name", min_size=None, older_than=None, rescan=False)
+                    self.assertFalse(result_processor.metadata_only())
+                    result_processor.open_result_index()
+                    with self.assertLogs(result_processor.myglobal.log, logging.INFO) as logs:
+                        self.assertEqual(result_processor.run_results_ls_mode(), 0)
+                    result_processor.close_result_index()
+                    self.assertIn("partial: yes (2 engine(s) dropped)", "\n".join(logs.output))
+
+    def test_modes(self):
+        self.set_args(mode="completion", type="run-dir")
+        self.assertTrue(result_processor.metadata_only())
+        self.set_args(mode="completion", type="run-id")
+        self.assertFalse(result_processor.metadata_only())
+        self.set_args(type="short")
+        self.assertFalse(result_processor.metadata_only())
+        self.set_args(type="short", filter_type="tags", filters=["campaign"])
+        self.assertFalse(result_processor.metadata_only())
+        self.set_args(type="tags")
+        self.assertFalse(result_processor.metadata_only())
+
+
+class TestCompletionCache(ResultProcessorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = Path(self.tmp) / "completion-cache"
+        result_processor.myglobal.log.setLevel(logging.INFO)
+        for name in ["b-run", "a-run"]:
+            (self.run_dir / name).mkdir()
+
+    def tearDown(self):
+        result_processor.myglobal.log.setLevel(logging.NOTSET)
+        super().tearDown()
+
+    def run_completion(self):
+        self.set_args(mode="completion", type="run-dir", cache_dir=str(self.cache_dir))
+        cache = result_processor.open_completion_cache()
+        rc = result_processor.run_results_ls_mode()
+        result_processor.close_completion_cache(cache, rc)
+        return rc
+
+    def test_cache_written(self):
+        self.assertEqual(self.run_completion(), 0)
+        self.assertEqual((self.cache_dir / "run-dir").read_text(), "a-run\nb-run\n")
+        self.assertEqual(list(self.cache_dir.glob(".*")), [])
+
+    def test_cache_not_written_on_failure(self):
+        shutil.rmtree(self.run_dir)
+        self.run_completion()
+        self.assertFalse((self.cache_dir / "run-dir").exists())
+
+    def test_cache_disabled(self):
+        self.set_args(mode="completion", type="run-dir", cache_dir="")
+        self.assertIsNone(result_processor.open_completion_cache())
+
+
+class TestJsonKeyExtractor(unittest.TestCase):
+
+    DOC = {
+        "benchmark": "uperf",
+        "dropped-engines": [],
+        "id": "abc-123",
+        "iterations": [{"params": [{"arg": "x%d" % (i), "val": "]}\\\"{["} for i in range(50)]} for j in range(50)],
+        "num": 1234567.25,
+        "tags": [{"name": "campaign", "val": "a b"}],
+        "zz": "last",
+    }
+
+    def extract(self, keys, chunk_size=262144, **dump_args):
+        text = json.dumps(self.DOC, **dump_args)
+        return result_processor.json_key_extractor(io.StringIO(text), keys, chunk_size).extract()
+
+    def test_matches_full_load(self):
+        keys = ["tags", "id", "run-id", "num", "zz"]
+        expected = {key: self.DOC[key] for key in keys if key in self.DOC}
+        for chunk_size in [1, 7, 64, 262144]:
+            for indent in [None, 4]:
+                self.assertEqual(self.extract(keys, chunk_size, indent=indent), expected)
+
+    def test_stops_once_keys_are_found(self):
+        text = json.dumps({"id": "abc", "rest": [1, 2, 3]}) + "this is not json"
+        extractor = result_processor.json_key_extractor(io.StringIO(text), ["id"], 4)
+        self.assertEqual(extractor.extract(), {"id": "abc"})
+        self.assertFalse(extractor.eof)
+
+    def test_stops_at_either_alternative(self):
+        # 'id' and 'run-id' are never both present, waiting for the
+        # other one would read to the end
+        text = json.dumps({"a": 1, "run-id": "abc", "rest": [1, 2, 3]}) + "this is not json"
+        extractor = result_processor.json_key_extractor(io.StringIO(text), ["id", "run-id", "a"], 4,
+                                                        alternatives=[("id", "run-id")])
+        self.assertEqual(extractor.extract(), {"a": 1, "run-id": "abc"})
+        self.assertFalse(extractor.eof)
+
+    def test_invalid_document(self):
+        with self.assertRaises(json.JSONDecodeError):
+            result_processor.json_key_extractor(io.StringIO('{"a": [1, 2'), ["id"], 4).extract()
+        with self.assertRaises(json.JSONDecodeError):
+            result_processor.json_key_extractor(io.StringIO('[1, 2]'), ["id"]).extract()
+
+
+class TestParallelLoading(ResultProcessorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.results = []
+        for i in range(6):
+            result = self.run_dir / ("run-%d" % (i))
+            write_rickshaw_run(result, {"id": str(i), "tags": [{"name": "n", "val": str(i)}]})
+            self.results.append(result)
+        self.set_args(no_index=True)
+
+    def test_parallel_matches_serial(self):
+        serial = result_processor.load_result_summaries(self.results)
+        self.set_args(no_index=True, jobs=3)
+        parallel = result_processor.load_result_summaries(self.results)
+        self.assertEqual(list(parallel.keys()), self.results)
+        self.assertEqual(parallel, serial)
+
+    def test_parallel_populates_index(self):
+        self.set_args(jobs=3)
+        result_processor.open_result_index()
+        result_processor.load_result_summaries(self.results)
+        for i, result in enumerate(self.results):
+            data, status = result_processor.read_result_index(result)
+            self.assertEqual(data["id"], str(i))
+
+    def test_workers_do_not_inherit_index(self):
+        self.set_args(jobs=3)
+        result_processor.open_result_index()
+        result_processor.load_result_summaries(self.results[:3])
+        self.assertEqual(result_processor.map_in_processes(worker_has_result_index, 3, self.results), [False] * 6)
+        # the parent has its index back, with what it wrote before
+        self.assertIsNotNone(result_processor.myglobal.result_index)
+        self.assertEqual(result_processor.read_result_index(self.results[0])[0]["id"], "0")
+
+
+if __name__ == "__main__":
+    unittest.main()